@@ -3,97 +3,214 @@ import { updateLastMessage } from './utils.js';
 import { sessions, currentSessionIndex } from './sessions.js';
 
 /**
- * Chooses the correct API function based on the model setting.
+ * Streams the AI response for the current session. The server picks the
+ * provider from the model code.
  */
 export async function callLLMStream(conversation, signal) {
   const session = sessions[currentSessionIndex];
   const { model, temperature, maxTokens } = session.settings;
+  return callChatStream(session, conversation, model, temperature, maxTokens, signal);
+}
+
+// Reconnects to an interrupted stream before giving up.
+const RESUME_ATTEMPTS = 5;
+
+// Session id -> id of the stream the server is generating for it.
+const activeStreams = new Map();
 
-  if (model.startsWith("gpt-4o")) {
-    return callOpenAIStream(session, conversation, model, temperature, maxTokens, signal);
-  } else if (model.startsWith("claude")) {
-    return callAnthropicStream(session, conversation, model, temperature, maxTokens, signal);
-  } else if (model.startsWith("gemini")) {
-    return callGoogleStream(session, conversation, model, temperature, maxTokens, signal);
-  } else if (model.startsWith("huggingface")) {
-    return callHuggingFaceStream(session, conversation, model, temperature, maxTokens, signal);
-  } else if (model.startsWith("mistral")) {
-    return callMistralStream(session, conversation, model, temperature, maxTokens, signal);
-  } else if (model.startsWith("upstage")) {
-    return callUpstageStream(session, conversation, model, temperature, maxTokens, signal);
-  } else {
-    throw new Error("Unsupported model: " + model);
+/**
+ * Handles one SSE frame. Returns false once the stream is over.
+ */
+function handleFrame(frame, state, session, errorPrefix) {
+  let dataStr = null;
+  for (const line of frame.split("\n")) {
+    if (line.startsWith("id:")) {
+      state.lastEventId = line.substring(3).trim();
+    } else if (line.startsWith("data:")) {
+      dataStr = line.substring(5).trim(); // Remove "data:" prefix
+    }
+  }
+  if (dataStr === null) return true;
+  if (dataStr === "[DONE]") {
+    state.done = true;
+    return false;
   }
+
+  try {
+    const parsed = JSON.parse(dataStr);
+    if (parsed.error) {
+      state.done = true;
+      state.error = parsed.error;
+      return false;
+    }
+    if (parsed.model) {
+      // Hedged requests report the model that actually answered.
+      session.messages[session.messages.length - 1].model = parsed.model;
+    }
+    const delta = parsed.choices[0].delta.content;
+    if (delta) {
+      state.aiMessage += delta;
+      updateLastMessage(session, state.aiMessage, true);
+    }
+  } catch (err) {
+    console.error(`${errorPrefix} parsing error:`, err, "Chunk:", dataStr);
+  }
+  return true;
 }
 
 /**
- * Process streaming response from LLM APIs
+ * Reads frames from one response until the stream ends. Throws when the
+ * connection drops before the end.
  */
-async function processStream(reader, decoder, session, errorPrefix = "Stream") {
-  let done = false;
-  let aiMessage = "";
+async function readStream(response, state, session, errorPrefix) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder("utf-8");
   let buffer = "";
-  
-  updateLastMessage(session, aiMessage, true);
-  
-  while (!done) {
-    const { value, done: doneReading } = await reader.read();
-    done = doneReading;
-    
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+
     // Decode the chunk and append it to the buffer
     buffer += decoder.decode(value, { stream: true });
-    
+
     // Process the buffer based on newline delimiters
     const parts = buffer.split("\n\n");
     // Keep the last part in buffer as it might be incomplete
     buffer = parts.pop();
-    
-    // Process complete parts
+
     for (const part of parts) {
-      const trimmed = part.trim();
-      if (!trimmed.startsWith("data:")) continue;
-      
-      const dataStr = trimmed.substring(5).trim(); // Remove "data:" prefix
-      if (dataStr === "[DONE]") {
-        done = true;
-        break;
-      }
-      
-      try {
-        const parsed = JSON.parse(dataStr);
-        const delta = parsed.choices[0].delta.content;
-        if (delta) {
-          aiMessage += delta;
-          updateLastMessage(session, aiMessage, true);
-        }
-      } catch (err) {
-        console.error(`${errorPrefix} parsing error:`, err, "Chunk:", dataStr);
+      if (!handleFrame(part.trim(), state, session, errorPrefix)) {
+        reader.cancel().catch(() => {});
+        return;
       }
     }
   }
-  
+
   // Process any remaining buffered data
   if (buffer.trim()) {
-    try {
-      const trimmed = buffer.trim();
-      if (trimmed.startsWith("data:")) {
-        const dataStr = trimmed.substring(5).trim();
-        if (dataStr !== "[DONE]") {
-          const parsed = JSON.parse(dataStr);
-          const delta = parsed.choices[0].delta.content;
-          if (delta) {
-            aiMessage += delta;
-            updateLastMessage(session, aiMessage, true);
-          }
+    handleFrame(buffer.trim(), state, session, errorPrefix);
+  }
+  if (!state.done) {
+    throw new Error(`${errorPrefix} ended early`);
+  }
+}
+
+/**
+ * Reconnects to a stream the server is still generating (or has just
+ * finished), receiving only the frames after the last one seen.
+ */
+async function resumeStream(session, streamId, lastEventId, signal) {
+  const headers = { "X-Session-ID": session.id };
+  if (lastEventId !== null) {
+    headers["Last-Event-ID"] = lastEventId;
+  }
+  const response = await fetch(`http://127.0.0.1:8000/streams/${encodeURIComponent(streamId)}`, { headers, signal });
+  if (!response.ok) {
+    throw new Error(`Cannot resume stream: ${response.status}`);
+  }
+  return response;
+}
+
+/**
+ * Process streaming response from LLM APIs. The server keeps generating
+ * when the connection drops, so an interrupted stream is resumed from the
+ * last event received.
+ */
+async function processStream(response, session, signal, errorPrefix = "Stream") {
+  const streamId = response.headers.get("X-Convo-Stream-ID");
+  const state = { aiMessage: "", lastEventId: null, done: false, error: null };
+
+  updateLastMessage(session, state.aiMessage, true);
+  if (streamId) {
+    activeStreams.set(session.id, streamId);
+  }
+
+  try {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        if (!response) {
+          response = await resumeStream(session, streamId, state.lastEventId, signal);
         }
+        await readStream(response, state, session, errorPrefix);
+        break;
+      } catch (err) {
+        if (err.name === "AbortError" || !streamId || attempt >= RESUME_ATTEMPTS) {
+          throw err;
+        }
+        console.warn(`${errorPrefix} interrupted, resuming:`, err);
+        response = null;
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
       }
-    } catch (err) {
-      console.error(`Final buffer parsing error:`, err, "Buffer:", buffer);
     }
+  } finally {
+    if (activeStreams.get(session.id) === streamId) {
+      activeStreams.delete(session.id);
+    }
+  }
+
+  updateLastMessage(session, state.aiMessage, false);
+  if (state.error) {
+    throw new Error(state.error);
+  }
+  return state.aiMessage;
+}
+
+/**
+ * Asks the server to stop generating the session's current answer.
+ * Aborting the fetch only closes the connection; the server keeps the
+ * generation running for a resume. The partial answer is kept.
+ */
+export async function cancelStream(session) {
+  const streamId = activeStreams.get(session.id);
+  if (!streamId) {
+    return false;
+  }
+  activeStreams.delete(session.id);
+  try {
+    const response = await fetch(`http://127.0.0.1:8000/streams/${encodeURIComponent(streamId)}/cancel`, {
+      method: "POST",
+      headers: { "X-Session-ID": session.id },
+    });
+    return response.ok && (await response.json()).cancelled;
+  } catch (err) {
+    console.warn("Cannot cancel stream:", err);
+    return false;
+  }
+}
+
+/**
+ * Flags the turn when the server left earlier turns out of the model's
+ * context without a summary in their place, or left out attachments whose
+ * file it no longer has (see `X-Convo-Context`).
+ */
+function noteLostHistory(session, response) {
+  let report = null;
+  try {
+    report = JSON.parse(response.headers.get("X-Convo-Context") || "null");
+  } catch (err) {
+    return;
+  }
+  if (!report) return;
+  const notices = [];
+  if (report.turns_lost) {
+    const turns = report.turns_lost === 1 ? "turn" : "turns";
+    notices.push(`${report.turns_lost} earlier ${turns} did not fit the model's context and were not sent`);
+  }
+  if (report.attachments_dropped && report.attachments_dropped.length) {
+    notices.push(`attachments no longer available were not sent: ${report.attachments_dropped.join(", ")}`);
   }
-  
-  updateLastMessage(session, aiMessage, false);
-  return aiMessage;
+  if (notices.length) {
+    session.messages[session.messages.length - 1].contextNotice = notices.join("; ");
+  }
+}
+
+/**
+ * The server keeps each session's history, so stream requests only carry
+ * the new user turn.
+ */
+function latestTurn(conversation) {
+  return conversation[conversation.length - 1];
 }
 
 /**
@@ -111,161 +228,43 @@ function createRequestOptions(session, payload, signal) {
   };
 }
 
-export async function callOpenAIStream(session, conversation, model, temperature, maxTokens, signal) {
-  const response = await fetch("http://127.0.0.1:8000/openai_stream", 
-    createRequestOptions(session, {
-      conversation: conversation,
-      temperature: temperature,
-      max_tokens: maxTokens,
-      model: model,
-    }, signal)
-  );
-  
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "OpenAI stream");
-}
-
-export async function callAnthropicStream(session, conversation, model, temperature, maxTokens, signal) {
-  console.log(`Calling Anthropic API with model: ${model}`);
-  
-  const response = await fetch("http://127.0.0.1:8000/anthropic_stream", 
-    createRequestOptions(session, {
-      messages: conversation,
-      temperature: temperature,
-      max_tokens: maxTokens,
-      model: model,
-    }, signal)
-  );
-  
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "Anthropic stream");
-}
-
-export async function callGoogleStream(session, conversation, model, temperature, maxTokens, signal) {
-  model = model.toLowerCase().replace(/\s+/g, '-');
-  console.log(`Calling Google (Gemini) API with model: ${model}`);
-  
-  const response = await fetch("http://127.0.0.1:8000/gemini_stream", 
-    createRequestOptions(session, {
-      messages: conversation,
-      temperature: temperature,
-      max_tokens: maxTokens,
-      model: model,
-    }, signal)
-  );
-  
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "Gemini stream");
-}
-
-export async function callHuggingFaceStream(session, conversation, model, temperature, maxTokens, signal) {
-  console.log(`Calling Hugging Face API with model: ${model}`);
-  
-  const response = await fetch("http://127.0.0.1:8000/huggingface_stream", 
-    createRequestOptions(session, {
-      messages: conversation,
-      temperature: temperature,
-      max_tokens: maxTokens,
-      model: model,
-    }, signal)
-  );
-  
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "Hugging Face stream");
-}
+export async function callChatStream(session, conversation, model, temperature, maxTokens, signal) {
+  console.log(`Calling chat stream with model: ${model}`);
 
-export async function callMistralStream(session, conversation, model, temperature, maxTokens, signal) {
-  console.log(`Calling Mistral API with model: ${model}`);
-  
-  const response = await fetch("http://127.0.0.1:8000/mistral_stream", 
+  const response = await fetch("http://127.0.0.1:8000/chat_stream", 
     createRequestOptions(session, {
-      conversation: conversation,
+      message: latestTurn(conversation),
       temperature: temperature,
       max_tokens: maxTokens,
       model: model,
     }, signal)
   );
 
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "Mistral stream");
-}
-
-export async function callUpstageStream(session, conversation, model, temperature, maxTokens, signal) {
-  console.log(`Calling Upstage API with model: ${model}`);
-  
-  const response = await fetch("http://127.0.0.1:8000/upstage_stream", 
-    createRequestOptions(session, { 
-      conversation: conversation,
-      temperature: temperature,
-      max_tokens: maxTokens,
-      model: model,
-    }, signal)
-  );
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({}));
+    throw new Error(error.detail || `Chat stream failed: ${response.status}`);
+  }
 
-  const reader = response.body.getReader();
-  const decoder = new TextDecoder("utf-8");
-  return processStream(reader, decoder, session, "Upstage stream");
+  noteLostHistory(session, response);
+  return processStream(response, session, signal, `${model} stream`);
 }
 
-
-
 /**
- * Makes a batch request to generate a summary of the conversation
+ * Waits for the server's background summary job for the session to finish
+ * (long-polling), then updates the stored summary and the summary overlay.
  */
-export async function callLLMSummaryBatch(sessionId, conversation, model, temperature, maxTokens) {
-  const loadingOverlay = document.getElementById("loadingOverlay");
-  const loadingOverlayText = document.getElementById("loadingOverlayText");
-  loadingOverlay.classList.add("active");
-  loadingOverlayText.innerHTML = "Generating summary by " + model + "...";
-
-  // Determine the appropriate endpoint based on the model
-  const modelToEndpoint = {
-    "gpt-4o": "openai_summary",
-    "claude": "anthropic_summary",
-    "gemini": "gemini_summary",
-    "huggingface": "huggingface_summary",
-    "mistral": "mistral_summary"
-  };
-  
-  // Find the matching prefix
-  const modelPrefix = Object.keys(modelToEndpoint).find(prefix => model.startsWith(prefix));
-  if (!modelPrefix) {
-    throw new Error("Unsupported model for summary: " + model);
+export async function waitForSummary(session) {
+  const response = await fetch(`http://127.0.0.1:8000/sessions/${encodeURIComponent(session.id)}/summary?wait=60`);
+  if (!response.ok) {
+    throw new Error(`Summary request failed: ${response.status}`);
   }
-  
-  const endpoint = `http://127.0.0.1:8000/${modelToEndpoint[modelPrefix]}`;
-
-  try {
-    const response = await fetch(endpoint, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-        "X-Session-ID": sessionId,
-      },
-      body: JSON.stringify({
-        conversation: conversation,
-        temperature: temperature,
-        max_tokens: maxTokens,
-        model: model,
-      }),
-    });
 
-    const responseData = await response.json();
-    const summaryText = responseData.summary;
-    sessions[currentSessionIndex].summary = summaryText;
+  const { summary } = await response.json();
+  session.summary = summary;
 
-    const summaryOverlay = document.getElementById('summaryOverlay');
-    if (summaryOverlay.classList.contains('active')) {
-      document.getElementById('summaryContent').innerHTML = marked.parse(summaryText);
-    }
-    
-    return summaryText;
-  } finally {
-    loadingOverlay.classList.remove("active");
+  const summaryOverlay = document.getElementById('summaryOverlay');
+  if (summaryOverlay.classList.contains('active') && sessions[currentSessionIndex] === session) {
+    document.getElementById('summaryContent').innerHTML = marked.parse(summary);
   }
+  return summary;
 }
@@ -3,6 +3,7 @@ import { addConversation, attachedFiles, updateFileAttachments } from './events_
 import { sessions, currentSessionIndex, getCurrentCardIndex, setCurrentCardIndex, updateCarousel } from './sessions.js';
 import { updateHamburgerPosition, toggleLayout } from './navigation.js';
 import { updateLastMessage } from './utils.js';
+import { cancelStream } from './api.js';
 
 // Global variables for streaming state
 window.isStreaming = false;
@@ -27,10 +28,12 @@ const chatInput = document.getElementById('chatInput');
 const sendBtn = document.getElementById('sendBtn');
 sendBtn.addEventListener('click', async () => {
   if (window.isStreaming) {
+    const session = sessions[currentSessionIndex];
+    // Stop the generation on the server too; aborting only drops the connection.
+    cancelStream(session);
     if (window.currentStreamController) {
       window.currentStreamController.abort();
     }
-    const session = sessions[currentSessionIndex];
     const lastIndex = session.messages.length - 1;
     const currentContent = session.messages[lastIndex].aiResponse;
     // Use the imported updateLastMessage instead of window.updateLastMessage
@@ -1,7 +1,7 @@
 // events_helper.js
 import { updateLastMessage, autoResizeTextarea } from './utils.js';
 import { renderCurrentSession, sessions, currentSessionIndex } from './sessions.js';
-import { callLLMStream, callLLMSummaryBatch } from './api.js';
+import { callLLMStream, waitForSummary } from './api.js';
 
 export let attachedFiles = [];
 
@@ -26,6 +26,29 @@ export async function fileToBase64(file) {
   });
 }
 
+/**
+ * Upload a file to the server's attachment store. Messages then reference
+ * the returned blob id instead of carrying the file as base64.
+ */
+export async function uploadAttachment(file) {
+  const formData = new FormData();
+  formData.append("file", file);
+  const response = await fetch("http://127.0.0.1:8000/attachments", {
+    method: "POST",
+    body: formData,
+  });
+  if (!response.ok) {
+    throw new Error(`Failed to upload ${file.name}: ${response.status}`);
+  }
+  const blob = await response.json();
+  return {
+    name: file.name,
+    size: blob.size,
+    type: blob.type,
+    blobId: blob.blobId,
+  };
+}
+
 /**
  * Update the file attachments UI.
  */
@@ -54,9 +77,10 @@ export async function addConversation(userText) {
   if (userText.trim() === '' && attachedFiles.length === 0) return;
   const session = sessions[currentSessionIndex];
   session.messages.push({
+    turnId: crypto.randomUUID(),
     userText,
     aiResponse: "",
-    attachments: await Promise.all(attachedFiles.map(fileToBase64)),
+    attachments: await Promise.all(attachedFiles.map(uploadAttachment)),
     model: session.settings.model,
     timestamp: new Date().toISOString(),
     maxTokens: session.settings.maxTokens,
@@ -73,7 +97,7 @@ export async function addConversation(userText) {
   // Build conversation context for API
   const conversation = [];
   session.messages.forEach(msg => {
-    conversation.push({ role: "user", content: msg.userText, attachments: msg.attachments, sessionId: msg.sessionId });
+    conversation.push({ role: "user", content: msg.userText, attachments: msg.attachments, sessionId: msg.sessionId, turnId: msg.turnId });
     if (msg.aiResponse) {
       conversation.push({ role: "assistant", content: msg.aiResponse, sessionId: msg.sessionId, model: msg.model, temperature: msg.temperature, max_tokens: msg.maxTokens, timestamp: msg.timestamp });
     }
@@ -89,13 +113,8 @@ export async function addConversation(userText) {
     session.messages[session.messages.length - 1].aiResponse = aiResponse;
     renderCurrentSession();
     if (session.settings.enableSummarization) {
-      await callLLMSummaryBatch(
-        session.id,
-        session.messages,
-        session.settings.summarizingModel,
-        session.settings.temperature,
-        session.settings.maxTokens
-      );
+      // The server summarizes in the background; pick the result up when ready.
+      waitForSummary(session).catch(err => console.error('Error fetching summary:', err));
     }
   } catch (err) {
     if (err.name === 'AbortError') {
@@ -1,5 +1,5 @@
 // main.js
-import { sessions, currentSessionIndex, renderCurrentSession, setSessions, setCurrentSessionIndex, renderSessionListFromData } from './sessions.js';
+import { sessions, currentSessionIndex, renderCurrentSession, setSessions, setCurrentSessionIndex, renderSessionListFromData, ensureMessagesLoaded, loadSessions } from './sessions.js';
 import { updateHamburgerPosition } from './navigation.js';
 import { initPresets } from './presets.js';
 
@@ -76,49 +76,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     }
 
     try {
-        const response = await fetch('http://127.0.0.1:8000/sessions');
-        const data = await response.json();
-        console.log("Recovered sessions:", data.sessions);
-
-        // Parse attachments JSON string in messages if present
-        data.sessions.forEach(session => {
-            session.messages.forEach(message => {
-                if (message.attachments) {
-                    try {
-                        message.attachments = JSON.parse(message.attachments);
-                    } catch (e) {
-                        console.error("Error parsing attachments JSON:", e);
-                        message.attachments = [];
-                    }
-                }
-            });
-        });
-
-        console.log("data.sessions", data.sessions);
-        setSessions(data.sessions.map(s => ({
-            id: s.sessionId,
-            name: s.name,
-            title: s.title,
-            messages: s.messages,
-            summary: s.summary.replace(/^```markdown\n/, ''),
-            settings: {
-                temperature: s.temperature,
-                maxTokens: s.maxTokens,
-                persona: s.persona,
-                model: s.model,
-                summarizingModel: s.summarizingModel,
-                modelPreset1: s.modelPreset1,
-                modelPreset2: s.modelPreset2,
-                enableSummarization: s.enableSummarization
-            }
-        })));
-
-        console.log("sessions", sessions);
-
-        // Use the setter function for currentSessionIndex
-        setCurrentSessionIndex(sessions.length - 1);
-        renderSessionListFromData(sessions);
-        renderCurrentSession();
+        await loadSessions();
     } catch (err) {
         console.error("Error loading sessions:", err);
     }
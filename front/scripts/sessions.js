@@ -2,11 +2,13 @@
 import { formatTimestamp } from './utils.js';
 import { updateLayout } from './navigation.js';
 import { setPresets } from './presets.js';
-import { determineSvgFile } from './utils.js';
+import { determineSvgFile, escapeHtml } from './utils.js';
 
 export let sessions = [];
 export let currentSessionIndex = 0;
 export let currentCardIndex = 0;
+// Cursor of the next (older) page of sessions; null once every page is loaded.
+let sessionsCursor = null;
 
 const summarizeToggleBtn = document.getElementById('customBtn3');
 
@@ -20,9 +22,125 @@ export function setCurrentSessionIndex(newIndex) {
   currentSessionIndex = newIndex;
 }
 
+/**
+ * Builds a client session from the metadata of `/sessions/page`.
+ * Messages are loaded when the session is opened.
+ */
+function sessionFromMetadata(s) {
+  return {
+    id: s.sessionId,
+    name: s.name,
+    title: s.title,
+    messages: [],
+    messagesLoaded: false,
+    summary: s.summary.replace(/^```markdown\n/, ''),
+    settings: {
+      temperature: s.temperature,
+      maxTokens: s.maxTokens,
+      persona: s.persona,
+      model: s.model,
+      summarizingModel: s.summarizingModel,
+      modelPreset1: s.modelPreset1,
+      modelPreset2: s.modelPreset2,
+      enableSummarization: s.enableSummarization
+    }
+  };
+}
+
+async function fetchSessionsPage(cursor) {
+  const url = new URL('http://127.0.0.1:8000/sessions/page');
+  if (cursor) url.searchParams.set('cursor', cursor);
+  const response = await fetch(url);
+  if (!response.ok) {
+    throw new Error(`Loading sessions failed: ${response.status}`);
+  }
+  return response.json();
+}
+
+/**
+ * Loads the most recently updated page of sessions and opens the newest one.
+ * Older sessions are fetched with `loadMoreSessions`.
+ */
+export async function loadSessions() {
+  const data = await fetchSessionsPage(null);
+  sessionsCursor = data.next_cursor;
+  // The page is ordered most recently updated first; the sidebar lists
+  // sessions oldest first.
+  setSessions(data.sessions.reverse().map(sessionFromMetadata));
+  setCurrentSessionIndex(sessions.length - 1);
+  await ensureMessagesLoaded(sessions[sessions.length - 1]);
+  renderSessionListFromData(sessions);
+  renderCurrentSession();
+}
+
+/**
+ * Prepends the next page of older sessions to the sidebar.
+ */
+export async function loadMoreSessions() {
+  if (!sessionsCursor) return;
+  const data = await fetchSessionsPage(sessionsCursor);
+  sessionsCursor = data.next_cursor;
+  const older = data.sessions.reverse().map(sessionFromMetadata);
+  setSessions([...older, ...sessions]);
+  setCurrentSessionIndex(currentSessionIndex + older.length);
+  renderSessionListFromData(sessions);
+}
+
+// Adds a "load older sessions" entry at the top of the list while pages remain.
+function addLoadMoreItem(sessionList) {
+  if (!sessionsCursor) return;
+  const li = document.createElement('li');
+  li.classList.add("session-item", "load-more-sessions");
+  li.textContent = "Load older sessions";
+  li.addEventListener('click', async () => {
+    li.textContent = "Loading…";
+    try {
+      await loadMoreSessions();
+    } catch (err) {
+      console.error("Error loading sessions:", err);
+      li.textContent = "Load older sessions";
+    }
+  });
+  sessionList.appendChild(li);
+}
+
+/**
+ * Fetch a session's messages on first use; the session list only carries metadata.
+ */
+export async function ensureMessagesLoaded(session) {
+  if (session.messagesLoaded !== false) return;
+
+  const messages = [];
+  let cursor = null;
+  do {
+    const url = new URL(`http://127.0.0.1:8000/sessions/${encodeURIComponent(session.id)}/messages`);
+    if (cursor) url.searchParams.set('cursor', cursor);
+    const response = await fetch(url);
+    const data = await response.json();
+
+    // Parse attachments JSON string in messages if present
+    data.messages.forEach(message => {
+      if (message.attachments) {
+        try {
+          message.attachments = JSON.parse(message.attachments);
+        } catch (e) {
+          console.error("Error parsing attachments JSON:", e);
+          message.attachments = [];
+        }
+      }
+    });
+    messages.push(...data.messages);
+    cursor = data.next_cursor;
+  } while (cursor);
+
+  session.messages = messages;
+  session.messagesLoaded = true;
+}
+
 export function renderSessionListFromData(sessions) {
   const sessionList = document.getElementById('sessionList');
   sessionList.innerHTML = "";
+  addLoadMoreItem(sessionList);
 
   sessions.forEach((session, index) => {
     const li = document.createElement('li');
@@ -50,8 +168,9 @@ export function renderSessionListFromData(sessions) {
     li.appendChild(removeBtn);
 
     // When the li is clicked, update the active session.
-    li.addEventListener('click', () => {
+    li.addEventListener('click', async () => {
       setCurrentSessionIndex(index);
+      await ensureMessagesLoaded(sessions[index]);
       // Re-render the session list to update the active class.
       renderSessionListFromData(sessions);
       // Render the selected session's conversation.
@@ -72,6 +191,7 @@ export function renderSessionListFromData(sessions) {
 export function renderSessionList() {
   const sessionList = document.getElementById('sessionList');
   sessionList.innerHTML = "";
+  addLoadMoreItem(sessionList);
   sessions.forEach((session, index) => {
     const li = document.createElement('li');
     const nameSpan = document.createElement('span');
@@ -89,9 +209,10 @@ export function renderSessionList() {
     });
 
     li.appendChild(removeBtn);
-    li.addEventListener('click', () => {
+    li.addEventListener('click', async () => {
       currentSessionIndex = index;
       currentCardIndex = 0;
+      await ensureMessagesLoaded(sessions[index]);
 
       renderSessionList();
       renderCurrentSession();
@@ -123,46 +244,13 @@ export async function removeSession(index) {
       'X-Session-ID': sessions[index].id
     }
   });
-  const data = await response.json();
-
-  // Parse attachments JSON string in messages if present
-  data.sessions.forEach(session => {
-    session.messages.forEach(message => {
-      if (message.attachments) {
-        try {
-          message.attachments = JSON.parse(message.attachments);
-        } catch (e) {
-          console.error("Error parsing attachments JSON:", e);
-          message.attachments = [];
-        }
-      }
-    });
-  });
-
-  setSessions(data.sessions.map(s => ({
-    id: s.sessionId,
-    name: s.name,
-    title: s.title,
-    messages: s.messages,
-    summary: s.summary,
-    settings: {
-      temperature: s.temperature,
-      maxTokens: s.maxTokens,
-      persona: s.persona,
-      model: s.model,
-      summarizingModel: s.summarizingModel,
-      modelPreset1: s.modelPreset1,
-      modelPreset2: s.modelPreset2,
-      enableSummarization: s.enableSummarization
-    }
-  })));
-
-  console.log("sessions", sessions);
+  if (!response.ok) {
+    console.error("Error removing session:", response.status);
+    return;
+  }
 
-  // Use the setter function for currentSessionIndex
-  setCurrentSessionIndex(sessions.length - 1);
-  renderSessionListFromData(sessions);
-  renderCurrentSession();
+  // Reload the first page; the server creates a default session if none remain.
+  await loadSessions();
 }
 
 export function renderCurrentSession() {
@@ -218,6 +306,7 @@ export function renderCurrentSession() {
           <div class="ai-meta">
             <span class="ai-model"><img src="${svg_file}" width="14" height="14" style="vertical-align: middle; margin-right: 5px;" alt="icon">${message.model}</span>
             <span class="ai-timestamp"> @${formatTimestamp(message.timestamp)}</span>
+            ${message.contextNotice ? `<span class="ai-context-notice" title="${escapeHtml(message.contextNotice)}">⚠ partial history</span>` : ""}
           </div>
         </div>
       </div>
@@ -145,3 +145,13 @@ export function determineSvgFile(model) {
   }
   return 'assets/mistral.svg';
 }
+
+// Escapes text for use in HTML content and attribute values.
+export function escapeHtml(text) {
+  return String(text)
+    .replace(/&/g, "&amp;")
+    .replace(/</g, "&lt;")
+    .replace(/>/g, "&gt;")
+    .replace(/"/g, "&quot;")
+    .replace(/'/g, "&#39;");
+}
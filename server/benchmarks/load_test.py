@@ -0,0 +1,253 @@
+"""
+Load test for the streaming endpoints against local mock providers.
+
+Starts the mock providers (`benchmarks.mock_providers`) and the real
+FastAPI app under uvicorn, each on its own thread and event loop, points
+every provider client at the mock, then drives N concurrent sessions
+through `/chat_stream`. Results are printed as JSON so releases can be
+compared. `--context-words` pads every message so conversations get long
+enough for the providers' prompt-prefix caches; the report then has the
+token hit rate per model and the mock's breakpoint checks, next to the
+server's own usage rollups (`/usage`). The database, the blob store and
+the caches go to a temporary directory, so nothing is left in the tree.
+Run from `server/`:
+
+    python -m benchmarks.load_test --sessions 50 --turns 3 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+from contextlib import redirect_stdout
+
+import aiohttp
+
+from benchmarks import mock_providers
+
+DEFAULT_MODELS = [
+    "gpt-4o-mini",
+    "claude-3.5-sonnet-latest",
+    "gemini-2.0-flash",
+    "mistral-large-latest",
+    "huggingface/meta-llama/Llama-3.3-70B-Instruct",
+    "upstage-solar-mini",
+]
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "mean": statistics.fmean(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_mock(config: mock_providers.MockConfig) -> str:
+    """Runs the mock providers on a background thread; returns its root URL."""
+    ready = threading.Event()
+    result = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result["runner"], result["root"] = loop.run_until_complete(mock_providers.start(config))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="mock-providers", daemon=True).start()
+    ready.wait()
+    return result["root"]
+
+def start_app(port: int):
+    """Imports the app (after the environment is set up) and serves it."""
+    import uvicorn
+    import main as app_module
+
+    config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, name="uvicorn", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return app_module, server
+
+def filler(words: int) -> str:
+    return " ".join(mock_providers._WORDS[i % len(mock_providers._WORDS)] for i in range(words))
+
+async def run_turn(http: aiohttp.ClientSession, root: str, session_id: str, model: str, turn: int,
+                   context_words: int = 0) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    content = []
+    error = None
+    payload = {
+        "message": {"content": f"Load test turn {turn}\n\n{filler(context_words)}".strip(), "turnId": f"{session_id}-{turn}"},
+        "model": model,
+        "temperature": 0,
+        "max_tokens": 256,
+    }
+    async with http.post(f"{root}/chat_stream", json=payload, headers={"X-Session-ID": session_id}) as response:
+        if response.status != 200:
+            error = f"HTTP {response.status}"
+        else:
+            async for line in response.content:
+                line = line.decode().strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                parsed = json.loads(data)
+                if "error" in parsed:
+                    error = parsed["error"]
+                    break
+                if first_token is None:
+                    first_token = time.perf_counter()
+                content.append(parsed["choices"][0]["delta"]["content"])
+    finished = time.perf_counter()
+
+    tokens = len("".join(content).split())
+    return {
+        "model": model,
+        "error": error,
+        "ttft": first_token - started if first_token else None,
+        "duration": finished - started,
+        "tokens": tokens,
+        "tokens_per_second": tokens / (finished - first_token) if first_token and finished > first_token else None,
+    }
+
+async def run_session(http, root: str, model: str, turns: int, context_words: int = 0) -> dict:
+    async with http.post(f"{root}/add_session") as response:
+        session_id = (await response.json())["sessionId"]
+    results = [await run_turn(http, root, session_id, model, turn, context_words) for turn in range(turns)]
+    async with http.get(f"{root}/sessions/{session_id}/prompt_cache") as response:
+        prompt_cache = await response.json()
+    return {"model": model, "turns": results, "prompt_cache": prompt_cache}
+
+async def drive(root: str, sessions: int, turns: int, models: list, context_words: int = 0) -> tuple:
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+        started = time.perf_counter()
+        sessions = await asyncio.gather(*[
+            run_session(http, root, models[i % len(models)], turns, context_words) for i in range(sessions)
+        ])
+        elapsed = time.perf_counter() - started
+    return sessions, elapsed
+
+def prompt_cache_rate(sessions: list) -> dict:
+    prompt_tokens = sum(s["prompt_cache"]["prompt_tokens"] for s in sessions)
+    cached_tokens = sum(s["prompt_cache"]["cached_tokens"] for s in sessions)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "token_hit_rate": cached_tokens / prompt_tokens if prompt_tokens else None,
+    }
+
+def report(sessions: list, elapsed: float, app_module, mock_stats: dict = None, usage: list = None) -> dict:
+    turns = [turn for session in sessions for turn in session["turns"]]
+    ok = [t for t in turns if not t["error"]]
+    by_model = {}
+    for model in sorted({t["model"] for t in turns}):
+        model_turns = [t for t in turns if t["model"] == model]
+        model_ok = [t for t in model_turns if not t["error"]]
+        by_model[model] = {
+            "turns": len(model_turns),
+            "errors": len(model_turns) - len(model_ok),
+            "ttft_seconds": summarize([t["ttft"] for t in model_ok if t["ttft"] is not None]),
+            "tokens_per_second": summarize([t["tokens_per_second"] for t in model_ok if t["tokens_per_second"]]),
+            "prompt_cache": prompt_cache_rate([s for s in sessions if s["model"] == model]),
+        }
+
+    watchdog = app_module.loop_watchdog
+    return {
+        "turns": len(turns),
+        "errors": len(turns) - len(ok),
+        "wall_seconds": elapsed,
+        "aggregate_tokens_per_second": sum(t["tokens"] for t in ok) / elapsed if elapsed else None,
+        "ttft_seconds": summarize([t["ttft"] for t in ok if t["ttft"] is not None]),
+        "turn_duration_seconds": summarize([t["duration"] for t in ok]),
+        "tokens_per_second": summarize([t["tokens_per_second"] for t in ok if t["tokens_per_second"]]),
+        "event_loop": {
+            "max_lag_seconds": watchdog.max_lag if watchdog else None,
+            "stalls_over_threshold": len(watchdog.reports) if watchdog else None,
+        },
+        "db_writes": app_module.conversation_writer.metrics(),
+        "prompt_cache": prompt_cache_rate(sessions),
+        "mock_prompt_cache": mock_stats,
+        "usage_rollups": usage,
+        "by_model": by_model,
+    }
+
+async def fetch_json(url: str) -> dict:
+    async with aiohttp.ClientSession() as http:
+        async with http.get(url) as response:
+            return await response.json()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--context-words", type=int, default=0, help="Filler words added to every message")
+    parser.add_argument("--stall-threshold-ms", type=float, default=50)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    mock_root = start_mock(mock_providers.MockConfig(
+        args.ttft_ms, args.tokens_per_second, args.tokens, args.error_rate
+    ))
+    # The stores follow the database into this directory.
+    workdir = tempfile.mkdtemp(prefix="convo-load-")
+    os.environ.update(mock_providers.base_urls(mock_root))
+    for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY", "MISTRAL_API_KEY", "HUGGINGFACE_TOKEN", "UPSTAGE_API_KEY"):
+        os.environ[key] = "mock"
+    os.environ["CONVO_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'load_test.db')}"
+    os.environ["CONVO_LOOP_WATCHDOG_MS"] = str(args.stall_threshold_ms)
+
+    # Keep stdout for the machine-readable report.
+    with redirect_stdout(sys.stderr):
+        port = free_port()
+        root = f"http://127.0.0.1:{port}"
+        app_module, server = start_app(port)
+
+        sessions, elapsed = asyncio.run(drive(root, args.sessions, args.turns, args.models, args.context_words))
+        # Let queued conversation writes land before reading the writer metrics.
+        app_module.conversation_writer.flush()
+        results = report(
+            sessions, elapsed, app_module,
+            asyncio.run(fetch_json(f"{mock_root}/mock/stats")),
+            asyncio.run(fetch_json(f"{root}/usage?group_by=model"))["usage"],
+        )
+        server.should_exit = True
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
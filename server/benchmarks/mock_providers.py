@@ -0,0 +1,294 @@
+"""
+Local stand-ins for the LLM providers' streaming APIs.
+
+One aiohttp app speaks the wire formats the SDKs in `stream/` expect:
+
+- OpenAI-style chat completions (`/v1/chat/completions`), used by the
+  OpenAI, Upstage, Mistral and Hugging Face clients
+- Anthropic messages (`/v1/messages`)
+- Gemini `streamGenerateContent` (`/v1beta/models/{model}:streamGenerateContent`)
+
+Time to first token, token rate, response length and error injection are
+configurable, so load tests cost no provider credits. Point the server at
+it with `base_urls()`.
+
+The OpenAI and Anthropic endpoints also imitate prompt-prefix caching.
+Anthropic requests are checked for valid `cache_control` breakpoints
+(at most four, all `ephemeral`; anything else is a 400 like the real
+API) and prefixes up to a breakpoint seen before are reported as
+`cache_read_input_tokens`. OpenAI requests get `cached_tokens` for the
+longest repeated message prefix of at least `min_cache_tokens`. Counts
+are served at `GET /mock/stats`.
+
+Every endpoint reports token usage the way its provider does: OpenAI in
+a final chunk when asked with `include_usage`, Mistral and Upstage on
+the last chunk unasked, Anthropic in its message events and Gemini in
+the `usageMetadata` of every chunk.
+"""
+import json
+import time
+import hashlib
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+class MockConfig:
+    def __init__(self, ttft_ms: float = 300, tokens_per_second: float = 50, tokens: int = 100,
+                 error_rate: float = 0.0, error_status: int = 500, min_cache_tokens: int = 1024):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.min_cache_tokens = min_cache_tokens
+
+    def token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+# Upstream models whose APIs put usage on the last chunk without being asked.
+_USAGE_ON_LAST_CHUNK = ("mistral", "codestral", "ministral", "solar")
+
+_WORDS = "the quick brown fox jumps over the lazy dog while streaming tokens".split()
+
+async def _tokens(config: MockConfig):
+    """Yields response tokens with the configured TTFT and rate."""
+    await asyncio.sleep(config.ttft_ms / 1000)
+    delay = config.token_delay()
+    for i in range(config.tokens):
+        if i:
+            await asyncio.sleep(delay)
+        yield _WORDS[i % len(_WORDS)] + " "
+
+def _injected_error(config: MockConfig):
+    if config.error_rate and random.random() < config.error_rate:
+        return web.json_response(
+            {"error": {"type": "mock_error", "message": "Injected error"}}, status=config.error_status
+        )
+    return None
+
+def _prompt_tokens(value) -> int:
+    return max(1, len(json.dumps(value)) // 4)
+
+class PromptCache:
+    """Prefix hashes seen so far, and what the mock did with them."""
+
+    MAX_BREAKPOINTS = 4
+
+    def __init__(self):
+        self.prefixes = set()
+        self.stats = {"requests": 0, "breakpoints": 0, "rejected": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    def _prefix_hashes(self, items: list) -> list:
+        digest = hashlib.sha256()
+        hashes = []
+        for item in items:
+            digest.update(json.dumps(item, sort_keys=True).encode())
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+
+    def anthropic(self, body: dict):
+        """Returns the usage for an Anthropic request, or an error message for invalid breakpoints."""
+        blocks = []
+        for msg in body.get("messages", []):
+            content = msg["content"]
+            blocks.extend([{"type": "text", "text": content}] if isinstance(content, str) else content)
+        marked = [i for i, block in enumerate(blocks) if "cache_control" in block]
+        if len(marked) > self.MAX_BREAKPOINTS or any(blocks[i]["cache_control"].get("type") != "ephemeral" for i in marked):
+            self.stats["rejected"] += 1
+            return None, f"expected at most {self.MAX_BREAKPOINTS} ephemeral cache_control blocks"
+
+        # Tokens are counted without the markers, so marked and unmarked prefixes compare equal.
+        plain = [{k: v for k, v in block.items() if k != "cache_control"} for block in blocks]
+        hashes = self._prefix_hashes(plain)
+        total = _prompt_tokens(plain)
+        read = written = 0
+        for i in marked:
+            tokens = _prompt_tokens(plain[:i + 1])
+            if hashes[i] in self.prefixes:
+                read = tokens
+            else:
+                written = tokens
+                self.prefixes.add(hashes[i])
+        written = max(0, written - read)
+        self.stats["requests"] += 1
+        self.stats["breakpoints"] += len(marked)
+        self.stats["prompt_tokens"] += total
+        self.stats["cached_tokens"] += read
+        return {
+            "input_tokens": max(1, total - read - written),
+            "cache_read_input_tokens": read,
+            "cache_creation_input_tokens": written,
+            "output_tokens": 1,
+        }, None
+
+    def openai(self, body: dict, min_tokens: int) -> dict:
+        """Returns the usage for an OpenAI request, caching every message prefix automatically."""
+        messages = body.get("messages", [])
+        cached = 0
+        for i, prefix_hash in enumerate(self._prefix_hashes(messages)):
+            tokens = _prompt_tokens(messages[:i + 1])
+            if prefix_hash in self.prefixes and tokens >= min_tokens:
+                # OpenAI reports cache hits in 128-token increments.
+                cached = tokens - tokens % 128
+            self.prefixes.add(prefix_hash)
+        total = _prompt_tokens(messages)
+        self.stats["requests"] += 1
+        self.stats["prompt_tokens"] += total
+        self.stats["cached_tokens"] += cached
+        return {"prompt_tokens": total, "prompt_tokens_details": {"cached_tokens": cached}}
+
+async def _sse(request: web.Request) -> web.StreamResponse:
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    return response
+
+async def _send(response: web.StreamResponse, data: dict, event: str = None):
+    frame = f"event: {event}\n" if event else ""
+    frame += f"data: {json.dumps(data)}\n\n"
+    await response.write(frame.encode())
+
+async def openai_chat(request: web.Request):
+    config = request.app["config"]
+    error = _injected_error(config)
+    if error:
+        return error
+    body = await request.json()
+    model = body.get("model", "mock")
+    created = int(time.time())
+    usage = request.app["openai_cache"].openai(body, config.min_cache_tokens)
+
+    def chunk(delta: dict, finish_reason=None):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    usage.update(completion_tokens=config.tokens, total_tokens=usage["prompt_tokens"] + config.tokens)
+
+    response = await _sse(request)
+    await _send(response, chunk({"role": "assistant", "content": ""}))
+    async for token in _tokens(config):
+        await _send(response, chunk({"content": token}))
+    last = chunk({}, "stop")
+    if model.startswith(_USAGE_ON_LAST_CHUNK):
+        last["usage"] = {k: v for k, v in usage.items() if k != "prompt_tokens_details"}
+    await _send(response, last)
+    if (body.get("stream_options") or {}).get("include_usage"):
+        await _send(response, {
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [], "usage": usage,
+        })
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+async def anthropic_messages(request: web.Request):
+    config = request.app["config"]
+    error = _injected_error(config)
+    if error:
+        return error
+    body = await request.json()
+    usage, invalid = request.app["anthropic_cache"].anthropic(body)
+    if invalid:
+        return web.json_response(
+            {"type": "error", "error": {"type": "invalid_request_error", "message": invalid}}, status=400
+        )
+
+    response = await _sse(request)
+    await _send(response, {
+        "type": "message_start",
+        "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "content": [],
+            "model": body.get("model", "mock"), "stop_reason": None, "stop_sequence": None,
+            "usage": usage,
+        },
+    }, "message_start")
+    await _send(response, {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+    async for token in _tokens(config):
+        await _send(response, {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}}, "content_block_delta")
+    await _send(response, {"type": "content_block_stop", "index": 0}, "content_block_stop")
+    await _send(response, {
+        "type": "message_delta",
+        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+        "usage": {"output_tokens": config.tokens},
+    }, "message_delta")
+    await _send(response, {"type": "message_stop"}, "message_stop")
+    return response
+
+async def gemini_stream(request: web.Request):
+    config = request.app["config"]
+    error = _injected_error(config)
+    if error:
+        return error
+    body = await request.json()
+    prompt_tokens = _prompt_tokens(body.get("contents", []))
+
+    response = await _sse(request)
+    completion_tokens = 0
+    async for token in _tokens(config):
+        completion_tokens += 1
+        await _send(response, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": token}]}, "index": 0}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": completion_tokens,
+                "totalTokenCount": prompt_tokens + completion_tokens,
+            },
+        })
+    return response
+
+async def stats(request: web.Request):
+    return web.json_response({
+        "anthropic": request.app["anthropic_cache"].stats,
+        "openai": request.app["openai_cache"].stats,
+    })
+
+def create_app(config: MockConfig = None) -> web.Application:
+    app = web.Application()
+    app["config"] = config or MockConfig()
+    app["anthropic_cache"] = PromptCache()
+    app["openai_cache"] = PromptCache()
+    app.router.add_get("/mock/stats", stats)
+    app.router.add_post("/v1/chat/completions", openai_chat)
+    app.router.add_post("/chat/completions", openai_chat)
+    app.router.add_post("/v1/messages", anthropic_messages)
+    app.router.add_post("/v1beta/models/{model}:streamGenerateContent", gemini_stream)
+    return app
+
+def base_urls(root: str) -> dict:
+    """Environment variables pointing every provider client at the mock."""
+    return {
+        "OPENAI_BASE_URL": f"{root}/v1",
+        "UPSTAGE_BASE_URL": f"{root}/v1",
+        "ANTHROPIC_BASE_URL": root,
+        "GOOGLE_BASE_URL": f"{root}/",
+        "MISTRAL_BASE_URL": root,
+        "HUGGINGFACE_BASE_URL": root,
+    }
+
+async def start(config: MockConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Starts the mock on the running loop. Returns (runner, root_url)."""
+    runner = web.AppRunner(create_app(config))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock LLM providers.")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    config = MockConfig(args.ttft_ms, args.tokens_per_second, args.tokens, args.error_rate)
+    web.run_app(create_app(config), host="127.0.0.1", port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark for page-parallel PDF extraction.
+
+Generates a large synthetic text PDF and compares single-process
+extraction against `iter_pdf_pages` with a growing number of workers,
+both for the whole document and for the first page to come back.
+Run from `server/`:
+
+    python -m benchmarks.pdf_extraction --pages 400
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from stream.extraction import extract_pdf_text_sync, iter_pdf_pages
+
+LINES_PER_PAGE = 40
+
+def make_synthetic_pdf(path: str, pages: int):
+    """Writes a minimal, valid PDF with `pages` pages of Helvetica text."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(pages):
+        lines = [
+            f"(Page {page + 1} line {line + 1}: the quick brown fox jumps over the lazy dog) Tj T*"
+            for line in range(LINES_PER_PAGE)
+        ]
+        stream = ("BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(lines) + " ET").encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), pages
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+async def time_parallel(path: str, workers: int) -> tuple:
+    """Returns (seconds to the first page, seconds to the whole document)."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Warm the pool so process start-up is not part of the measurement.
+        list(executor.map(abs, range(workers)))
+        started = time.perf_counter()
+        first_page = None
+        async for _ in iter_pdf_pages(path, executor):
+            if first_page is None:
+                first_page = time.perf_counter() - started
+        return first_page, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.pdf")
+        make_synthetic_pdf(path, args.pages)
+
+        started = time.perf_counter()
+        extract_pdf_text_sync(path)
+        baseline = time.perf_counter() - started
+
+        results = {"pages": args.pages, "sequential_seconds": baseline, "parallel": []}
+        workers = 1
+        while workers <= args.max_workers:
+            first_page, elapsed = asyncio.run(time_parallel(path, workers))
+            results["parallel"].append({
+                "workers": workers, "seconds": elapsed, "first_page_seconds": first_page, "speedup": baseline / elapsed,
+            })
+            workers *= 2
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
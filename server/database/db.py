@@ -1,11 +1,85 @@
-from sqlalchemy import create_engine
+import os
+import fcntl
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-# Create an engine for SQLite database file.
-engine = create_engine('sqlite:///database.db', echo=True, connect_args={"check_same_thread": False})
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Absolute, so every worker opens the same file whatever its working directory.
+DATABASE_URL = os.environ.get("CONVO_DATABASE_URL", f"sqlite:///{os.path.join(SERVER_DIR, 'database.db')}")
+_url = make_url(DATABASE_URL)
+# The schema setup, the search index and the usage rollups rely on SQLite.
+if _url.get_backend_name() != "sqlite":
+    raise RuntimeError(f"CONVO_DATABASE_URL must be a SQLite URL, got {_url.get_backend_name()!r}")
+# The blob store and the caches live next to the database file.
+DATA_DIR = os.path.dirname(os.path.abspath(_url.database)) if _url.database else SERVER_DIR
+# Connections kept open per worker process, and extra ones allowed under load.
+DB_POOL_SIZE = int(os.environ.get("CONVO_DB_POOL_SIZE", 8))
+DB_MAX_OVERFLOW = int(os.environ.get("CONVO_DB_MAX_OVERFLOW", 16))
+# How long a connection waits for another writer (thread or worker) before failing.
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("CONVO_SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# Create an engine for SQLite database file. Set CONVO_SQL_ECHO=1 to log
+# statements (see logs.py).
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+)
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    """
+    WAL lets readers run while one connection writes, and lets writers in
+    other workers queue on the busy timeout instead of failing with
+    "database is locked". With WAL, `synchronous=NORMAL` is still safe
+    against corruption and skips an fsync per commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+@contextmanager
+def schema_lock():
+    """
+    Serializes schema setup across the worker processes that start
+    together, which would otherwise race to create the same tables.
+    """
+    with open(f"{engine.url.database}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Base class for our ORM models.
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+def add_missing_columns(bind=engine):
+    """
+    Adds columns declared on the models but missing from an existing
+    database file. create_all() only creates missing tables, so databases
+    created by older versions would otherwise lack new columns.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, DateTime, Text, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database.db import Base
 
@@ -26,15 +26,19 @@ class Session(Base):
     enableSummarization = Column(Boolean, default=False)
     
     createdAt = Column(DateTime, default=datetime.datetime.utcnow)
-    updatedAt = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    updatedAt = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
     
     # Relationship to messages
     messages = relationship("Message", back_populates="session", cascade="all, delete-orphan")
 
 class Message(Base):
     __tablename__ = 'messages'
+    # A unique index rather than a constraint, so add_missing_columns can add it to older databases
+    __table_args__ = (Index('ix_messages_session_turn', 'sessionId', 'turnId', unique=True),)
     id = Column(Integer, primary_key=True, index=True)
-    sessionId = Column(Integer, ForeignKey('sessions.id'), nullable=False)
+    sessionId = Column(Integer, ForeignKey('sessions.id'), nullable=False, index=True)
+    # Stable per-turn identifier so a turn can be appended or updated in place
+    turnId = Column(String, index=True)
     userText = Column(Text, default="")  # Content from user
     aiResponse = Column(Text, default="")  # Response from AI
     attachments = Column(Text, default="[]")  # JSON string of attachments
@@ -43,5 +47,73 @@ class Message(Base):
     temperature = Column(Float, default=0.7)
     maxTokens = Column(Integer, default=1024)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    # The response was cut short (the user stopped the stream)
+    truncated = Column(Boolean, default=False)
+    # What the response cost and how fast it came; empty on older rows
+    promptTokens = Column(Integer)
+    completionTokens = Column(Integer)
+    cachedTokens = Column(Integer)
+    # The token counts are local estimates (the provider reported none)
+    tokensEstimated = Column(Boolean, default=False)
+    ttftSeconds = Column(Float)
+    durationSeconds = Column(Float)
+    chunkCount = Column(Integer)
 
     session = relationship("Session", back_populates="messages")
+
+class Attachment(Base):
+    __tablename__ = 'attachments'
+    id = Column(Integer, primary_key=True, index=True)
+    # SHA-256 hex digest of the file content; also names the blob on disk
+    blobId = Column(String, unique=True, index=True, nullable=False)
+    name = Column(String, default="")  # Name of the first upload, for display only
+    mimeType = Column(String, default="application/octet-stream")
+    size = Column(Integer, default=0)
+    # Number of stored messages referencing this blob
+    refCount = Column(Integer, default=0)
+    createdAt = Column(DateTime, default=datetime.datetime.utcnow)
+
+class RemoteFile(Base):
+    """A blob uploaded to a provider's file store (e.g. the Gemini Files API)."""
+    __tablename__ = 'remote_files'
+    __table_args__ = (UniqueConstraint('provider', 'blobId'),)
+    id = Column(Integer, primary_key=True, index=True)
+    provider = Column(String, nullable=False)
+    blobId = Column(String, nullable=False, index=True)
+    uri = Column(String, nullable=False)
+    mimeType = Column(String, default="application/octet-stream")
+    uploadedAt = Column(DateTime, default=datetime.datetime.utcnow)
+    # When the provider deletes the file; entries are re-uploaded before this
+    expiresAt = Column(DateTime, index=True)
+
+class UsageTotals:
+    """Running totals of the turns' usage, shared by the rollup tables (see database/usage.py)."""
+    turns = Column(Integer, default=0, nullable=False)
+    promptTokens = Column(Integer, default=0, nullable=False)
+    completionTokens = Column(Integer, default=0, nullable=False)
+    cachedTokens = Column(Integer, default=0, nullable=False)
+    estimatedTurns = Column(Integer, default=0, nullable=False)
+    truncatedTurns = Column(Integer, default=0, nullable=False)
+    # Sums; turns without a first token add nothing to ttftSeconds or ttftTurns
+    ttftSeconds = Column(Float, default=0.0, nullable=False)
+    ttftTurns = Column(Integer, default=0, nullable=False)
+    durationSeconds = Column(Float, default=0.0, nullable=False)
+    chunks = Column(Integer, default=0, nullable=False)
+
+class UsageDaily(UsageTotals, Base):
+    """Usage of every session per day and model."""
+    __tablename__ = 'usage_daily'
+    __table_args__ = (UniqueConstraint('day', 'model'),)
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False, index=True)
+    model = Column(String, nullable=False, index=True)
+
+class UsageSession(UsageTotals, Base):
+    """Usage per session, day and model. Kept when the session is removed."""
+    __tablename__ = 'usage_sessions'
+    __table_args__ = (UniqueConstraint('sessionId', 'day', 'model'),)
+    id = Column(Integer, primary_key=True, index=True)
+    # The public session id (Session.sessionId)
+    sessionId = Column(String, nullable=False, index=True)
+    day = Column(Date, nullable=False, index=True)
+    model = Column(String, nullable=False)
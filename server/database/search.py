@@ -0,0 +1,146 @@
+"""
+Full-text search over messages backed by an SQLite FTS5 index.
+
+`messages_fts` is an external-content FTS5 table over `messages`; triggers
+keep it in sync on every insert, update and delete, so the persistence
+path needs no changes. Existing databases are indexed the first time the
+table is created. To rebuild the index by hand run, from `server/`:
+
+    python -m database.search --rebuild
+"""
+import sys
+import html
+
+from sqlalchemy import text
+
+from database.db import engine, Base
+
+FTS_TABLE = "messages_fts"
+# Match markers for snippet(): private-use characters that survive HTML
+# escaping and become <mark> tags afterwards.
+_OPEN, _CLOSE = "\ue000", "\ue001"
+
+_SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        userText, aiResponse,
+        content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, userText, aiResponse)
+        VALUES (new.id, new.userText, new.aiResponse);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, userText, aiResponse)
+        VALUES ('delete', old.id, old.userText, old.aiResponse);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF userText, aiResponse ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, userText, aiResponse)
+        VALUES ('delete', old.id, old.userText, old.aiResponse);
+        INSERT INTO {FTS_TABLE}(rowid, userText, aiResponse)
+        VALUES (new.id, new.userText, new.aiResponse);
+    END
+    """,
+]
+
+_SEARCH_SQL = f"""
+    SELECT
+        m.id AS id,
+        m.turnId AS turnId,
+        m.timestamp AS timestamp,
+        m.model AS model,
+        s.sessionId AS sessionId,
+        s.title AS title,
+        snippet({FTS_TABLE}, 0, :open, :close, '…', :tokens) AS userSnippet,
+        snippet({FTS_TABLE}, 1, :open, :close, '…', :tokens) AS aiSnippet,
+        bm25({FTS_TABLE}) AS rank
+    FROM {FTS_TABLE}
+    JOIN messages m ON m.id = {FTS_TABLE}.rowid
+    JOIN sessions s ON s.id = m.sessionId
+    WHERE {FTS_TABLE} MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+"""
+
+def create_search_index(bind=engine):
+    """
+    Creates the FTS5 table and its sync triggers. The index is populated
+    from the messages table when it did not exist before.
+    """
+    with bind.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": FTS_TABLE},
+        ).first()
+        for statement in _SCHEMA:
+            conn.execute(text(statement))
+        if not exists:
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+def rebuild_search_index(bind=engine):
+    """Re-indexes every message from scratch."""
+    with bind.begin() as conn:
+        for statement in _SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+def to_match_query(query: str) -> str:
+    """
+    Turns free text into an FTS5 query that matches every term. Terms are
+    quoted so user input cannot inject FTS5 operators; a trailing `*` is
+    kept for prefix search.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+def highlight(snippet: str) -> str:
+    """Escapes a snippet for HTML and wraps its matches in <mark> tags."""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+def search_messages(query: str, limit: int = 20, offset: int = 0, bind=engine) -> list:
+    """
+    Ranked matches for `query`. The snippets are HTML: message text is
+    escaped and only the <mark> tags around matches are markup.
+    """
+    match = to_match_query(query)
+    if not match:
+        return []
+    with bind.connect() as conn:
+        rows = conn.execute(text(_SEARCH_SQL), {
+            "query": match,
+            "open": _OPEN,
+            "close": _CLOSE,
+            "tokens": 16,
+            "limit": limit,
+            "offset": offset,
+        }).mappings().all()
+    results = []
+    for row in rows:
+        result = dict(row)
+        result["userSnippet"] = highlight(result["userSnippet"])
+        result["aiSnippet"] = highlight(result["aiSnippet"])
+        results.append(result)
+    return results
+
+if __name__ == "__main__":
+    if "--rebuild" in sys.argv:
+        import database.models  # noqa: F401  (registers the tables)
+        Base.metadata.create_all(bind=engine)
+        rebuild_search_index()
+        print("Search index rebuilt.")
+    else:
+        print("usage: python -m database.search --rebuild")
@@ -0,0 +1,101 @@
+"""
+Token usage and latency rollups.
+
+Every stored turn records what it cost (prompt, completion and cached
+tokens) and how fast it came (time to first token, duration, chunks) on
+its `messages` row. The same numbers are added to two rollup tables as
+the turn is written, so reports never scan the messages:
+
+- `usage_daily`: one row per day and model, across sessions.
+- `usage_sessions`: one row per session, day and model.
+
+A turn is added once per generation. Rewriting or editing stored turns
+does not add it again, and removing a session keeps its totals.
+"""
+import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from database.db import SessionLocal
+from database.models import UsageDaily, UsageSession
+
+DIMENSIONS = ("day", "model", "session")
+_TOTALS = (
+    "turns", "promptTokens", "completionTokens", "cachedTokens", "estimatedTurns",
+    "truncatedTurns", "ttftSeconds", "ttftTurns", "durationSeconds", "chunks",
+)
+
+def _increments(usage: dict, truncated: bool) -> dict:
+    return {
+        "turns": 1,
+        "promptTokens": usage.get("prompt_tokens") or 0,
+        "completionTokens": usage.get("completion_tokens") or 0,
+        "cachedTokens": usage.get("cached_tokens") or 0,
+        "estimatedTurns": 1 if usage.get("estimated") else 0,
+        "truncatedTurns": 1 if truncated else 0,
+        "ttftSeconds": usage.get("ttft_seconds") or 0.0,
+        "ttftTurns": 0 if usage.get("ttft_seconds") is None else 1,
+        "durationSeconds": usage.get("duration_seconds") or 0.0,
+        "chunks": usage.get("chunks") or 0,
+    }
+
+def _upsert(db, table, keys: dict, increments: dict):
+    statement = insert(table).values(**keys, **increments)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: getattr(table, name) + statement.excluded[name] for name in increments},
+    ))
+
+def add_turn_usage(db, session_id: str, day: datetime.date, model: str, usage: dict, truncated: bool = False):
+    """Adds one generated turn to the rollups, in `db`'s transaction."""
+    increments = _increments(usage, truncated)
+    _upsert(db, UsageDaily, {"day": day, "model": model}, increments)
+    _upsert(db, UsageSession, {"sessionId": session_id, "day": day, "model": model}, increments)
+
+def usage_report(group_by: list, since: datetime.date = None, until: datetime.date = None,
+                 model: str = None, session_id: str = None) -> list:
+    """
+    Sums the rollups by `group_by` (any of DIMENSIONS) between `since`
+    and `until` (inclusive). The per-session table is read only when the
+    report needs sessions.
+    """
+    table = UsageSession if "session" in group_by or session_id else UsageDaily
+    columns = {"day": table.day, "model": table.model}
+    if table is UsageSession:
+        columns["session"] = UsageSession.sessionId
+    keys = [columns[name].label(name) for name in group_by]
+
+    db = SessionLocal()
+    try:
+        query = db.query(*keys, *[func.sum(getattr(table, name)).label(name) for name in _TOTALS])
+        if since:
+            query = query.filter(table.day >= since)
+        if until:
+            query = query.filter(table.day <= until)
+        if model:
+            query = query.filter(table.model == model)
+        if session_id:
+            query = query.filter(UsageSession.sessionId == session_id)
+        rows = query.group_by(*keys).order_by(*keys).all()
+    finally:
+        db.close()
+
+    report = []
+    for row in rows:
+        values = row._asdict()
+        entry = {name: values[name].isoformat() if name == "day" else values[name] for name in group_by}
+        turns = values["turns"] or 0
+        entry.update({
+            "turns": turns,
+            "prompt_tokens": values["promptTokens"] or 0,
+            "completion_tokens": values["completionTokens"] or 0,
+            "cached_tokens": values["cachedTokens"] or 0,
+            "estimated_turns": values["estimatedTurns"] or 0,
+            "truncated_turns": values["truncatedTurns"] or 0,
+            "chunks": values["chunks"] or 0,
+            "avg_ttft_seconds": round(values["ttftSeconds"] / values["ttftTurns"], 4) if values["ttftTurns"] else None,
+            "avg_duration_seconds": round(values["durationSeconds"] / turns, 4) if turns else None,
+        })
+        report.append(entry)
+    return report
@@ -0,0 +1,194 @@
+"""
+Structured, queued logging for the server.
+
+Log calls only enqueue the record. A listener thread formats it and writes
+it to stderr, so a slow terminal or log pipe never blocks a request. When
+the queue is full, records are dropped and counted instead of blocking.
+
+Request payloads are logged with `log_payload`. It does nothing unless
+DEBUG is enabled and the route's sample fires. The payload is then passed
+through `redact`, which caps the size of every field. The cost of a
+payload log is therefore bounded however large the conversation or its
+attachments are.
+
+Environment:
+
+- CONVO_LOG_LEVEL: DEBUG, INFO (default), WARNING, ...
+- CONVO_LOG_FORMAT: `text` (default) or `json`, one record per line
+- CONVO_LOG_SAMPLE: per-route payload sample rates, e.g.
+  `chat_stream=0.01,openai_summary=0.1,*=1`
+- CONVO_LOG_MAX_FIELD: characters kept of a string field (default 200)
+- CONVO_SQL_ECHO: set to 1 to log SQL statements
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import threading
+import logging.handlers
+
+import metrics
+
+LOG_LEVEL = os.environ.get("CONVO_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("CONVO_LOG_FORMAT", "text")
+MAX_FIELD_CHARS = int(os.environ.get("CONVO_LOG_MAX_FIELD", "200"))
+SQL_ECHO = os.environ.get("CONVO_SQL_ECHO", "") not in ("", "0")
+QUEUE_SIZE = 10000
+
+# Lists longer than this keep only their last items (the latest turns).
+MAX_ITEMS = 10
+MAX_DEPTH = 5
+# Inline file data; never logged, only its size.
+BINARY_FIELDS = {"content", "data"}
+
+def _parse_sample_rates(spec: str) -> dict:
+    rates = {}
+    for part in spec.split(","):
+        route, _, rate = part.partition("=")
+        if route.strip() and rate.strip():
+            rates[route.strip()] = float(rate)
+    return rates
+
+SAMPLE_RATES = _parse_sample_rates(os.environ.get("CONVO_LOG_SAMPLE", ""))
+
+def fields(**values) -> dict:
+    """`extra=` argument attaching structured fields to a log record."""
+    return {"fields": values}
+
+def _truncate(value: str, limit: int) -> str:
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}...<+{len(value) - limit} chars>"
+
+def redact(value, limit: int = None, _depth: int = 0, _binary: bool = False):
+    """
+    Returns a copy of `value` that is cheap to log. Strings are cut to
+    `limit` characters. Lists keep their last MAX_ITEMS entries. Attachment
+    data is replaced by its length. Nesting stops at MAX_DEPTH.
+    """
+    limit = MAX_FIELD_CHARS if limit is None else limit
+    if isinstance(value, str):
+        if _binary:
+            return f"<{len(value)} chars redacted>"
+        return _truncate(value, limit)
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes redacted>"
+    if _depth >= MAX_DEPTH:
+        return "<...>"
+    if isinstance(value, dict):
+        # Only attachment dicts carry file data under `content`; message
+        # content is text and is truncated like any other string.
+        is_attachment = "name" in value and ("type" in value or "file_path" in value or "blobId" in value)
+        return {
+            key: redact(item, limit, _depth + 1, is_attachment and key in BINARY_FIELDS)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        items = [redact(item, limit, _depth + 1) for item in value[-MAX_ITEMS:]]
+        if len(value) > MAX_ITEMS:
+            items.insert(0, f"<{len(value) - MAX_ITEMS} earlier items omitted>")
+        return items
+    return value
+
+def sampled(route: str) -> bool:
+    rate = SAMPLE_RATES.get(route, SAMPLE_RATES.get("*", 1.0))
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+def log_payload(logger: logging.Logger, route: str, payload, message: str = "Request payload"):
+    """Logs a redacted request payload at DEBUG, subject to the route's sample rate."""
+    if logger.isEnabledFor(logging.DEBUG) and sampled(route):
+        logger.debug(message, extra=fields(route=route, payload=redact(payload)))
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as `key=value` text or a JSON object per line."""
+
+    def __init__(self, style: str = "text"):
+        super().__init__()
+        self.style = style
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+
+        if self.style == "json":
+            return json.dumps(entry, default=str)
+        extra = " ".join(
+            f"{key}={json.dumps(value, default=str)}"
+            for key, value in entry.items() if key not in ("ts", "level", "logger", "msg", "exc")
+        )
+        line = f"{entry['ts']} {entry['level']:<7} {entry['logger']}: {entry['msg']}"
+        if extra:
+            line += " " + extra
+        if "exc" in entry:
+            line += "\n" + entry["exc"]
+        return line
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records without formatting them. Formatting happens on the
+    listener thread. Records are dropped when the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve %-args now since they may be mutated after the call; the
+        # rest of the formatting is left to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+metrics.Gauge("convo_log_records_dropped", "Log records dropped because the log queue was full.",
+              function=lambda: DroppingQueueHandler.dropped)
+
+_listener = None
+_setup_lock = threading.Lock()
+
+def setup_logging():
+    """Installs the queued handler on the `convo` loggers. Safe to call more than once."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(StructuredFormatter(LOG_FORMAT))
+        handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+
+        root = logging.getLogger("convo")
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(handler)
+        root.propagate = False
+        if SQL_ECHO:
+            sql_logger = logging.getLogger("sqlalchemy.engine")
+            sql_logger.setLevel(logging.INFO)
+            sql_logger.addHandler(handler)
+
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+def get_logger(name: str) -> logging.Logger:
+    setup_logging()
+    return logging.getLogger(f"convo.{name}")
@@ -1,14 +1,20 @@
 
 import os
+import json
+import base64
+import asyncio
 import datetime
 
-from fastapi import FastAPI, Depends, Request, HTTPException
+from fastapi import FastAPI, Depends, Request, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import Session, selectinload
 
 from stream import (
+    pipeline as chat_stream,
     openai as openai_stream, 
     anthropic as anthropic_stream, 
     google as google_stream,
@@ -23,10 +29,32 @@ from summary import (
     # huggingface as huggingface_summary, mistral as mistral_summary
 )
 
-from database.db import engine, Base, SessionLocal
+import metrics
+from logs import get_logger, fields
+from stream.writer import conversation_writer
+from stream.utils import remove_duplicate_turns, forget_session
+from stream.extraction import shutdown_extraction
+from stream.watchdog import LoopWatchdog
+from stream.cache import completion_cache
+from stream.uploads import prune_remote_files
+from stream.prompt_cache import session_cache_stats
+from stream.resumable import cancel_generations
+from state import shared_state
+from summary.jobs import summary_queue, wait_for_summary
+from stream.blobs import store_blob_file, blob_ids_of, adjust_refcounts, collect_unreferenced_blobs
+
+from database.db import SERVER_DIR, engine, Base, SessionLocal, add_missing_columns, schema_lock
 from database.models import Session as ChatSession, Message
+from database.search import create_search_index, search_messages
+from database.usage import DIMENSIONS, usage_report
+
+with schema_lock():
+    Base.metadata.create_all(bind=engine)
+    remove_duplicate_turns(engine)
+    add_missing_columns(engine)
+    create_search_index(engine)
 
-Base.metadata.create_all(bind=engine)
+logger = get_logger(__name__)
 
 def get_db():
     db = SessionLocal()
@@ -52,8 +80,30 @@ def get_default_session():
     )    
     return new_session
 
-def session_to_dict(session: ChatSession):
+def message_to_dict(msg: Message):
     return {
+        "id": msg.id,
+        "turnId": msg.turnId,
+        "userText": msg.userText,
+        "aiResponse": msg.aiResponse,
+        "attachments": msg.attachments,
+        "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
+        "model": msg.model,
+        "persona": msg.persona,
+        "temperature": msg.temperature,
+        "maxTokens": msg.maxTokens,
+        "truncated": bool(msg.truncated),
+        "promptTokens": msg.promptTokens,
+        "completionTokens": msg.completionTokens,
+        "cachedTokens": msg.cachedTokens,
+        "tokensEstimated": bool(msg.tokensEstimated),
+        "ttftSeconds": msg.ttftSeconds,
+        "durationSeconds": msg.durationSeconds,
+        "chunkCount": msg.chunkCount,
+    }
+
+def session_to_dict(session: ChatSession, include_messages: bool = True):
+    data = {
         "id": session.id,
         "sessionId": session.sessionId,
         "name": session.name,
@@ -69,23 +119,29 @@ def session_to_dict(session: ChatSession):
         "updatedAt": session.updatedAt.isoformat() if session.updatedAt else None,
         "modelPreset1": session.modelPreset1,
         "modelPreset2": session.modelPreset2,
-        "messages": [
-            {
-                "id": msg.id,
-                "userText": msg.userText,
-                "aiResponse": msg.aiResponse,
-                "attachments": msg.attachments,
-                "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
-                "model": msg.model,
-                "persona": msg.persona,
-                "temperature": msg.temperature,
-                "maxTokens": msg.maxTokens,
-            }
-            for msg in session.messages
-        ],
     }
+    if include_messages:
+        data["messages"] = [message_to_dict(msg) for msg in session.messages]
+    return data
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, *types) -> list:
+    """
+    Decodes a cursor made by `encode_cursor`, converting each value with
+    the matching entry of `types`. A malformed cursor is a 400.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(f"Expected {len(types)} cursor values")
+        return [convert(value) for convert, value in zip(types, values)]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
 
 app = FastAPI()
+app.include_router(chat_stream.router)
 app.include_router(openai_stream.router)
 app.include_router(anthropic_stream.router)
 app.include_router(google_stream.router)
@@ -102,13 +158,87 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the front end resume an interrupted stream.
+    expose_headers=["X-Convo-Stream-ID", "X-Convo-Context"],
 )
 
-app.mount("/static", StaticFiles(directory="../front", html=True), name="static")
+@app.on_event("startup")
+def start_conversation_writer():
+    conversation_writer.start()
+    removed = collect_unreferenced_blobs()
+    if removed:
+        logger.info("Removed unreferenced attachment blobs", extra=fields(count=removed))
+
+@app.on_event("startup")
+def prune_completion_cache():
+    removed = completion_cache.prune()
+    if removed:
+        logger.info("Removed expired completion cache entries", extra=fields(count=removed))
+
+@app.on_event("startup")
+def prune_provider_uploads():
+    removed = prune_remote_files()
+    if removed:
+        logger.info("Removed expired provider file uploads", extra=fields(count=removed))
+
+# Expired shared-state entries are dropped on read; this clears the ones nobody reads again.
+SHARED_STATE_PRUNE_SECONDS = 600
+shared_state_pruner = None
+
+@app.on_event("startup")
+async def start_shared_state_pruner():
+    global shared_state_pruner
+
+    async def prune():
+        while True:
+            removed = await shared_state.run(shared_state.prune)
+            if removed:
+                logger.debug("Removed expired shared state", extra=fields(count=removed))
+            await asyncio.sleep(SHARED_STATE_PRUNE_SECONDS)
+
+    shared_state_pruner = asyncio.ensure_future(prune())
+
+@app.on_event("shutdown")
+def stop_shared_state_pruner():
+    if shared_state_pruner is not None:
+        shared_state_pruner.cancel()
+
+# Debug aid: report any coroutine holding the event loop longer than
+# CONVO_LOOP_WATCHDOG_MS milliseconds.
+loop_watchdog = None
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    global loop_watchdog
+    threshold_ms = os.environ.get("CONVO_LOOP_WATCHDOG_MS")
+    if threshold_ms:
+        loop_watchdog = LoopWatchdog(threshold=float(threshold_ms) / 1000)
+        loop_watchdog.start()
+
+@app.on_event("shutdown")
+def stop_loop_watchdog():
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+
+@app.on_event("shutdown")
+async def stop_generations():
+    await cancel_generations()
+
+@app.on_event("shutdown")
+def stop_summary_jobs():
+    summary_queue.stop()
+
+@app.on_event("shutdown")
+def flush_conversation_writer():
+    # Make sure every queued conversation reaches the database before exit.
+    conversation_writer.flush()
+    shutdown_extraction()
+
+app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(SERVER_DIR), "front"), html=True), name="static")
 
 @app.get("/sessions")
 def get_sessions(db: Session = Depends(get_db)):
-    sessions_data = db.query(ChatSession).all()
+    sessions_data = db.query(ChatSession).options(selectinload(ChatSession.messages)).all()
     # If no sessions exist, create a default one.
     if not sessions_data:
         new_session = get_default_session()
@@ -119,6 +249,127 @@ def get_sessions(db: Session = Depends(get_db)):
         sessions_data = [new_session]
     return {"sessions": [session_to_dict(s) for s in sessions_data]}
 
+@app.get("/sessions/page")
+def get_sessions_page(cursor: str = None, limit: int = 50, db: Session = Depends(get_db)):
+    """
+    Returns session metadata (no messages), most recently updated first.
+    Pass the returned `next_cursor` back to fetch the following page.
+    """
+    limit = max(1, min(limit, 200))
+    query = db.query(ChatSession)
+    if cursor:
+        updated_at, last_id = decode_cursor(cursor, datetime.datetime.fromisoformat, int)
+        query = query.filter(or_(
+            ChatSession.updatedAt < updated_at,
+            and_(ChatSession.updatedAt == updated_at, ChatSession.id < last_id),
+        ))
+    elif db.query(ChatSession.id).first() is None:
+        # If no sessions exist, create a default one.
+        db.add(get_default_session())
+        db.commit()
+
+    sessions_data = query.order_by(ChatSession.updatedAt.desc(), ChatSession.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(sessions_data) > limit:
+        sessions_data = sessions_data[:limit]
+        last = sessions_data[-1]
+        next_cursor = encode_cursor(last.updatedAt.isoformat(), last.id)
+
+    return {
+        "sessions": [session_to_dict(s, include_messages=False) for s in sessions_data],
+        "next_cursor": next_cursor,
+    }
+
+@app.get("/sessions/{session_id}/messages")
+def get_session_messages(session_id: str, cursor: str = None, limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Returns the messages of one session in conversation order, one page at
+    a time.
+    """
+    limit = max(1, min(limit, 500))
+    session = db.query(ChatSession.id).filter(ChatSession.sessionId == session_id).first()
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    query = db.query(Message).filter(Message.sessionId == session.id)
+    if cursor:
+        (last_id,) = decode_cursor(cursor, int)
+        query = query.filter(Message.id > last_id)
+
+    messages = query.order_by(Message.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor(messages[-1].id)
+
+    return {
+        "messages": [message_to_dict(msg) for msg in messages],
+        "next_cursor": next_cursor,
+    }
+
+@app.get("/sessions/{session_id}/summary")
+async def get_session_summary(session_id: str, wait: float = 0):
+    """
+    Returns the session's summary. With `wait`, holds the request up to
+    that many seconds until the background summary job queued by the
+    last turn has finished.
+    """
+    return await wait_for_summary(session_id, max(0.0, min(wait, 60.0)))
+
+@app.get("/sessions/{session_id}/prompt_cache")
+async def get_session_prompt_cache(session_id: str):
+    """Returns how much of the session's prompts the providers served from their prefix caches."""
+    return await session_cache_stats(session_id)
+
+@app.post("/attachments")
+async def upload_attachment(file: UploadFile = File(...)):
+    """
+    Stores an uploaded file in the content-addressed blob store and returns
+    its blob id. Messages reference attachments by this id instead of
+    carrying the file as base64.
+    """
+    try:
+        return await asyncio.to_thread(store_blob_file, file.file, file.filename, file.content_type)
+    finally:
+        await file.close()
+
+@app.get("/search")
+def search(q: str, limit: int = 20, offset: int = 0):
+    """
+    Ranked full-text search across every session's messages. Snippets are
+    HTML-escaped, with matches wrapped in <mark> tags.
+    """
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+    results = search_messages(q, limit=limit + 1, offset=offset)
+    next_offset = offset + limit if len(results) > limit else None
+    for result in results:
+        if result["timestamp"]:
+            result["timestamp"] = datetime.datetime.fromisoformat(str(result["timestamp"])).isoformat()
+    return {"results": results[:limit], "next_offset": next_offset}
+
+@app.get("/usage")
+def usage(group_by: str = "model", since: datetime.date = None, until: datetime.date = None,
+          model: str = None, session_id: str = None):
+    """
+    Token usage and latency totals from the rollup tables, grouped by a
+    comma-separated list of `day`, `model` and `session`. `since` and
+    `until` are inclusive dates (YYYY-MM-DD).
+    """
+    dimensions = [name.strip() for name in group_by.split(",") if name.strip()]
+    unknown = [name for name in dimensions if name not in DIMENSIONS]
+    if unknown or len(set(dimensions)) != len(dimensions):
+        raise HTTPException(status_code=400, detail=f"group_by takes distinct values of: {', '.join(DIMENSIONS)}")
+    return {"group_by": dimensions, "usage": usage_report(dimensions, since, until, model, session_id)}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/storage_metrics")
+def storage_metrics():
+    return conversation_writer.metrics()
+
 @app.post("/add_session")
 def add_session(db: Session = Depends(get_db)):
     new_session = get_default_session()
@@ -137,33 +388,28 @@ async def update_model_preset(request: Request, db: Session = Depends(get_db)):
     selectedModelPreset = body.get("selected_preset_idx")
     if selectedModelPreset == 1:
         session.model = session.modelPreset1
-        print("modelPreset1", session.modelPreset1)
     elif selectedModelPreset == 2:
         session.model = session.modelPreset2
-        print("modelPreset2", session.modelPreset2)
     db.commit()
     db.refresh(session)
     return session_to_dict(session)
 
-@app.post("/remove_session")
+@app.post("/remove_session", status_code=204)
 def remove_session(request: Request, db: Session = Depends(get_db)):
+    """
+    Deletes the session and its messages. Clients reload the session list
+    from `/sessions/page`, which recreates a default session when none remain.
+    """
     session_id = request.headers.get("X-Session-ID")
     session = db.query(ChatSession).filter(ChatSession.sessionId == session_id).first()
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    for (attachments,) in db.query(Message.attachments).filter(Message.sessionId == session.id):
+        adjust_refcounts(db, blob_ids_of(json.loads(attachments or "[]")), -1)
     db.delete(session)
     db.commit()
-
-    remaining_sessions = db.query(ChatSession).count()
-    if remaining_sessions == 0:
-        new_session = get_default_session()
-        
-        db.add(new_session)
-        db.commit()
-        db.refresh(new_session)
-        sessions_data = [new_session]
-    else:
-        sessions_data = db.query(ChatSession).all()
-
-    return {"sessions": [session_to_dict(s) for s in sessions_data]}
+    forget_session(session_id)
+    return Response(status_code=204)
 
 @app.post("/update_summarization_enable")
 async def update_summarization_enable(request: Request, db: Session = Depends(get_db)):
@@ -240,7 +486,7 @@ async def update_session_settings(request: Request, db: Session = Depends(get_db
     session_id = request.headers.get("X-Session-ID")
     body = await request.json()
     session_settings = body.get("session_settings")
-    print("session_settings", session_settings)
+    logger.debug("Updating session settings", extra=fields(session=session_id, settings=session_settings))
     session = db.query(ChatSession).filter(ChatSession.sessionId == session_id).first()
     session.modelPreset1 = session_settings.get("modelPreset1")
     session.modelPreset2 = session_settings.get("modelPreset2")
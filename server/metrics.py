@@ -0,0 +1,170 @@
+"""
+Minimal Prometheus-style metrics registry.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text exposition format by `render()` (served at `/metrics`). Recording a
+sample is a dict lookup and a few additions under a lock, so it is cheap
+enough for hot paths; per-chunk work in the stream pipeline is still
+aggregated locally and recorded once per stream.
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Seconds; covers sub-millisecond DB commits up to multi-minute streams.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_registry = []
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = self._header()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}_total{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        super().__init__(name, documentation, labels)
+        # Unlabelled gauges may be computed at scrape time instead.
+        self._function = function
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self) -> list:
+        lines = self._header()
+        if self._function is not None:
+            lines.append(f"{self.name} {_format_value(self._function())}")
+            return lines
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = self._header()
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Streaming
+STREAM_LABELS = ("provider", "model")
+streams_in_flight = Gauge("convo_streams_in_flight", "Streams currently being served.", ("provider",))
+stream_ttft = Histogram("convo_stream_ttft_seconds", "Time from request to first streamed token.", STREAM_LABELS)
+stream_duration = Histogram("convo_stream_duration_seconds", "Total duration of a stream.", STREAM_LABELS)
+stream_chunks = Histogram("convo_stream_chunks", "Upstream chunks per stream.", STREAM_LABELS, COUNT_BUCKETS)
+stream_bytes = Counter("convo_stream_bytes", "Bytes of response text streamed to clients.", STREAM_LABELS)
+stream_upstream_errors = Counter("convo_stream_upstream_errors", "Streams that failed with a provider error.", STREAM_LABELS)
+stream_client_aborts = Counter("convo_stream_client_aborts", "Streams aborted by the client.", STREAM_LABELS)
+stream_cancel_close_seconds = Histogram(
+    "convo_stream_cancel_close_seconds", "Time from a stop request until the provider stream was closed.", STREAM_LABELS
+)
+stream_cancel_tokens_saved = Counter(
+    "convo_stream_cancel_tokens_saved", "Completion tokens not generated because the stream was stopped (estimated).", STREAM_LABELS
+)
+
+# Storage
+store_conversation_seconds = Histogram("convo_store_conversation_seconds", "Latency of a synchronous store_conversation_in_db call.")
+writer_commit_seconds = Histogram("convo_writer_commit_seconds", "Latency of a write-behind batch commit.")
+writer_batch_size = Histogram("convo_writer_batch_size", "Conversations per write-behind batch.", buckets=COUNT_BUCKETS)
+
+# Summaries
+summary_seconds = Histogram("convo_summary_seconds", "Latency of summary generation.", ("provider", "model"))
+
+# Attachments
+attachment_decode_seconds = Histogram("convo_attachment_decode_seconds", "Time to decode and store a base64 attachment.")
+attachment_extract_seconds = Histogram("convo_attachment_extract_seconds", "Time to extract text from a PDF (cache misses only).")
+attachment_extract_pages = Counter("convo_attachment_extract_pages", "PDF pages extracted (cache misses only).")
+attachment_extract_pages_pending = Gauge("convo_attachment_extract_pages_pending", "Pages of the PDFs being extracted not parsed yet.")
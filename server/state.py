@@ -0,0 +1,236 @@
+"""
+State shared by every worker process of the server.
+
+Most caches live in each process, which is fine for a single `uvicorn`
+process. With `--workers N`, or several replicas on one host, some state
+has to be visible to all of them: the conversation a worker has not
+written to the database yet, who is uploading a blob or summarizing a
+session, and per-session counters.
+
+`shared_state` is chosen by CONVO_SHARED_STATE:
+
+- `memory` (default): a dict in this process. For a single worker it
+  costs nothing.
+- `sqlite`: a SQLite file (CONVO_SHARED_STATE_PATH, `shared_state.db`
+  next to the server by default) in WAL mode. Every worker on the host
+  opens the same file.
+
+Values are JSON. Every entry may have a TTL. Leases (`acquire` /
+`release`) give one owner at a time a key, until it releases it or the
+lease expires. The SQLite backend blocks on disk and lock waits, so async
+code calls it through `run`.
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from database.db import DATA_DIR
+
+SHARED_STATE_BACKEND = os.environ.get("CONVO_SHARED_STATE", "memory")
+SHARED_STATE_PATH = os.environ.get(
+    "CONVO_SHARED_STATE_PATH", os.path.join(DATA_DIR, "shared_state.db")
+)
+# How long a writer waits for another worker's write lock, in milliseconds.
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("CONVO_SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+class SharedState:
+    """Interface of the shared-state backends."""
+
+    # False when only this process sees the state.
+    shared = False
+
+    def get(self, namespace: str, key: str, default=None):
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def incr(self, namespace: str, key: str, amounts: dict, ttl: float = None) -> dict:
+        """Adds `amounts` to the numbers in the dict stored at `key`. Returns the new dict."""
+        raise NotImplementedError
+
+    def acquire(self, namespace: str, key: str, owner: str, ttl: float) -> bool:
+        """Takes (or renews) the lease on `key` for `owner`. False while someone else holds it."""
+        raise NotImplementedError
+
+    def release(self, namespace: str, key: str, owner: str):
+        raise NotImplementedError
+
+    def prune(self) -> int:
+        """Removes expired entries. Returns how many were removed."""
+        raise NotImplementedError
+
+    async def run(self, method, *args, **kwargs):
+        """Calls one of the methods above from async code."""
+        return method(*args, **kwargs)
+
+def _expiry(ttl):
+    return time.time() + ttl if ttl else None
+
+def _added(current, amounts: dict) -> dict:
+    result = dict(current or {})
+    for name, amount in amounts.items():
+        result[name] = result.get(name, 0) + amount
+    return result
+
+class MemoryState(SharedState):
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _live(self, namespace, key):
+        entry = self._entries.get((namespace, key))
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._entries[(namespace, key)]
+            return None
+        return entry
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            return default if entry is None else entry[0]
+
+    def set(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._entries[(namespace, key)] = (value, _expiry(ttl))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+    def incr(self, namespace, key, amounts, ttl=None):
+        with self._lock:
+            entry = self._live(namespace, key)
+            value = _added(entry[0] if entry else None, amounts)
+            self._entries[(namespace, key)] = (value, _expiry(ttl))
+            return dict(value)
+
+    def acquire(self, namespace, key, owner, ttl):
+        with self._lock:
+            entry = self._live(namespace, key)
+            if entry is not None and entry[0] != owner:
+                return False
+            self._entries[(namespace, key)] = (owner, _expiry(ttl))
+            return True
+
+    def release(self, namespace, key, owner):
+        with self._lock:
+            entry = self._live(namespace, key)
+            if entry is not None and entry[0] == owner:
+                del self._entries[(namespace, key)]
+
+    def prune(self):
+        with self._lock:
+            now = time.time()
+            expired = [k for k, (_, expires) in self._entries.items() if expires is not None and expires <= now]
+            for k in expired:
+                del self._entries[k]
+            return len(expired)
+
+class SqliteState(SharedState):
+    """
+    One table in a SQLite file. Each thread has its own connection.
+    Read-modify-write operations take the write lock up front
+    (`BEGIN IMMEDIATE`), so they are atomic across processes.
+    """
+
+    shared = True
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS shared_state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _read(self, conn, namespace, key):
+        row = conn.execute(
+            "SELECT value, expires_at FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _write(self, conn, namespace, key, value, ttl):
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), _expiry(ttl)),
+        )
+
+    def get(self, namespace, key, default=None):
+        value = self._read(self._connection(), namespace, key)
+        return default if value is None else value
+
+    def set(self, namespace, key, value, ttl=None):
+        self._write(self._connection(), namespace, key, value, ttl)
+
+    def delete(self, namespace, key):
+        self._connection().execute("DELETE FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def incr(self, namespace, key, amounts, ttl=None):
+        with self._transaction() as conn:
+            value = _added(self._read(conn, namespace, key), amounts)
+            self._write(conn, namespace, key, value, ttl)
+            return value
+
+    def acquire(self, namespace, key, owner, ttl):
+        with self._transaction() as conn:
+            holder = self._read(conn, namespace, key)
+            if holder is not None and holder != owner:
+                return False
+            self._write(conn, namespace, key, owner, ttl)
+            return True
+
+    def release(self, namespace, key, owner):
+        with self._transaction() as conn:
+            if self._read(conn, namespace, key) == owner:
+                conn.execute("DELETE FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def prune(self):
+        cursor = self._connection().execute(
+            "DELETE FROM shared_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+    async def run(self, method, *args, **kwargs):
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND) -> SharedState:
+    if backend == "memory":
+        return MemoryState()
+    if backend == "sqlite":
+        return SqliteState()
+    raise ValueError(f"Unknown CONVO_SHARED_STATE backend: {backend}")
+
+shared_state = create_shared_state()
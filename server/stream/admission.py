@@ -0,0 +1,242 @@
+"""
+Admission control in front of the provider clients.
+
+Every upstream stream takes a slot from its provider's limiter and from
+its model's limiter. A limiter combines:
+
+- a concurrency semaphore (streams in flight)
+- a bounded wait queue: once `queue_size` requests are waiting, new
+  ones are rejected at once instead of piling up
+- a token bucket (`requests_per_minute`, `burst`)
+
+The wait for a slot and a token is bounded by `queue_timeout`. Errors that
+happen before the first token are retried with full-jitter exponential
+backoff when they look transient (429, 5xx, connection errors).
+
+Limits come from `configs/limits.toml`. CONVO_LIMITS_CONFIG points
+elsewhere.
+"""
+import os
+import math
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager, AsyncExitStack
+
+import tomli
+from fastapi import HTTPException
+
+import metrics
+from logs import get_logger, fields
+
+logger = get_logger(__name__)
+
+LIMITS_PATH = os.environ.get(
+    "CONVO_LIMITS_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "limits.toml"),
+)
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+admission_wait = metrics.Histogram(
+    "convo_admission_wait_seconds", "Time a stream waited for a provider slot.", ("provider",)
+)
+admission_waiting = metrics.Gauge(
+    "convo_admission_waiting", "Streams waiting for a provider slot.", ("limiter",)
+)
+admission_rejections = metrics.Counter(
+    "convo_admission_rejections", "Streams rejected by admission control.", ("limiter", "reason")
+)
+upstream_retries = metrics.Counter(
+    "convo_upstream_retries", "Retries of provider errors before the first token.", ("provider", "model")
+)
+
+def load_limits(path: str = LIMITS_PATH) -> dict:
+    try:
+        with open(path, "rb") as f:
+            return tomli.load(f)
+    except FileNotFoundError:
+        return {}
+
+class AdmissionRejected(Exception):
+    def __init__(self, limiter: str, reason: str, retry_after: float):
+        super().__init__(f"{limiter} is overloaded ({reason}), retry in {math.ceil(retry_after)}s")
+        self.limiter = limiter
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token, possibly in advance. Returns how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens += 1
+
+class Limiter:
+    def __init__(self, name: str, concurrency: int, queue_size: int, queue_timeout: float,
+                 requests_per_minute: float = 0, burst: int = 10):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(requests_per_minute, burst) if requests_per_minute else None
+
+    def full(self) -> bool:
+        return self.waiting >= self.queue_size and self._semaphore.locked()
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        admission_rejections.inc(limiter=self.name, reason=reason)
+        return AdmissionRejected(self.name, reason, self.queue_timeout)
+
+    @asynccontextmanager
+    async def slot(self, deadline: float):
+        """Holds one slot until the block exits. Raises AdmissionRejected when none is free by `deadline`."""
+        if self.full():
+            raise self._reject("queue_full")
+        self.waiting += 1
+        admission_waiting.inc(limiter=self.name)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise self._reject("timeout") from None
+        finally:
+            self.waiting -= 1
+            admission_waiting.dec(limiter=self.name)
+
+        try:
+            if self._bucket is not None:
+                delay = self._bucket.reserve()
+                if delay > deadline - time.monotonic():
+                    self._bucket.refund()
+                    raise self._reject("rate_limited")
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            self._semaphore.release()
+
+class Scheduler:
+    def __init__(self, limits: dict = None):
+        self.limits = load_limits() if limits is None else limits
+        self._limiters = {}
+
+    def settings(self, provider: str) -> dict:
+        defaults = {key: value for key, value in self.limits.get("defaults", {}).items() if key != "model"}
+        return {**defaults, **self.limits.get("providers", {}).get(provider, {})}
+
+    def _limiter(self, name: str, settings: dict) -> Limiter:
+        if name not in self._limiters:
+            self._limiters[name] = Limiter(
+                name,
+                concurrency=int(settings.get("concurrency", 32)),
+                queue_size=int(settings.get("queue_size", 64)),
+                queue_timeout=float(settings.get("queue_timeout", 15.0)),
+                requests_per_minute=float(settings.get("requests_per_minute", 0)),
+                burst=int(settings.get("burst", 10)),
+            )
+        return self._limiters[name]
+
+    def limiters(self, provider: str, model: str) -> list:
+        provider_settings = self.settings(provider)
+        model_settings = {
+            **provider_settings,
+            **self.limits.get("defaults", {}).get("model", {}),
+            **self.limits.get("models", {}).get(model, {}),
+        }
+        return [
+            self._limiter(provider, provider_settings),
+            self._limiter(f"{provider}/{model}", model_settings),
+        ]
+
+    def check(self, provider: str, model: str):
+        """Rejects with HTTP 503 before the response starts when a wait queue is already full."""
+        for limiter in self.limiters(provider, model):
+            if limiter.full():
+                error = limiter._reject("queue_full")
+                raise HTTPException(
+                    status_code=503, detail=str(error), headers={"Retry-After": str(math.ceil(error.retry_after))}
+                )
+
+    @asynccontextmanager
+    async def admit(self, provider: str, model: str):
+        started = time.monotonic()
+        limiters = self.limiters(provider, model)
+        deadline = started + limiters[0].queue_timeout
+        async with AsyncExitStack() as stack:
+            for limiter in limiters:
+                await stack.enter_async_context(limiter.slot(deadline))
+            admission_wait.observe(time.monotonic() - started, provider=provider)
+            yield
+
+scheduler = Scheduler()
+
+def _status_of(error: Exception):
+    for attribute in ("status_code", "code", "status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (AdmissionRejected, HTTPException)):
+        return False
+    if isinstance(error, (ConnectionError, asyncio.TimeoutError)):
+        return True
+    status = _status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # SDK connection and timeout errors (openai/anthropic APIConnectionError, httpx errors, ...).
+    name = type(error).__name__
+    return "Connection" in name or "Timeout" in name
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+async def admitted_stream(adapter, req, messages):
+    """
+    `adapter.stream` under admission control, retrying transient errors
+    that happen before the first token. The slot is released while
+    backing off.
+    """
+    settings = scheduler.settings(adapter.name)
+    retries = int(settings.get("retries", 2))
+    attempt = 0
+    while True:
+        produced = False
+        try:
+            async with scheduler.admit(adapter.name, req.model):
+                async for delta in adapter.stream(req, messages):
+                    produced = True
+                    yield delta
+            return
+        except Exception as e:
+            if produced or attempt >= retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, float(settings.get("backoff_base", 0.5)), float(settings.get("backoff_max", 8.0)))
+            delay = max(delay, min(_retry_after(e) or 0, float(settings.get("backoff_max", 8.0))))
+            attempt += 1
+            upstream_retries.inc(provider=adapter.name, model=req.model)
+            logger.info("Retrying provider error: %s", e, extra=fields(
+                provider=adapter.name, model=req.model, attempt=attempt, delay=round(delay, 2)
+            ))
+            await asyncio.sleep(delay)
@@ -1,114 +1,82 @@
 import os
 import re
-import json
-import datetime
+import asyncio
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import Request
 from fastapi import APIRouter
 
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 
-from .utils import handle_attachments, store_conversation_in_db
+from .utils import is_pdf, read_file_base64
+from .prompt_cache import mark_breakpoints
+from .pipeline import ProviderAdapter, register, stream_chat
 
 router = APIRouter()
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL")
 
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL)
 
-attachments_in_anthropic = {}
-
-@router.post("/anthropic_stream")
-async def anthropic_stream(request: Request):
+class AnthropicAdapter(ProviderAdapter):
     """
-    Stream responses from Anthropic's Claude models.
+    Sends PDFs inline as base64 `document` blocks, with prompt cache
+    breakpoints after the documents and the older turns.
     """
-    print("Received request for Anthropic streaming")
-    
-    # Parse the request body
-    body = await request.json()
-    conversation = body.get("messages", [])
-    temperature = body.get("temperature", 0.7)
-    max_tokens = body.get("max_tokens", 1024)
-    model = body.get("model", "claude-3-opus-20240229")
-    timestamp = body.get("timestamp", datetime.datetime.now().isoformat())
 
-    # Get session ID from the request
-    session_id = request.headers.get("X-Session-ID")
-    if session_id not in attachments_in_anthropic: attachments_in_anthropic[session_id] = {}
-    if not session_id:
-        raise HTTPException(status_code=400, detail="Missing 'session_id' in payload")
+    name = "anthropic"
+    model_prefixes = ("claude",)
+    default_model = "claude-3-opus-20240229"
+    default_max_tokens = 1024
+    keep_attachment_content = True
+    sends_files = True
+    chars_per_token = 3.5
+    default_context_window = 200000
+    default_context_budget = 64000
+
+    def upstream_model(self, model):
+        return re.sub(r'\.', '-', model)
+
+    async def build_messages(self, req):
+        anthropic_messages = []
+        for msg in req.conversation:
+            role = "user" if msg["role"] == "user" else "assistant"
 
-    # Handle file attachments if present
-    conversation = await handle_attachments(session_id, conversation, remove_content=False)
-    anthropic_messages = []
-    for msg in conversation:
-        role = "user" if msg["role"] == "user" else "assistant"
+            pdf_base64s = []
+            for attachment in msg.get("attachments") or []:
+                if is_pdf(attachment):
+                    # History rebuilt on the server carries the file path only.
+                    pdf_data = attachment.get("content") or await asyncio.to_thread(read_file_base64, attachment["file_path"])
+                    pdf_base64s.append({"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_data}})
 
-        pdf_base64s = []
-        if "attachments" in msg:
-            for attachment in msg["attachments"]:
-                if attachment["file_path"].endswith(".pdf"):
-                    print(attachment)
-                    if attachment["file_path"] not in attachments_in_anthropic[session_id]:    
-                        pdf_base64 = {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": attachment["content"]}}
-                        pdf_base64s.append(pdf_base64)
-                        attachments_in_anthropic[session_id][attachment["name"]] = pdf_base64
-                    else:
-                        pdf_base64s.append(attachments_in_anthropic[session_id][attachment["name"]])
+            anthropic_messages.append({"role": role, "content": pdf_base64s + [{"type": "text", "text": msg["content"]}]})
+        mark_breakpoints(anthropic_messages)
+        return anthropic_messages
 
-        anthropic_messages.append({"role": role, "content": pdf_base64s + [{"type": "text", "text": msg["content"]}]})
-    
-    line_count = 0
-    
-    async def event_generator():
-        try:
-            stream_completed = False
-            full_response = ""
+    async def stream(self, req, messages):
+        async with client.messages.stream(
+            model=self.upstream_model(req.model),
+            messages=messages,
+            max_tokens=req.max_tokens,
+            temperature=req.temperature
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            usage = (await stream.get_final_message()).usage
+            cached = usage.cache_read_input_tokens or 0
+            written = usage.cache_creation_input_tokens or 0
+            # `input_tokens` counts only the tokens after the last cache breakpoint.
+            req.usage.update(
+                prompt_tokens=usage.input_tokens + cached + written,
+                cached_tokens=cached,
+                cache_write_tokens=written,
+                completion_tokens=usage.output_tokens,
+            )
 
-            # Start the streaming response
-            with client.messages.stream(
-                model=re.sub(r'\.', '-', model),
-                messages=anthropic_messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            ) as stream:
-                for chunk in stream:
-                    if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text') and chunk.delta.text:
-                        content = chunk.delta.text
-                        full_response += content
-                        nonlocal line_count
-                        line_count += 1
-                        if line_count % 10 == 0:
-                            print(f"Processed {line_count} Anthropic stream chunks")
-                        
-                        # Format the response to match OpenAI format for client compatibility
-                        response_json = json.dumps({
-                            "choices": [{"delta": {"content": content}}]
-                        })
-                        yield f"data: {response_json}\n\n"
-            
-            # Send the [DONE] marker
-            print("Anthropic stream completed successfully")
-            yield "data: [DONE]\n\n"
-            stream_completed = True
-        except Exception as e:
-            print(f"Error during Anthropic streaming: {str(e)}")
-            yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
-        finally:
-            print(f"Anthropic stream ended after processing {line_count if 'line_count' in locals() else 0} chunks")
-            if stream_completed:
-                conversation.append(
-                    {
-                        "role": "assistant", 
-                        "content": full_response, 
-                        "model": model, 
-                        "temperature": temperature, 
-                        "max_tokens": max_tokens, 
-                        "timestamp": timestamp
-                    }
-                )
-                store_conversation_in_db(session_id, conversation)
+adapter = register(AnthropicAdapter())
 
-    print("Returning StreamingResponse from Anthropic to client")
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
\ No newline at end of file
+@router.post("/anthropic_stream")
+async def anthropic_stream(request: Request):
+    """
+    Stream responses from Anthropic's Claude models.
+    """
+    return await stream_chat(request, adapter)
@@ -0,0 +1,147 @@
+import os
+import re
+import uuid
+import hashlib
+import datetime
+import mimetypes
+
+from sqlalchemy.exc import IntegrityError
+
+from database.db import DATA_DIR, SessionLocal
+from database.models import Attachment
+
+BLOB_ROOT = os.path.join(DATA_DIR, "blob_store")
+# Where versions before the blob store kept attachments, per session.
+LEGACY_ATTACHMENT_ROOT = os.path.join(DATA_DIR, "temp_attachments")
+CHUNK_SIZE = 1024 * 1024
+# Blob ids are SHA-256 hex digests; anything else could name a path outside the store.
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+def is_blob_id(blob_id) -> bool:
+    return isinstance(blob_id, str) and BLOB_ID_PATTERN.match(blob_id) is not None
+
+def blob_path(blob_id: str) -> str:
+    if not is_blob_id(blob_id):
+        raise ValueError(f"Invalid blob id: {blob_id!r}")
+    return os.path.join(BLOB_ROOT, blob_id[:2], blob_id)
+
+def registered_blob_ids(blob_ids) -> set:
+    """Returns the ids in `blob_ids` that have an attachments row."""
+    blob_ids = {blob_id for blob_id in blob_ids if is_blob_id(blob_id)}
+    if not blob_ids:
+        return set()
+    db = SessionLocal()
+    try:
+        return {blob_id for (blob_id,) in db.query(Attachment.blobId).filter(Attachment.blobId.in_(blob_ids))}
+    finally:
+        db.close()
+
+def guess_mime_type(name: str, mime_type: str = None) -> str:
+    return mime_type or mimetypes.guess_type(name or "")[0] or "application/octet-stream"
+
+def _register_blob(blob_id: str, name: str, mime_type: str, size: int):
+    db = SessionLocal()
+    try:
+        if db.query(Attachment.id).filter(Attachment.blobId == blob_id).first() is None:
+            db.add(Attachment(blobId=blob_id, name=name, mimeType=guess_mime_type(name, mime_type), size=size))
+            db.commit()
+    except IntegrityError:
+        # Another upload of the same content registered it first.
+        db.rollback()
+    finally:
+        db.close()
+
+def store_blob_file(fileobj, name: str, mime_type: str = None) -> dict:
+    """
+    Copies a file-like object into the blob store, hashing it on the way.
+    Identical content is stored once no matter how often it is uploaded.
+    """
+    os.makedirs(BLOB_ROOT, exist_ok=True)
+    tmp_path = os.path.join(BLOB_ROOT, f".upload-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = fileobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+
+        blob_id = digest.hexdigest()
+        final_path = blob_path(blob_id)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    _register_blob(blob_id, name, mime_type, size)
+    return {"blobId": blob_id, "name": name, "type": guess_mime_type(name, mime_type), "size": size}
+
+def store_blob_bytes(data: bytes, name: str, mime_type: str = None) -> dict:
+    blob_id = hashlib.sha256(data).hexdigest()
+    final_path = blob_path(blob_id)
+    if not os.path.exists(final_path):
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, final_path)
+    _register_blob(blob_id, name, mime_type, len(data))
+    return {"blobId": blob_id, "name": name, "type": guess_mime_type(name, mime_type), "size": len(data)}
+
+def store_legacy_file(session_id: str, file_path: str, name: str, mime_type: str = None) -> dict:
+    """
+    Copies a file saved by versions before the blob store into it, so turns
+    stored back then keep their attachments. Returns None when `file_path`
+    does not name a file in the session's folder under LEGACY_ATTACHMENT_ROOT.
+    """
+    if not isinstance(file_path, str) or not file_path:
+        return None
+    root = os.path.realpath(os.path.join(LEGACY_ATTACHMENT_ROOT, session_id))
+    path = os.path.realpath(os.path.join(DATA_DIR, file_path))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return store_blob_file(f, name, mime_type)
+
+def blob_ids_of(attachments: list) -> list:
+    return [attachment["blobId"] for attachment in attachments or [] if attachment.get("blobId")]
+
+def adjust_refcounts(db, blob_ids: list, delta: int):
+    """
+    Adds `delta` to the reference count of every blob in `blob_ids`
+    (repeats count). Runs inside the caller's transaction.
+    """
+    for blob_id in blob_ids:
+        db.query(Attachment).filter(Attachment.blobId == blob_id).update(
+            {Attachment.refCount: Attachment.refCount + delta}, synchronize_session=False
+        )
+
+def collect_unreferenced_blobs(max_age: datetime.timedelta = datetime.timedelta(days=1)) -> int:
+    """
+    Deletes blobs no stored message references. Uploads younger than
+    `max_age` are kept, since their message may not be stored yet.
+    """
+    cutoff = datetime.datetime.utcnow() - max_age
+    db = SessionLocal()
+    removed = 0
+    try:
+        stale = db.query(Attachment).filter(Attachment.refCount <= 0, Attachment.createdAt < cutoff).all()
+        for attachment in stale:
+            path = blob_path(attachment.blobId)
+            if os.path.exists(path):
+                os.remove(path)
+            db.delete(attachment)
+            removed += 1
+        db.commit()
+    finally:
+        db.close()
+    return removed
@@ -0,0 +1,183 @@
+"""
+Response cache for deterministic completions.
+
+A completion is keyed by a SHA-256 over the provider, model, normalized
+messages (role, trimmed text and the content hashes of attachments),
+temperature and max_tokens. Only requests at or below
+COMPLETION_CACHE_MAX_TEMPERATURE are cached. Sampled answers are meant to
+differ between runs.
+
+Entries live in a size-bounded in-memory LRU over an on-disk tier under
+`completion_cache/`. The disk tier survives restarts and is shared by
+every worker on the host. The pipeline replays hits through the normal
+SSE path.
+
+Per request, the body may set:
+
+- `cache`: "use" (default), "refresh" to skip the lookup but store the new
+  answer, or "off" to bypass the cache entirely
+- `cache_ttl`: the maximum age in seconds of an entry that counts as a hit
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+from database.db import DATA_DIR
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+COMPLETION_CACHE_ROOT = os.path.join(DATA_DIR, "completion_cache")
+COMPLETION_CACHE_MEMORY_BYTES = int(os.environ.get("CONVO_COMPLETION_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+COMPLETION_CACHE_TTL = float(os.environ.get("CONVO_COMPLETION_CACHE_TTL", 7 * 24 * 3600))
+COMPLETION_CACHE_MAX_TEMPERATURE = float(os.environ.get("CONVO_COMPLETION_CACHE_MAX_TEMPERATURE", 0.0))
+# Size of the pieces a hit is replayed in; the coalescer merges them further.
+REPLAY_CHUNK_CHARS = 256
+
+cache_lookups = metrics.Counter(
+    "convo_completion_cache_lookups", "Completion cache lookups by result (hit, miss).", ("provider", "model", "result")
+)
+
+def _attachment_key(attachment: dict) -> str:
+    if attachment.get("blobId"):
+        return attachment["blobId"]
+    if attachment.get("content"):
+        return hashlib.sha256(attachment["content"].encode()).hexdigest()
+    return attachment.get("name", "")
+
+def normalize_messages(conversation: list) -> list:
+    """Drops per-turn metadata (timestamps, turn ids, models of earlier answers)."""
+    return [
+        {
+            "role": "user" if msg.get("role") == "user" else "assistant",
+            "content": (msg.get("content") or "").strip(),
+            "attachments": [_attachment_key(a) for a in msg.get("attachments") or []],
+        }
+        for msg in conversation
+    ]
+
+def cache_key(provider: str, model: str, conversation: list, temperature: float, max_tokens: int) -> str:
+    canonical = json.dumps(
+        {
+            "provider": provider,
+            "model": model,
+            "messages": normalize_messages(conversation),
+            "temperature": float(temperature),
+            "max_tokens": int(max_tokens),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def cache_mode(body: dict, temperature: float) -> str:
+    """Returns "use", "refresh" or "off" for a request."""
+    mode = body.get("cache", "use")
+    if mode not in ("use", "refresh", "off"):
+        mode = "use"
+    if temperature is None or float(temperature) > COMPLETION_CACHE_MAX_TEMPERATURE:
+        return "off"
+    return mode
+
+class CompletionCache:
+    def __init__(self, root: str = COMPLETION_CACHE_ROOT, max_memory_bytes: int = COMPLETION_CACHE_MEMORY_BYTES,
+                 ttl: float = COMPLETION_CACHE_TTL):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _remember(self, key: str, created: float, text: str):
+        size = len(text.encode("utf-8"))
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous[2]
+            self._entries[key] = (created, text, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def _read_disk(self, key: str):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["created"], entry["text"]
+
+    def _write_disk(self, key: str, entry: dict):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so other workers never read a partial file.
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write completion cache entry: %s", e)
+
+    async def get(self, key: str, ttl: float = None):
+        """Returns the cached text, or None when missing or older than `ttl`."""
+        ttl = self.ttl if ttl is None else min(float(ttl), self.ttl)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is None:
+                return None
+            self._remember(key, entry[0], entry[1])
+
+        created, text = entry[0], entry[1]
+        if time.time() - created > ttl:
+            return None
+        return text
+
+    def put(self, key: str, text: str, provider: str, model: str):
+        """Stores an answer in memory now and on disk in the background."""
+        created = time.time()
+        self._remember(key, created, text)
+        entry = {"created": created, "provider": provider, "model": model, "text": text}
+        asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, entry)
+
+    def prune(self) -> int:
+        """Deletes on-disk entries older than the TTL. Returns how many were removed."""
+        removed = 0
+        cutoff = time.time() - self.ttl
+        if not os.path.isdir(self.root):
+            return 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+completion_cache = CompletionCache()
+
+async def replay(text: str):
+    """Yields a cached answer as a stream of deltas."""
+    for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield text[start:start + REPLAY_CHUNK_CHARS]
@@ -0,0 +1,258 @@
+"""
+Token-budgeted context assembly.
+
+Sending the whole history every turn makes latency and cost grow without
+bound. `build_context` fits a turn into the model's token budget instead
+(the adapter's `context_budget`, capped by its context window), using:
+
+- the latest turn, which is always sent
+- as many of the previous turns as fit, newest first
+- when the session has a rolling summary (summarization enabled), at
+  most CONTEXT_MAX_TURNS turns, with the summary in place of the dropped
+  ones. It goes first, where the system prompt would be, so the prompt
+  prefix stays the same from turn to turn.
+- with a summary, turns dropped in steps of CONTEXT_DROP_STEP, so the
+  oldest kept turn stays the same for several turns and providers can
+  reuse the cached prompt prefix (see `prompt_cache.py`)
+- attachment text cut to ATTACHMENT_TOKEN_LIMIT per document (and further
+  if the latest turn alone is over budget)
+
+Without a summary, turns are only dropped when the budget forces it, and
+the report says so (`turns_lost`), so clients can tell the user.
+
+Token counts are local estimates (see `estimate_tokens`), not provider
+tokenizers, so the budget leaves some headroom. CONVO_CONTEXT_BUDGET
+overrides every model's budget. Requests may override the budget with
+`context_budget` and the turn limit with `context_turns`.
+"""
+import os
+import math
+import asyncio
+
+from database.db import SessionLocal
+from database.models import Session as ChatSession
+
+import metrics
+from logs import get_logger, fields
+
+from .utils import is_pdf
+from .extraction import get_attachment_text
+
+logger = get_logger(__name__)
+
+# Overrides the adapters' per-model budgets when set.
+CONTEXT_BUDGET_TOKENS = int(os.environ["CONVO_CONTEXT_BUDGET"]) if os.environ.get("CONVO_CONTEXT_BUDGET") else None
+CONTEXT_MAX_TURNS = int(os.environ.get("CONVO_CONTEXT_TURNS", 20))
+ATTACHMENT_TOKEN_LIMIT = int(os.environ.get("CONVO_ATTACHMENT_TOKEN_LIMIT", 8000))
+CONTEXT_DROP_STEP = max(1, int(os.environ.get("CONVO_CONTEXT_DROP_STEP", 4)))
+# Role markers and separators the providers add around each message.
+MESSAGE_OVERHEAD_TOKENS = 4
+# Rough cost of an image or other non-PDF file sent to a multimodal model.
+FILE_ATTACHMENT_TOKENS = 1000
+# Hangul, CJK and other non-ASCII text tokenizes much more densely.
+NON_ASCII_TOKENS_PER_CHAR = 0.8
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n\n"
+
+context_dropped_turns = metrics.Counter(
+    "convo_context_dropped_turns", "Turns left out of the provider context to fit the budget.", ("provider", "model")
+)
+context_truncated_tokens = metrics.Counter(
+    "convo_context_truncated_tokens", "Estimated attachment tokens cut from the provider context.", ("provider", "model")
+)
+context_tokens = metrics.Histogram(
+    "convo_context_tokens", "Estimated prompt tokens per request.", ("provider", "model"),
+    buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000, 256000),
+)
+
+def estimate_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """
+    Estimates the token count of `text`. ASCII text is counted at
+    `chars_per_token` characters per token and other characters at
+    NON_ASCII_TOKENS_PER_CHAR tokens each.
+    """
+    if not text:
+        return 0
+    # Extra UTF-8 bytes approximate the number of non-ASCII characters
+    # without a Python-level loop over large documents.
+    non_ascii = min(len(text), (len(text.encode("utf-8")) - len(text)) // 2)
+    return math.ceil((len(text) - non_ascii) / chars_per_token + non_ascii * NON_ASCII_TOKENS_PER_CHAR)
+
+def truncate_to_tokens(text: str, max_tokens: int, chars_per_token: float = 4.0) -> str:
+    tokens = estimate_tokens(text, chars_per_token)
+    if tokens <= max_tokens:
+        return text
+    keep = int(len(text) * max(0, max_tokens) / tokens)
+    return f"{text[:keep]}\n\n[... truncated {tokens - max_tokens} of {tokens} tokens]"
+
+def split_turns(conversation: list) -> list:
+    """Groups messages into turns, each starting at a user message."""
+    turns = []
+    for msg in conversation:
+        if msg.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+def _load_summary(session_id: str):
+    db = SessionLocal()
+    try:
+        row = db.query(ChatSession.summary, ChatSession.enableSummarization).filter(
+            ChatSession.sessionId == session_id
+        ).first()
+        if row is None or not row.enableSummarization:
+            return None
+        return row.summary or None
+    finally:
+        db.close()
+
+class _Turn:
+    def __init__(self, messages: list):
+        # Copies, so truncated text never reaches the stored conversation.
+        self.messages = [
+            dict(msg, attachments=[dict(a) for a in msg.get("attachments") or []]) for msg in messages
+        ]
+        self.text_tokens = 0
+        self.attachment_tokens = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.text_tokens + self.attachment_tokens
+
+    def attachments(self):
+        for msg in self.messages:
+            yield from msg["attachments"]
+
+async def _measure(turn: _Turn, adapter) -> list:
+    """
+    Fills in the turn's token estimates. For providers that receive
+    extracted text, PDF text is cut to ATTACHMENT_TOKEN_LIMIT and kept on
+    the attachment as `text`. Returns (name, original, kept) tokens of
+    every truncated attachment.
+    """
+    cpt = adapter.chars_per_token
+    truncated = []
+    turn.text_tokens = sum(
+        estimate_tokens(msg.get("content") or "", cpt) + MESSAGE_OVERHEAD_TOKENS for msg in turn.messages
+    )
+    turn.attachment_tokens = 0
+    for attachment in turn.attachments():
+        if not is_pdf(attachment):
+            turn.attachment_tokens += FILE_ATTACHMENT_TOKENS if adapter.sends_files else 0
+            continue
+        text = await get_attachment_text(attachment)
+        tokens = estimate_tokens(text, cpt)
+        if not adapter.sends_files and tokens > ATTACHMENT_TOKEN_LIMIT:
+            attachment["text"] = truncate_to_tokens(text, ATTACHMENT_TOKEN_LIMIT, cpt)
+            truncated.append((attachment.get("name"), tokens, ATTACHMENT_TOKEN_LIMIT))
+            tokens = ATTACHMENT_TOKEN_LIMIT
+        elif not adapter.sends_files:
+            attachment["text"] = text
+        turn.attachment_tokens += tokens + MESSAGE_OVERHEAD_TOKENS
+    return truncated
+
+async def _shrink_attachments(turn: _Turn, adapter, available: int) -> list:
+    """Cuts the turn's attachment text evenly so the turn fits in `available` tokens."""
+    attachments = [a for a in turn.attachments() if "text" in a]
+    if not attachments:
+        return []
+    cpt = adapter.chars_per_token
+    share = max(0, (available - turn.text_tokens) // len(attachments) - MESSAGE_OVERHEAD_TOKENS)
+    truncated = []
+    turn.attachment_tokens = 0
+    for attachment in attachments:
+        tokens = estimate_tokens(attachment["text"], cpt)
+        if tokens > share:
+            attachment["text"] = truncate_to_tokens(attachment["text"], share, cpt)
+            truncated.append((attachment.get("name"), tokens, share))
+            tokens = share
+        turn.attachment_tokens += tokens + MESSAGE_OVERHEAD_TOKENS
+    return truncated
+
+def context_budget(req, adapter) -> int:
+    window = adapter.context_window(req.model) - req.max_tokens
+    budget = req.body.get("context_budget") or CONTEXT_BUDGET_TOKENS or adapter.context_budget(req.model)
+    return max(0, min(int(budget), window))
+
+async def build_context(req, adapter) -> tuple:
+    """
+    Returns (messages, report). `messages` is what to send the provider
+    in place of `req.conversation`, which is left unchanged. `report`
+    says what was dropped or cut.
+    """
+    budget = context_budget(req, adapter)
+    turns = split_turns(req.conversation)
+    summary = await asyncio.to_thread(_load_summary, req.session_id) if len(turns) > 1 else None
+    # Without a summary to stand in for them, turns are only dropped to fit the budget.
+    max_turns = int(req.body.get("context_turns") or CONTEXT_MAX_TURNS) if summary else len(turns)
+
+    kept = []
+    truncated = []
+    used = 0
+    for turn_messages in reversed(turns):
+        if kept and len(kept) >= max_turns:
+            break
+        turn = _Turn(turn_messages)
+        turn_truncated = await _measure(turn, adapter)
+        if kept and used + turn.tokens > budget:
+            break
+        kept.append(turn)
+        truncated.extend(turn_truncated)
+        used += turn.tokens
+    kept.reverse()
+    dropped = len(turns) - len(kept)
+
+    if not dropped:
+        summary = None
+    if summary:
+        summary_tokens = estimate_tokens(summary, adapter.chars_per_token) + MESSAGE_OVERHEAD_TOKENS
+        # Make room for the summary by dropping the oldest kept turns.
+        while len(kept) > 1 and used + summary_tokens > budget:
+            used -= kept.pop(0).tokens
+            dropped += 1
+        used += summary_tokens
+
+        # Round the dropped turns up to a whole step; the latest turn always stays.
+        while dropped % CONTEXT_DROP_STEP and len(kept) > 1:
+            used -= kept.pop(0).tokens
+            dropped += 1
+
+    # Only the latest turn can be over budget on its own.
+    if used > budget and kept:
+        latest = kept[-1]
+        used -= latest.tokens
+        truncated.extend(await _shrink_attachments(latest, adapter, budget - used))
+        used += latest.tokens
+
+    messages = [msg for turn in kept for msg in turn.messages]
+    if summary:
+        # First, so the kept turns after it form the same prefix every turn
+        # until the summary is next rewritten.
+        messages.insert(0, {"role": "user", "content": SUMMARY_PREFIX + summary})
+
+    labels = {"provider": adapter.name, "model": req.model}
+    report = {
+        "budget": budget,
+        "tokens": used,
+        "turns": len(turns),
+        "turns_dropped": dropped,
+        "summary": bool(summary),
+        # Dropped turns no summary stands in for: the model does not see them at all.
+        "turns_lost": 0 if summary else dropped,
+        "attachments_truncated": len(truncated),
+        "tokens_truncated": sum(original - kept_tokens for _, original, kept_tokens in truncated),
+    }
+    context_tokens.observe(used, **labels)
+    if dropped:
+        context_dropped_turns.inc(dropped, **labels)
+    if report["tokens_truncated"]:
+        context_truncated_tokens.inc(report["tokens_truncated"], **labels)
+    if report["turns_lost"]:
+        logger.warning("History dropped without a summary", extra=fields(session=req.session_id, **labels, **report))
+    elif dropped or truncated or used > budget:
+        logger.info("Context trimmed to budget", extra=fields(
+            session=req.session_id,
+            truncated=[{"name": name, "tokens": original, "kept": kept_tokens} for name, original, kept_tokens in truncated],
+            **labels, **report,
+        ))
+    return messages, report
@@ -0,0 +1,171 @@
+"""
+PDF text extraction shared by every provider router.
+
+Extracted text is cached on disk keyed by the SHA-256 of the PDF, so it
+survives restarts and is shared by all sessions and workers on the host.
+Parsing runs in a process pool, off the event loop, and concurrent
+requests for the same document wait on a single extraction. Large
+documents are split into page ranges that are parsed in parallel and
+handed back in page order as each range finishes (see `iter_pdf_pages`),
+so progress is reported while the rest of the document is still parsed.
+"""
+import os
+import math
+import uuid
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+
+import metrics
+from logs import get_logger, fields
+from database.db import DATA_DIR
+
+logger = get_logger(__name__)
+
+EXTRACT_CACHE_ROOT = os.path.join(DATA_DIR, "extract_cache")
+EXTRACT_WORKERS = int(os.environ.get("CONVO_EXTRACT_WORKERS", os.cpu_count() or 1))
+# Documents with at most this many pages are parsed in a single task.
+MIN_PAGES_PER_SHARD = 8
+# Extraction progress is logged every this many pages.
+EXTRACT_PROGRESS_PAGES = int(os.environ.get("CONVO_EXTRACT_PROGRESS_PAGES", 50))
+
+_executor = None
+_in_flight = {}
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _executor
+
+def shutdown_extraction():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+def extract_pdf_text_sync(pdf_path: str) -> str:
+    with open(pdf_path, "rb") as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        pages = [page.extract_text() or "" for page in reader.pages]
+    return "\n".join(pages).strip()
+
+def pdf_page_count(pdf_path: str) -> int:
+    with open(pdf_path, "rb") as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> list:
+    """Extracts pages [start, end) of a PDF. Runs in a pool worker."""
+    with open(pdf_path, "rb") as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def shard_ranges(page_count: int, workers: int = None) -> list:
+    """
+    Splits `page_count` pages into contiguous ranges, about two per
+    worker so a slow shard does not leave the other workers idle.
+    """
+    workers = workers or EXTRACT_WORKERS
+    shard_size = max(MIN_PAGES_PER_SHARD, math.ceil(page_count / (workers * 2)))
+    return [(start, min(start + shard_size, page_count)) for start in range(0, page_count, shard_size)]
+
+async def iter_pdf_pages(pdf_path: str, executor=None):
+    """
+    Yields `(page_index, page_count, text)` for every page, in page order,
+    as soon as the shard holding the page is done. Callers can use the
+    first pages or report progress before the whole document is parsed.
+    Closing the generator early cancels the shards not yet started.
+    """
+    loop = asyncio.get_running_loop()
+    executor = executor or _get_executor()
+    page_count = await loop.run_in_executor(executor, pdf_page_count, pdf_path)
+    shards = [
+        (start, loop.run_in_executor(executor, extract_page_range, pdf_path, start, end))
+        for start, end in shard_ranges(page_count, getattr(executor, "_max_workers", None))
+    ]
+    try:
+        for start, shard in shards:
+            for offset, text in enumerate(await shard):
+                yield start + offset, page_count, text
+    finally:
+        for _, shard in shards:
+            shard.cancel()
+
+async def extract_pdf_text_parallel(pdf_path: str, executor=None) -> str:
+    """Parses the page ranges of a PDF in parallel and joins the pages in order."""
+    pages = [text async for _, _, text in iter_pdf_pages(pdf_path, executor)]
+    return "\n".join(pages).strip()
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_path(content_hash: str) -> str:
+    return os.path.join(EXTRACT_CACHE_ROOT, content_hash[:2], f"{content_hash}.txt")
+
+def _read_cached(content_hash: str):
+    path = _cache_path(content_hash)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def _write_cached(content_hash: str, text: str):
+    path = _cache_path(content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so other workers never read a partial file.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+async def _extract_and_cache(pdf_path: str, content_hash: str) -> str:
+    cached = await asyncio.to_thread(_read_cached, content_hash)
+    if cached is not None:
+        return cached
+    pages = []
+    pending = 0
+    try:
+        with metrics.attachment_extract_seconds.time():
+            async for index, page_count, page_text in iter_pdf_pages(pdf_path):
+                if not pages:
+                    pending = page_count
+                    metrics.attachment_extract_pages_pending.inc(pending)
+                pages.append(page_text)
+                pending -= 1
+                metrics.attachment_extract_pages_pending.dec()
+                metrics.attachment_extract_pages.inc()
+                if (index + 1) % EXTRACT_PROGRESS_PAGES == 0 or index + 1 == page_count:
+                    logger.info("PDF extraction progress", extra=fields(
+                        document=content_hash[:12], pages=index + 1, total=page_count
+                    ))
+    finally:
+        metrics.attachment_extract_pages_pending.dec(pending)
+    text = "\n".join(pages).strip()
+    await asyncio.to_thread(_write_cached, content_hash, text)
+    return text
+
+async def get_pdf_text(pdf_path: str, content_hash: str = None) -> str:
+    """
+    Returns the text of a PDF. `content_hash` is the SHA-256 of the file
+    (the blob id for blob store files); it is computed when not given.
+    """
+    if content_hash is None:
+        content_hash = await asyncio.to_thread(file_sha256, pdf_path)
+
+    task = _in_flight.get(content_hash)
+    if task is None:
+        task = asyncio.ensure_future(_extract_and_cache(pdf_path, content_hash))
+        _in_flight[content_hash] = task
+        task.add_done_callback(lambda _: _in_flight.pop(content_hash, None))
+    # Shield the shared task so one cancelled request does not cancel the
+    # extraction for everyone else waiting on it.
+    return await asyncio.shield(task)
+
+async def get_attachment_text(attachment: dict) -> str:
+    return await get_pdf_text(attachment["file_path"], attachment.get("blobId"))
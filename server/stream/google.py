@@ -1,121 +1,184 @@
 import os
-import json
-import datetime
+import asyncio
+import threading
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import Request
 from fastapi import APIRouter
 
 from google.genai import types
 from google import genai
 
-from .utils import handle_attachments, store_conversation_in_db
+from .blobs import guess_mime_type
+from .uploads import remote_files
+from .pipeline import ProviderAdapter, register, stream_chat
 
 router = APIRouter()
 
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-client = genai.client.AsyncClient(genai.client.ApiClient(api_key=GOOGLE_API_KEY))
+GOOGLE_BASE_URL = os.environ.get("GOOGLE_BASE_URL")
+# Longest wait for the next bytes of a stream before it is abandoned.
+GEMINI_READ_TIMEOUT = float(os.environ.get("CONVO_GEMINI_READ_TIMEOUT", 60))
 
-attachments_in_gcp = {}
+_reader = threading.local()
 
-@router.post("/gemini_stream")
-async def gemini_stream(request: Request):
-    """
-    Stream responses from Google's Gemini model using the Gemini SDK.
-    """
-    body = await request.json()
-    conversation = body.get("messages", [])
-    temperature = body.get("temperature", 0.7)
-    max_tokens = body.get("max_tokens", 256)
-    model = body.get("model", "gemini-pro")  # Default to gemini-pro model
-    timestamp = body.get("timestamp", datetime.datetime.now().isoformat())
-    # Get session ID from the request
-    session_id = request.headers.get("X-Session-ID")
-    if session_id not in attachments_in_gcp: attachments_in_gcp[session_id] = {}
-    if not session_id:
-        raise HTTPException(status_code=400, detail="Missing 'session_id' in payload")
-
-    # Handle file attachments if present
-    conversation = await handle_attachments(session_id, conversation)
-    
-    # Convert OpenAI message format to Gemini format
-    gemini_messages = []
-    for msg in conversation:
-        role = "user" if msg["role"] == "user" else "model"
-        attachments = []
-        
-        if "attachments" in msg:
-            for attachment in msg["attachments"]:
-                if attachment["file_path"] not in attachments_in_gcp[session_id]:
-                    gcp_upload = await client.files.upload(path=attachment["file_path"])
-                    path_wrap = types.Part.from_uri(file_uri=gcp_upload.uri, mime_type=gcp_upload.mime_type)
-                    attachments_in_gcp[session_id][attachment["file_path"]] = path_wrap
-                    attachments.append(path_wrap)
-                else:
-                    attachments.append(attachments_in_gcp[session_id][attachment["file_path"]])
-                    print("Uploaded File Reused")
-
-        gemini_messages.append(
-            types.Content(role=role, parts=[types.Part.from_text(text=msg["content"])] + attachments)
-        )
+def _shutdown(response):
+    """Closes a streamed HTTP response, waking a read blocked on it in another thread."""
+    shutdown = getattr(response.raw, "shutdown", None)  # urllib3 2.3+
+    try:
+        if shutdown is not None:
+            shutdown()
+        else:
+            response.close()
+    except Exception:
+        pass  # The response is already done with its connection.
+
+class _Upstream:
+    """The HTTP response behind one stream, so the event loop can stop a reader that waits on it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._response = None
+        self.stopped = False
 
-    print(gemini_messages)
+    def attach(self, response):
+        with self._lock:
+            self._response = response
+            stopped = self.stopped
+        if stopped:
+            _shutdown(response)
 
-    async def event_generator():
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            response = self._response
+        if response is not None:
+            _shutdown(response)
+
+class _ApiClient(genai.client.ApiClient):
+    """Hands streamed responses opened by a `_read_stream` thread to its `_Upstream`."""
+
+    def _request(self, http_request, stream=False):
+        response = super()._request(http_request, stream=stream)
+        upstream = getattr(_reader, "upstream", None)
+        if stream and upstream is not None:
+            upstream.attach(response.response_stream)
+        return response
+
+api_client = _ApiClient(
+    api_key=GOOGLE_API_KEY,
+    http_options={"base_url": GOOGLE_BASE_URL} if GOOGLE_BASE_URL else None,
+)
+client = genai.client.AsyncClient(api_client)
+# The SDK's async stream reads the HTTP response with blocking calls on
+# the event loop, and cannot be cancelled while it waits. Streams use the
+# blocking client on their own thread instead (see `_read_stream`).
+sync_models = genai.models.Models(api_client)
+
+_END = object()
+
+def _read_stream(chunks, loop, queue: asyncio.Queue, upstream: _Upstream):
+    """Reads the SDK's blocking stream on a worker thread and hands the chunks to the event loop."""
+    def put(item):
         try:
-            print(f"Starting Gemini stream for model: {model}, temperature: {temperature}, max_tokens: {max_tokens}")
-            line_count = 0
-            stream_completed = False
-            full_response = ""
-            
-            # Create a Gemini model instance
-            response = await client.models.generate_content_stream(
-                model=model,
-                contents=gemini_messages,
-                config=types.GenerateContentConfig(
-                    temperature=temperature,
-                    max_output_tokens=max_tokens,
-                    top_p=0.95,
-                )
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass  # The loop has shut down.
+
+    _reader.upstream = upstream
+    try:
+        for chunk in chunks:
+            if upstream.stopped:
+                break
+            put(chunk)
+    except Exception as e:
+        # A stopped stream fails its pending read; nobody is waiting for that error.
+        if not upstream.stopped:
+            put(e)
+    finally:
+        _reader.upstream = None
+        # Closing the generator drops the HTTP response and its connection.
+        chunks.close()
+        put(_END)
+
+class GeminiAdapter(ProviderAdapter):
+    """Uploads attachments with the Files API and references them by URI."""
+
+    name = "gemini"
+    model_prefixes = ("gemini",)
+    default_model = "gemini-pro"
+    sends_files = True
+    context_windows = {"gemini-1.5-pro": 2000000}
+    default_context_window = 1000000
+    context_budgets = {"gemini-1.5-pro": 128000}
+    default_context_budget = 64000
+
+    @staticmethod
+    async def upload(attachment):
+        # Blobs have no file extension, so pass the MIME type explicitly.
+        gcp_upload = await client.files.upload(
+            path=attachment["file_path"],
+            config=types.UploadFileConfig(mime_type=guess_mime_type(attachment.get("name"), attachment.get("type"))),
+        )
+        return gcp_upload.uri, gcp_upload.mime_type, gcp_upload.expiration_time
+
+    async def build_messages(self, req):
+        # Upload every attachment the registry has no fresh copy of, concurrently.
+        attachments = [a for msg in req.conversation for a in msg.get("attachments") or []]
+        files = iter(await remote_files(self.name, attachments, self.upload))
+
+        # Convert OpenAI message format to Gemini format
+        gemini_messages = []
+        for msg in req.conversation:
+            role = "user" if msg["role"] == "user" else "model"
+            parts = [types.Part.from_text(text=msg["content"])]
+            for _ in msg.get("attachments") or []:
+                uri, mime_type = next(files)
+                parts.append(types.Part.from_uri(file_uri=uri, mime_type=mime_type))
+            gemini_messages.append(types.Content(role=role, parts=parts))
+        return gemini_messages
+
+    async def stream(self, req, messages):
+        chunks = sync_models.generate_content_stream(
+            model=req.model,
+            contents=messages,
+            config=types.GenerateContentConfig(
+                temperature=req.temperature,
+                max_output_tokens=req.max_tokens,
+                top_p=0.95,
+                http_options={"timeout": int(GEMINI_READ_TIMEOUT * 1000)},
             )
-            
-            # Fix: Use synchronous iteration instead of async for
-            async for chunk in response:
-                content = chunk.text
-                full_response += content
-                line_count += 1
-                if line_count % 10 == 0:
-                    print(f"Processed {line_count} Gemini stream chunks")
-                
-                # Format the response to match OpenAI format for client compatibility
-                response_json = json.dumps({
-                    "choices": [{"delta": {"content": content}}]
-                })
-                yield f"data: {response_json}\n\n"
-            
-            # Send the [DONE] marker
-            print("Gemini stream completed successfully")
-            yield "data: [DONE]\n\n"
-            stream_completed = True
-                
-        except Exception as e:
-            print(f"Error during Gemini streaming: {str(e)}")
-            yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
+        )
+        queue = asyncio.Queue()
+        upstream = _Upstream()
+        # A thread per stream, so long streams do not tie up the default executor.
+        threading.Thread(
+            target=_read_stream, args=(chunks, asyncio.get_running_loop(), queue, upstream),
+            name="gemini-stream", daemon=True,
+        ).start()
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is _END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk.text
+                # Gemini caches repeated prefixes implicitly and reports the hit in the usage metadata.
+                if chunk.usage_metadata and chunk.usage_metadata.prompt_token_count:
+                    req.usage.update(
+                        prompt_tokens=chunk.usage_metadata.prompt_token_count,
+                        cached_tokens=chunk.usage_metadata.cached_content_token_count or 0,
+                        completion_tokens=chunk.usage_metadata.candidates_token_count,
+                    )
         finally:
-            print(f"Gemini stream ended after processing {line_count if 'line_count' in locals() else 0} chunks")
-            print(f"Stream ended after processing {line_count} chunks")
-            if stream_completed:
-                conversation.append(
-                    {
-                        "role": "assistant", 
-                        "content": full_response, 
-                        "model": model, 
-                        "temperature": temperature, 
-                        "max_tokens": max_tokens, 
-                        "timestamp": timestamp
-                    }
-                )
-                store_conversation_in_db(session_id, conversation)            
-
-    print("Returning StreamingResponse from Gemini to client")
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
\ No newline at end of file
+            # Shutting the response down wakes a reader stalled on the socket.
+            upstream.stop()
+
+adapter = register(GeminiAdapter())
+
+@router.post("/gemini_stream")
+async def gemini_stream(request: Request):
+    """
+    Stream responses from Google's Gemini model using the Gemini SDK.
+    """
+    return await stream_chat(request, adapter)
@@ -0,0 +1,127 @@
+"""
+Hedged requests across a session's model presets.
+
+If the primary model has not produced a first token within the hedge
+delay, a backup request starts on the session's other preset. The first
+stream to produce a token wins, and the other is cancelled, which closes
+its upstream connection. A stream that fails before its first token also
+starts the backup at once.
+
+Hedging is off unless CONVO_HEDGE_MS or the request's `hedge_ms` is set.
+The backup model is the request's `backup_model`, or else the session
+preset that differs from the primary model.
+"""
+import os
+import asyncio
+
+import metrics
+from database.db import SessionLocal
+from database.models import Session as ChatSession
+
+HEDGE_DELAY_MS = float(os.environ.get("CONVO_HEDGE_MS", 0))
+
+hedges_triggered = metrics.Counter(
+    "convo_hedges_triggered", "Streams that started a backup request.", ("provider", "model")
+)
+hedge_wins = metrics.Counter(
+    "convo_hedge_wins", "Hedged streams by the request that answered (primary, backup).", ("model", "winner")
+)
+
+_END = object()
+
+def hedge_delay(body: dict) -> float:
+    """Returns the hedge delay in seconds, or 0 when hedging is off."""
+    delay_ms = body.get("hedge_ms", HEDGE_DELAY_MS)
+    return max(0.0, float(delay_ms or 0)) / 1000
+
+def _load_presets(session_id: str) -> tuple:
+    db = SessionLocal()
+    try:
+        row = db.query(ChatSession.modelPreset1, ChatSession.modelPreset2).filter(
+            ChatSession.sessionId == session_id
+        ).first()
+        return tuple(row) if row else ()
+    finally:
+        db.close()
+
+async def backup_model_for(session_id: str, model: str, body: dict):
+    """Returns the model to hedge `model` with, or None."""
+    if body.get("backup_model"):
+        return body["backup_model"] if body["backup_model"] != model else None
+    for preset in await asyncio.to_thread(_load_presets, session_id):
+        if preset and preset != model:
+            return preset
+    return None
+
+async def hedge_deltas(primary, start_backup, delay: float, on_hedge=None, close_timeout: float = 2.0):
+    """
+    Races two delta streams. `primary` is an async generator of text
+    deltas, and `start_backup` is a coroutine function returning another.
+    The backup is started after `delay` seconds without a first token
+    from the primary, or as soon as the primary fails or ends empty.
+    Yields `(index, delta)`, where index 0 is the primary and 1 the backup,
+    and only from the winner. On the way out, waits up to `close_timeout`
+    seconds for both streams to close.
+    """
+    queue = asyncio.Queue()
+
+    async def pump(index, make):
+        try:
+            deltas = await make()
+            async for delta in deltas:
+                if delta:
+                    queue.put_nowait((index, delta))
+            queue.put_nowait((index, _END))
+        except Exception as e:
+            queue.put_nowait((index, e))
+
+    async def first():
+        return primary
+
+    tasks = {0: asyncio.ensure_future(pump(0, first))}
+    finished = {}
+    winner = None
+
+    def start():
+        if 1 not in tasks:
+            tasks[1] = asyncio.ensure_future(pump(1, start_backup))
+            if on_hedge:
+                on_hedge()
+
+    try:
+        while True:
+            timeout = delay if winner is None and 1 not in tasks else None
+            try:
+                index, item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                start()
+                continue
+
+            if winner is None:
+                if item is _END or isinstance(item, Exception):
+                    finished[index] = item
+                    if 1 not in tasks:
+                        start()
+                        continue
+                    if len(finished) < len(tasks):
+                        continue
+                    # Neither stream produced a token: report the primary's outcome.
+                    if isinstance(finished[0], Exception):
+                        raise finished[0]
+                    return
+                winner = index
+                for other, task in tasks.items():
+                    if other != winner:
+                        task.cancel()
+
+            if index != winner:
+                continue
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield index, item
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.wait(list(tasks.values()), timeout=close_timeout)
@@ -0,0 +1,552 @@
+"""
+Shared streaming pipeline for every provider.
+
+Each provider module implements a `ProviderAdapter` (how to turn the
+conversation into provider messages and how to stream text deltas back)
+and registers it. Everything else—request parsing, attachments, SSE
+framing, error reporting, context budgeting (see `context.py`),
+response caching (see `cache.py`), hedging across model presets (see
+`hedge.py`), admission control (see `admission.py`), prompt cache
+accounting (see `prompt_cache.py`), resumable delivery (see
+`resumable.py`) and persistence—lives here, once.
+`/chat_stream` dispatches on the model code; the old per-provider routes
+call `stream_chat` with their own adapter.
+"""
+import os
+import json
+import time
+import asyncio
+import inspect
+import datetime
+from contextlib import aclosing
+from dataclasses import dataclass, field, replace
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import StreamingResponse
+
+import metrics
+from logs import get_logger, log_payload, fields
+
+from .utils import resolve_conversation, handle_attachments, is_pdf, share_conversation
+from .extraction import get_attachment_text
+from .writer import enqueue_conversation
+from .context import build_context, estimate_tokens
+from .cache import completion_cache, cache_key, cache_mode, cache_lookups, replay
+from .admission import scheduler, admitted_stream
+from .prompt_cache import record_usage
+from .resumable import start_generation, get_generation
+from .hedge import hedge_delay, backup_model_for, hedge_deltas, hedges_triggered, hedge_wins
+from summary.jobs import schedule_summary
+
+router = APIRouter()
+logger = get_logger(__name__)
+
+DONE_FRAME = "data: [DONE]\n\n"
+# How long a stop may wait for provider streams to close.
+UPSTREAM_CLOSE_TIMEOUT = float(os.environ.get("CONVO_UPSTREAM_CLOSE_TIMEOUT", 2.0))
+
+@dataclass
+class StreamRequest:
+    session_id: str
+    conversation: list
+    model: str
+    temperature: float
+    max_tokens: int
+    timestamp: str
+    body: dict
+    # Token usage the adapter reports (see `prompt_cache.record_usage`):
+    # `prompt_tokens`, `cached_tokens`, `cache_write_tokens`, `completion_tokens`.
+    usage: dict = field(default_factory=dict)
+
+class ProviderAdapter:
+    """
+    Base class for provider adapters.
+
+    Subclasses set `name`, `model_prefixes` (model codes they serve, as
+    sent by the front end) and `default_model`, and implement
+    `build_messages` and `stream`.
+    """
+
+    name = ""
+    model_prefixes = ()
+    default_model = ""
+    default_max_tokens = 256
+    # Keep the base64 content of attachments for providers that send files inline.
+    keep_attachment_content = False
+    # Providers that receive attachments as files rather than extracted text.
+    sends_files = False
+    # For the local token estimate (see `context.estimate_tokens`).
+    chars_per_token = 4.0
+    # Context window in tokens by model code prefix, most specific first.
+    context_windows = {}
+    default_context_window = 32000
+    # Prompt tokens the context builder may use, by model code prefix, most
+    # specific first (see `context.context_budget`). Below the window,
+    # since cost and latency grow with the prompt.
+    context_budgets = {}
+    default_context_budget = 32000
+
+    def matches(self, model: str) -> bool:
+        return any(model.startswith(prefix) for prefix in self.model_prefixes)
+
+    def upstream_model(self, model: str) -> str:
+        """Maps the front end's model code to the provider's model name."""
+        return model
+
+    def context_window(self, model: str) -> int:
+        for prefix, window in self.context_windows.items():
+            if model.startswith(prefix):
+                return window
+        return self.default_context_window
+
+    def context_budget(self, model: str) -> int:
+        for prefix, budget in self.context_budgets.items():
+            if model.startswith(prefix):
+                return budget
+        return self.default_context_budget
+
+    async def build_messages(self, req: StreamRequest) -> list:
+        raise NotImplementedError
+
+    async def stream(self, req: StreamRequest, messages: list):
+        """Async generator of text deltas."""
+        raise NotImplementedError
+        yield
+
+async def close_upstream(stream):
+    """
+    Closes a provider SDK stream, releasing its HTTP connection now rather
+    than when the stream object is garbage collected.
+    """
+    close = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+_adapters = []
+
+def register(adapter: ProviderAdapter) -> ProviderAdapter:
+    _adapters.append(adapter)
+    return adapter
+
+def adapter_for(model: str) -> ProviderAdapter:
+    for adapter in _adapters:
+        if adapter.matches(model):
+            return adapter
+    raise HTTPException(status_code=400, detail=f"Unsupported model: {model}")
+
+async def build_text_messages(conversation: list) -> list:
+    """
+    Builds OpenAI-style chat messages. PDF attachments are sent as their
+    extracted text in an extra user message after the turn that carried
+    them. Text already cut to the context budget is kept on the attachment
+    as `text`.
+    """
+    messages = []
+    for msg in conversation:
+        role = "user" if msg["role"] == "user" else "assistant"
+
+        pdf_texts = []
+        for attachment in msg.get("attachments") or []:
+            if is_pdf(attachment):
+                pdf_text = attachment.get("text")
+                if pdf_text is None:
+                    pdf_text = await get_attachment_text(attachment)
+                pdf_texts.append([attachment["name"], pdf_text])
+
+        messages.append({"role": role, "content": msg["content"]})
+        for pdf_text in pdf_texts:
+            messages.append({"role": "user", "content": f"{pdf_text[0]}\n\n{pdf_text[1]}"})
+    return messages
+
+# Same shape as OpenAI's stream chunks, which the front end parses. Only
+# the content string is serialized per frame.
+_DELTA_PREFIX = 'data: {"choices": [{"delta": {"content": '
+_DELTA_SUFFIX = '}}]}\n\n'
+
+# Deltas are merged into one frame until this many milliseconds have
+# passed or this many bytes are pending; requests may override both with
+# `coalesce_ms` / `coalesce_bytes` (0 sends every delta as its own frame).
+COALESCE_WINDOW_MS = 30
+COALESCE_MAX_BYTES = 512
+
+_END = object()
+
+def format_delta(content: str) -> str:
+    return _DELTA_PREFIX + json.dumps(content) + _DELTA_SUFFIX
+
+async def coalesce_deltas(deltas, window_ms: float = COALESCE_WINDOW_MS, max_bytes: int = COALESCE_MAX_BYTES):
+    """
+    Merges text deltas into larger chunks. The first delta is passed
+    through immediately; later ones are held until `window_ms` has
+    elapsed since the buffer started or `max_bytes` are pending. A
+    pending buffer is flushed on time even if the upstream stalls.
+    """
+    if window_ms <= 0:
+        async for delta in deltas:
+            yield delta
+        return
+
+    window = window_ms / 1000
+    queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for delta in deltas:
+                queue.put_nowait(delta)
+            queue.put_nowait(_END)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    pump_task = asyncio.ensure_future(pump())
+    try:
+        first = await queue.get()
+        if first is _END:
+            return
+        if isinstance(first, Exception):
+            raise first
+        yield first
+
+        loop = asyncio.get_running_loop()
+        buffer = []
+        pending_bytes = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield "".join(buffer)
+                buffer, pending_bytes, deadline = [], 0, None
+                continue
+
+            if item is _END or isinstance(item, Exception):
+                if buffer:
+                    yield "".join(buffer)
+                if isinstance(item, Exception):
+                    raise item
+                return
+
+            if deadline is None:
+                deadline = loop.time() + window
+            buffer.append(item)
+            pending_bytes += len(item)
+            if pending_bytes >= max_bytes:
+                yield "".join(buffer)
+                buffer, pending_bytes, deadline = [], 0, None
+    finally:
+        # Stopping the stream stops the upstream too; wait for it to close.
+        pump_task.cancel()
+        await asyncio.wait([pump_task], timeout=UPSTREAM_CLOSE_TIMEOUT)
+
+def format_model(model: str) -> str:
+    """Frame telling the client which model answered (OpenAI chunks carry `model` too)."""
+    return f"data: {json.dumps({'model': model, 'choices': [{'delta': {}}]})}\n\n"
+
+def format_truncated() -> str:
+    """Frame telling the client the answer was cut short and kept as is."""
+    return f"data: {json.dumps({'truncated': True, 'choices': [{'delta': {}}]})}\n\n"
+
+def format_error(error: Exception) -> str:
+    return f"data: {json.dumps({'error': str(error)})}\n\n"
+
+def _is_valid_message(message) -> bool:
+    """Whether `message` is a user turn the server can add to the history."""
+    if not isinstance(message, dict) or not isinstance(message.get("content"), str):
+        return False
+    attachments = message.get("attachments") or []
+    return isinstance(attachments, list) and all(
+        isinstance(attachment, dict) and isinstance(attachment.get("name"), str) for attachment in attachments
+    )
+
+async def parse_stream_request(request: Request, adapter: ProviderAdapter = None) -> StreamRequest:
+    try:
+        body = await request.json()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload") from e
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+
+    # Routers historically used either key for the full conversation.
+    conversation = body.get("conversation") or body.get("messages")
+    message = body.get("message")
+    if not conversation and not message:
+        raise HTTPException(status_code=400, detail="Missing 'conversation' in payload")
+    if message is not None and not _is_valid_message(message):
+        raise HTTPException(
+            status_code=400,
+            detail="'message' must be an object with string 'content' and an optional 'attachments' list",
+        )
+
+    session_id = request.headers.get("X-Session-ID")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="Missing 'session_id' in payload")
+
+    model = body.get("model") or (adapter.default_model if adapter else None)
+    if not model:
+        raise HTTPException(status_code=400, detail="Missing 'model' in payload")
+    adapter = adapter or adapter_for(model)
+
+    return StreamRequest(
+        session_id=session_id,
+        conversation=await resolve_conversation(session_id, body, conversation),
+        model=model,
+        temperature=body.get("temperature", 0.7),
+        max_tokens=body.get("max_tokens", adapter.default_max_tokens),
+        timestamp=body.get("timestamp", datetime.datetime.now().isoformat()),
+        body=body,
+    )
+
+async def stream_chat(request: Request, adapter: ProviderAdapter = None) -> StreamingResponse:
+    """
+    Runs the full pipeline for one turn and returns the SSE response. When
+    `adapter` is None it is chosen from the request's model code.
+    """
+    started = time.perf_counter()
+    req = await parse_stream_request(request, adapter)
+    log_payload(logger, "chat_stream", req.body)
+    adapter = adapter or adapter_for(req.model)
+    labels = {"provider": adapter.name, "model": req.model}
+
+    dropped_attachments = []
+    req.conversation = await handle_attachments(
+        req.session_id, req.conversation, remove_content=not adapter.keep_attachment_content,
+        dropped=dropped_attachments,
+    )
+    context, context_report = await build_context(req, adapter)
+    # Attachments whose file is gone are not sent; the client can tell the user.
+    context_report["attachments_dropped"] = dropped_attachments
+
+    mode = cache_mode(req.body, req.temperature)
+    key = cached = None
+    if mode != "off":
+        key = cache_key(adapter.name, req.model, context, req.temperature, req.max_tokens)
+        if mode == "use":
+            cached = await completion_cache.get(key, req.body.get("cache_ttl"))
+            cache_lookups.inc(result="miss" if cached is None else "hit", **labels)
+    if cached is None:
+        # Fail fast while the provider's wait queue is full.
+        scheduler.check(adapter.name, req.model)
+    # A hit needs no provider messages or uploads. PDFs were already
+    # extracted by `build_context`, which measures them.
+    messages = await adapter.build_messages(replace(req, conversation=context)) if cached is None else None
+
+    delay = hedge_delay(req.body) if cached is None else 0
+    backup_model = await backup_model_for(req.session_id, req.model, req.body) if delay else None
+    answered_model = req.model
+
+    chunk_count = 0
+    ttft = None
+    response_parts = []
+    turn_completed = False
+
+    async def start_backup():
+        backup_adapter = adapter_for(backup_model)
+        backup_req = replace(req, model=backup_model)
+        backup_context, _ = await build_context(backup_req, backup_adapter)
+        backup_messages = await backup_adapter.build_messages(replace(backup_req, conversation=backup_context))
+        return admitted_stream(backup_adapter, backup_req, backup_messages)
+
+    async def provider_deltas():
+        nonlocal answered_model
+        if not backup_model:
+            async for content in admitted_stream(adapter, req, messages):
+                yield content
+            return
+
+        hedged = False
+
+        def on_hedge():
+            nonlocal hedged
+            hedged = True
+            hedges_triggered.inc(**labels)
+            logger.info("Hedging with backup model", extra=fields(session=req.session_id, backup=backup_model, **labels))
+
+        deltas = hedge_deltas(
+            admitted_stream(adapter, req, messages), start_backup, delay, on_hedge, close_timeout=UPSTREAM_CLOSE_TIMEOUT
+        )
+        async for index, content in deltas:
+            if not response_parts:
+                answered_model = backup_model if index else req.model
+                if hedged:
+                    hedge_wins.inc(model=req.model, winner="backup" if index else "primary")
+            yield content
+
+    async def upstream():
+        nonlocal chunk_count, ttft
+        source = provider_deltas() if cached is None else replay(cached)
+        async for content in source:
+            if content:
+                if not chunk_count:
+                    ttft = time.perf_counter() - started
+                    metrics.stream_ttft.observe(ttft, **labels)
+                chunk_count += 1
+                response_parts.append(content)
+                yield content
+
+    def turn_usage() -> dict:
+        """
+        What the turn cost and how fast it was, stored with the message.
+        Token counts the provider did not report are estimated locally
+        (`estimated`). A cache hit made no provider call and costs nothing.
+        """
+        text = "".join(response_parts)
+        usage = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "estimated": False,
+            "ttft_seconds": round(ttft, 4) if ttft is not None else None,
+            "duration_seconds": round(time.perf_counter() - started, 4),
+            "chunks": chunk_count,
+        }
+        if cached is not None:
+            return usage
+        usage["prompt_tokens"] = req.usage.get("prompt_tokens")
+        usage["completion_tokens"] = req.usage.get("completion_tokens")
+        usage["cached_tokens"] = req.usage.get("cached_tokens") or 0
+        if usage["prompt_tokens"] is None:
+            usage["prompt_tokens"] = context_report["tokens"]
+            usage["estimated"] = True
+        if usage["completion_tokens"] is None:
+            usage["completion_tokens"] = estimate_tokens(text, adapter_for(answered_model).chars_per_token)
+            usage["estimated"] = True
+        return usage
+
+    async def complete_turn(truncated: bool = False):
+        """
+        Persists the finished turn. Runs before [DONE] so clients see its
+        effects. A stopped stream is kept as far as it got, flagged
+        `truncated`; one stopped before any delta is not kept.
+        """
+        nonlocal turn_completed
+        turn_completed = True
+        req.conversation.append(
+            {
+                "role": "assistant",
+                "content": "".join(response_parts),
+                "model": answered_model,
+                "temperature": req.temperature,
+                "max_tokens": req.max_tokens,
+                "timestamp": req.timestamp,
+                "truncated": truncated,
+                "usage": turn_usage(),
+            }
+        )
+        enqueue_conversation(req.session_id, req.conversation)
+        await share_conversation(req.session_id, req.conversation)
+        # The key describes the primary model's request.
+        if key and cached is None and response_parts and answered_model == req.model and not truncated:
+            completion_cache.put(key, "".join(response_parts), adapter.name, req.model)
+        if cached is None:
+            await record_usage(req.session_id, adapter_for(answered_model).name, answered_model, req.usage)
+        user_turns = [msg for msg in req.conversation if msg.get("role") == "user"]
+        schedule_summary(req.session_id, user_turns[-1].get("turnId") if user_turns else None)
+
+    async def generate(generation):
+        """Runs the turn and publishes its frames, whether or not a client is listening."""
+        metrics.streams_in_flight.inc(provider=adapter.name)
+        try:
+            logger.info("Stream started", extra=fields(
+                session=req.session_id, temperature=req.temperature, max_tokens=req.max_tokens, **labels
+            ))
+            frames = coalesce_deltas(
+                upstream(),
+                window_ms=req.body.get("coalesce_ms", COALESCE_WINDOW_MS),
+                max_bytes=req.body.get("coalesce_bytes", COALESCE_MAX_BYTES),
+            )
+            # Closing the frames on the way out closes the provider stream too.
+            async with aclosing(frames):
+                async for content in frames:
+                    generation.publish(format_delta(content), content)
+
+            await complete_turn()
+            if backup_model:
+                generation.publish(format_model(answered_model))
+            generation.publish(DONE_FRAME)
+        except asyncio.CancelledError:
+            # Stopped by the user or by shutdown. The provider stream is closed by now.
+            if generation.cancel_requested_at is not None:
+                metrics.stream_cancel_close_seconds.observe(time.perf_counter() - generation.cancel_requested_at, **labels)
+            text = "".join(response_parts)
+            tokens_saved = max(0, req.max_tokens - estimate_tokens(text, adapter.chars_per_token)) if cached is None else 0
+            metrics.stream_cancel_tokens_saved.inc(tokens_saved, **labels)
+            logger.info("Stream cancelled", extra=fields(
+                session=req.session_id, chars=len(text), tokens_saved=tokens_saved, **labels
+            ))
+            if not turn_completed:
+                # A turn stopped before its first delta has nothing worth keeping.
+                if response_parts:
+                    await complete_turn(truncated=True)
+                    generation.publish(format_truncated())
+                generation.publish(DONE_FRAME)
+            raise
+        except Exception as e:
+            logger.warning("Stream failed: %s", e, extra=fields(session=req.session_id, **labels))
+            metrics.stream_upstream_errors.inc(**labels)
+            generation.publish(format_error(e))
+        finally:
+            logger.info("Stream ended", extra=fields(
+                session=req.session_id, chunks=chunk_count, seconds=round(time.perf_counter() - started, 3),
+                **req.usage, **labels
+            ))
+            metrics.streams_in_flight.dec(provider=adapter.name)
+            metrics.stream_duration.observe(time.perf_counter() - started, **labels)
+            metrics.stream_chunks.observe(chunk_count, **labels)
+            metrics.stream_bytes.inc(len("".join(response_parts).encode()), **labels)
+
+    generation = start_generation(req.session_id, labels, generate, catch_up=format_delta)
+    cache_status = "hit" if cached is not None else "miss" if mode == "use" else mode
+    return StreamingResponse(
+        generation.subscribe(),
+        media_type="text/event-stream",
+        headers={
+            "X-Convo-Cache": cache_status,
+            "X-Convo-Context": json.dumps(context_report, separators=(",", ":")),
+            "X-Convo-Stream-ID": generation.id,
+        },
+    )
+
+@router.post("/chat_stream")
+async def chat_stream(request: Request):
+    """
+    Single streaming endpoint for every provider; the adapter is chosen
+    from the `model` in the payload.
+    """
+    return await stream_chat(request)
+
+@router.post("/streams/{stream_id}/cancel")
+async def cancel_stream(stream_id: str, request: Request):
+    """
+    Stops a stream (the user pressed stop). Returns once the provider
+    stream is closed and the partial answer is stored, or after
+    UPSTREAM_CLOSE_TIMEOUT seconds.
+    """
+    generation = get_generation(stream_id, request.headers.get("X-Session-ID"))
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream")
+    return {"cancelled": await generation.cancel(UPSTREAM_CLOSE_TIMEOUT + 1)}
+
+@router.get("/streams/{stream_id}")
+async def resume_stream(stream_id: str, request: Request, last_event_id: int = None):
+    """
+    Reconnects to a running or recently finished stream. Frames after the
+    `Last-Event-ID` header (or `last_event_id` query parameter) are sent
+    again, then the stream continues live.
+    """
+    generation = get_generation(stream_id, request.headers.get("X-Session-ID"))
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream")
+    header = request.headers.get("Last-Event-ID")
+    try:
+        last_event_id = int(header) if header else last_event_id or 0
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID") from e
+    if not generation.can_resume(last_event_id):
+        raise HTTPException(status_code=410, detail="Stream position is no longer buffered")
+    return StreamingResponse(
+        generation.subscribe(last_event_id),
+        media_type="text/event-stream",
+        headers={"X-Convo-Stream-ID": generation.id},
+    )
@@ -0,0 +1,104 @@
+"""
+Provider-side prompt-prefix caching.
+
+Most of a turn's prompt repeats the previous turn's: the documents and
+the older turns come first and do not change. Providers can reuse that
+prefix instead of processing it again:
+
+- Anthropic caches up to explicit `cache_control` breakpoints.
+  `mark_breakpoints` puts one after the last document, one at the end
+  of the previous user message (where the last turn's cache ends) and
+  one at the end of the new user message (for the next turn to reuse).
+- OpenAI caches the longest previously seen prefix automatically, as
+  long as the messages come in the same order every turn. The context
+  builder keeps the prefix stable (see `context.py`).
+
+Adapters report the prompt token usage the provider returns on
+`StreamRequest.usage`. `record_usage` adds it to the metrics and to
+per-session totals in the shared state (so every worker counts into the
+same totals), which `GET /sessions/{id}/prompt_cache` reports.
+"""
+import os
+
+import metrics
+from state import shared_state
+
+# Anthropic rejects requests with more breakpoints than this.
+MAX_BREAKPOINTS = 4
+CACHE_CONTROL = {"type": "ephemeral"}
+# Session totals are dropped after this long without a request.
+PROMPT_CACHE_STATS_TTL = float(os.environ.get("CONVO_PROMPT_CACHE_STATS_TTL", 7 * 24 * 3600))
+
+prompt_tokens = metrics.Counter(
+    "convo_prompt_tokens", "Prompt tokens reported by the provider.", ("provider", "model")
+)
+prompt_cached_tokens = metrics.Counter(
+    "convo_prompt_cached_tokens", "Prompt tokens the provider read from its prefix cache.", ("provider", "model")
+)
+prompt_cache_write_tokens = metrics.Counter(
+    "convo_prompt_cache_write_tokens", "Prompt tokens the provider wrote to its prefix cache.", ("provider", "model")
+)
+
+def _empty_totals() -> dict:
+    return {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0, "hits": 0}
+
+def mark_breakpoints(messages: list, max_breakpoints: int = MAX_BREAKPOINTS) -> int:
+    """
+    Adds `cache_control` to the content blocks that end the stable prefix
+    of Anthropic `messages`, in place. Returns the number of breakpoints.
+    """
+    candidates = []
+    documents = [
+        block for msg in messages for block in msg["content"] if block.get("type") == "document"
+    ]
+    if documents:
+        candidates.append(documents[-1])
+    user_messages = [msg for msg in messages if msg["role"] == "user" and msg["content"]]
+    for msg in user_messages[-2:]:
+        candidates.append(msg["content"][-1])
+
+    marked = []
+    for block in candidates:
+        if any(block is other for other in marked):
+            continue
+        if len(marked) == max_breakpoints:
+            break
+        block["cache_control"] = dict(CACHE_CONTROL)
+        marked.append(block)
+    return len(marked)
+
+async def record_usage(session_id: str, provider: str, model: str, usage: dict):
+    """
+    Adds one response's usage to the metrics and the session's totals.
+    `usage` holds `prompt_tokens` (all input tokens, cached or not),
+    `cached_tokens` and `cache_write_tokens`.
+    """
+    if not usage.get("prompt_tokens"):
+        return
+    labels = {"provider": provider, "model": model}
+    prompt_tokens.inc(usage["prompt_tokens"], **labels)
+    if usage.get("cached_tokens"):
+        prompt_cached_tokens.inc(usage["cached_tokens"], **labels)
+    if usage.get("cache_write_tokens"):
+        prompt_cache_write_tokens.inc(usage["cache_write_tokens"], **labels)
+
+    await shared_state.run(shared_state.incr, "prompt_cache", session_id, {
+        "requests": 1,
+        "prompt_tokens": usage["prompt_tokens"],
+        "cached_tokens": usage.get("cached_tokens") or 0,
+        "cache_write_tokens": usage.get("cache_write_tokens") or 0,
+        "hits": 1 if usage.get("cached_tokens") else 0,
+    }, PROMPT_CACHE_STATS_TTL)
+
+async def session_cache_stats(session_id: str) -> dict:
+    """
+    Returns the session's prompt cache totals.
+    `hit_rate` is the share of requests that read from the cache and
+    `token_hit_rate` the share of prompt tokens read from it.
+    """
+    totals = {**_empty_totals(), **await shared_state.run(shared_state.get, "prompt_cache", session_id, {})}
+    totals["hit_rate"] = round(totals["hits"] / totals["requests"], 4) if totals["requests"] else 0.0
+    totals["token_hit_rate"] = (
+        round(totals["cached_tokens"] / totals["prompt_tokens"], 4) if totals["prompt_tokens"] else 0.0
+    )
+    return totals
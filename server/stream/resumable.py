@@ -0,0 +1,177 @@
+"""
+Generations that run detached from the HTTP connection.
+
+`stream_chat` runs each generation as a task (see `start_generation`),
+and the response only subscribes to it. When the client goes away, the
+generation keeps running and the turn is still persisted. Every SSE frame
+carries an `id:`. A client that lost its connection calls
+`GET /streams/{stream_id}` with a `Last-Event-ID` header and gets the
+frames after that id, then the live ones.
+
+Each generation keeps the last STREAM_REPLAY_FRAMES frames. A client
+resuming from an id that has left the buffer first gets one frame with
+all the text it missed, from the last STREAM_REPLAY_TEXT_CHARS
+characters of response text kept for that; resuming from further back
+fails with a 410. Finished generations can be resumed for
+STREAM_RETENTION_SECONDS.
+
+`cancel` stops a generation on purpose (the user pressed stop). The
+pipeline then closes the provider stream and keeps the partial answer.
+
+Generations live in the worker that started them. With several workers,
+route a session's requests to one worker (e.g. by `X-Session-ID`) so
+that a resume finds them.
+"""
+import os
+import time
+import uuid
+import asyncio
+from collections import deque
+
+import metrics
+from logs import get_logger, fields
+
+logger = get_logger(__name__)
+
+STREAM_REPLAY_FRAMES = int(os.environ.get("CONVO_STREAM_REPLAY_FRAMES", 1024))
+STREAM_RETENTION_SECONDS = float(os.environ.get("CONVO_STREAM_RETENTION_SECONDS", 300))
+# Response text kept for catching up resumed clients, in characters.
+STREAM_REPLAY_TEXT_CHARS = int(os.environ.get("CONVO_STREAM_REPLAY_TEXT_CHARS", 1024 * 1024))
+
+stream_resumes = metrics.Counter(
+    "convo_stream_resumes", "Reconnects to a running or finished stream, by whether frames had to be merged.", ("replay",)
+)
+
+_generations = {}
+
+class Generation:
+    def __init__(self, session_id: str, labels: dict, catch_up):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.labels = labels
+        # Formats missed text as one frame (see `subscribe`).
+        self.catch_up = catch_up
+        self.frames = deque(maxlen=STREAM_REPLAY_FRAMES)
+        self.last_id = 0
+        self.finished = False
+        self.task = None
+        # perf_counter() of the stop request, for the abort-to-close latency.
+        self.cancel_requested_at = None
+        # Response text of each event from id `_first_text_id` on, trimmed
+        # to about STREAM_REPLAY_TEXT_CHARS characters.
+        self._texts = []
+        self._first_text_id = 1
+        self._text_chars = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, frame: str, text: str = ""):
+        """Adds an SSE frame; `text` is the response text it carries."""
+        self.last_id += 1
+        self._texts.append(text)
+        self._text_chars += len(text)
+        if self._text_chars > STREAM_REPLAY_TEXT_CHARS:
+            self._trim_texts()
+        self.frames.append((self.last_id, frame))
+        self._notify()
+
+    def _trim_texts(self):
+        # Down to three quarters of the cap, so trimming runs once per many events.
+        drop = 0
+        while drop < len(self._texts) - 1 and self._text_chars > STREAM_REPLAY_TEXT_CHARS * 3 // 4:
+            self._text_chars -= len(self._texts[drop])
+            drop += 1
+        del self._texts[:drop]
+        self._first_text_id += drop
+
+    def can_resume(self, last_event_id: int) -> bool:
+        """Whether the text after `last_event_id` is still kept."""
+        return last_event_id >= self._first_text_id - 1
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _text_after(self, event_id: int, until_id: int) -> str:
+        """Response text of the events after `event_id` up to `until_id`."""
+        start = event_id + 1 - self._first_text_id
+        return "".join(self._texts[start:until_id + 1 - self._first_text_id])
+
+    async def subscribe(self, last_event_id: int = 0):
+        """Yields the frames after `last_event_id`, with their ids, until the generation ends."""
+        sent = max(0, min(last_event_id, self.last_id))
+        if last_event_id:
+            stream_resumes.inc(replay="merged" if self.frames and sent < self.frames[0][0] - 1 else "exact")
+        try:
+            while True:
+                changed = self._changed
+                first_buffered = self.frames[0][0] if self.frames else self.last_id + 1
+                if sent < first_buffered - 1:
+                    if not self.can_resume(sent):
+                        # Fell behind further than the kept text; a resume gets a 410.
+                        logger.warning("Subscriber fell behind the replay buffer", extra=fields(
+                            session=self.session_id, stream=self.id, **self.labels
+                        ))
+                        return
+                    yield f"id: {first_buffered - 1}\n" + self.catch_up(self._text_after(sent, first_buffered - 1))
+                    sent = first_buffered - 1
+                for event_id, frame in list(self.frames):
+                    if event_id > sent:
+                        yield f"id: {event_id}\n{frame}"
+                        sent = event_id
+                if self.finished and sent >= self.last_id:
+                    return
+                await changed.wait()
+        except (asyncio.CancelledError, GeneratorExit):
+            if not self.finished:
+                logger.info("Client disconnected, generation continues", extra=fields(
+                    session=self.session_id, stream=self.id, **self.labels
+                ))
+                metrics.stream_client_aborts.inc(**self.labels)
+            raise
+
+    async def cancel(self, timeout: float) -> bool:
+        """
+        Stops the generation and waits up to `timeout` seconds for it to
+        wind down. Returns False when it had already finished.
+        """
+        if self.task is None or self.task.done():
+            return False
+        self.cancel_requested_at = time.perf_counter()
+        self.task.cancel()
+        await asyncio.wait([self.task], timeout=timeout)
+        return True
+
+    def _done(self, task: asyncio.Task):
+        self.finished = True
+        self._notify()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Generation failed", exc_info=task.exception(), extra=fields(
+                session=self.session_id, stream=self.id, **self.labels
+            ))
+        asyncio.get_running_loop().call_later(STREAM_RETENTION_SECONDS, _generations.pop, self.id, None)
+
+def start_generation(session_id: str, labels: dict, produce, catch_up) -> Generation:
+    """
+    Runs `produce(generation)` as a task that outlives the request.
+    `produce` publishes frames with `generation.publish`.
+    """
+    generation = Generation(session_id, labels, catch_up)
+    _generations[generation.id] = generation
+    generation.task = asyncio.ensure_future(produce(generation))
+    generation.task.add_done_callback(generation._done)
+    return generation
+
+def get_generation(stream_id: str, session_id: str):
+    """Returns the generation, or None when it is unknown, expired or from another session."""
+    generation = _generations.get(stream_id)
+    if generation is None or generation.session_id != session_id:
+        return None
+    return generation
+
+async def cancel_generations(timeout: float = 5.0):
+    """Cancels the generations still running and waits for them to wind down. Called on shutdown."""
+    tasks = [g.task for g in _generations.values() if g.task is not None and not g.task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
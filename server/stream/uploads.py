@@ -0,0 +1,130 @@
+"""
+Registry of blobs uploaded to provider file stores.
+
+Uploads are recorded in the `remote_files` table by (provider, blob id),
+so every session, worker and restart reuses one upload. An entry is
+reused until UPLOAD_REFRESH_MARGIN seconds before the provider expires
+the file, then the blob is uploaded again. Missing files are uploaded
+concurrently. Concurrent requests for the same blob in one process share
+a single upload, and workers take a lease in the shared state (see
+`state.py`) so only one of them uploads a given blob at a time.
+"""
+import os
+import uuid
+import asyncio
+import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from state import shared_state
+from database.db import SessionLocal
+from database.models import RemoteFile
+
+from .extraction import file_sha256
+
+UPLOAD_REFRESH_MARGIN = float(os.environ.get("CONVO_UPLOAD_REFRESH_MARGIN", 3600))
+# Used when the provider does not report an expiry (Gemini keeps files 48 hours).
+DEFAULT_FILE_TTL = 48 * 3600
+# Longest an upload may hold its lease, and how often other workers check on it.
+UPLOAD_LEASE_SECONDS = 300
+UPLOAD_POLL_SECONDS = 0.5
+
+# (provider, blob id) -> (uri, mime type, expires at); mirrors the table.
+_known = {}
+_in_flight = {}
+
+def _utc(value):
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def _fresh(expires_at) -> bool:
+    return expires_at - datetime.timedelta(seconds=UPLOAD_REFRESH_MARGIN) > datetime.datetime.utcnow()
+
+def _lookup(provider: str, blob_id: str):
+    db = SessionLocal()
+    try:
+        row = db.query(RemoteFile).filter(RemoteFile.provider == provider, RemoteFile.blobId == blob_id).first()
+        return (row.uri, row.mimeType, row.expiresAt) if row else None
+    finally:
+        db.close()
+
+def _record(provider: str, blob_id: str, uri: str, mime_type: str, expires_at):
+    db = SessionLocal()
+    try:
+        values = {"uri": uri, "mimeType": mime_type, "uploadedAt": datetime.datetime.utcnow(), "expiresAt": expires_at}
+        updated = db.query(RemoteFile).filter(
+            RemoteFile.provider == provider, RemoteFile.blobId == blob_id
+        ).update(values, synchronize_session=False)
+        if not updated:
+            db.add(RemoteFile(provider=provider, blobId=blob_id, **values))
+        db.commit()
+    except IntegrityError:
+        # Another worker recorded its upload first; either one is fine.
+        db.rollback()
+    finally:
+        db.close()
+
+async def _upload_once(provider: str, blob_id: str, attachment: dict, upload):
+    """Uploads the blob unless another worker does, then returns the recorded entry."""
+    lease, owner = f"{provider}/{blob_id}", uuid.uuid4().hex
+    while not await shared_state.run(shared_state.acquire, "upload", lease, owner, UPLOAD_LEASE_SECONDS):
+        await asyncio.sleep(UPLOAD_POLL_SECONDS)
+        entry = await asyncio.to_thread(_lookup, provider, blob_id)
+        if entry is not None and _fresh(entry[2]):
+            return entry
+    try:
+        # The previous holder may have finished just before we took over.
+        entry = await asyncio.to_thread(_lookup, provider, blob_id)
+        if entry is not None and _fresh(entry[2]):
+            return entry
+        uri, mime_type, expires_at = await upload(attachment)
+        expires_at = _utc(expires_at) or datetime.datetime.utcnow() + datetime.timedelta(seconds=DEFAULT_FILE_TTL)
+        await asyncio.to_thread(_record, provider, blob_id, uri, mime_type, expires_at)
+        return uri, mime_type, expires_at
+    finally:
+        await shared_state.run(shared_state.release, "upload", lease, owner)
+
+async def _get_or_upload(provider: str, blob_id: str, attachment: dict, upload):
+    key = (provider, blob_id)
+    entry = _known.get(key)
+    if entry is None or not _fresh(entry[2]):
+        entry = await asyncio.to_thread(_lookup, provider, blob_id)
+    if entry is None or not _fresh(entry[2]):
+        entry = await _upload_once(provider, blob_id, attachment, upload)
+    _known[key] = entry
+    return entry
+
+async def remote_file(provider: str, attachment: dict, upload):
+    """
+    Returns `(uri, mime_type)` of the attachment in the provider's file
+    store. `upload(attachment)` is awaited when there is no fresh upload
+    and must return `(uri, mime_type, expires_at)`.
+    """
+    blob_id = attachment.get("blobId") or await asyncio.to_thread(file_sha256, attachment["file_path"])
+    key = (provider, blob_id)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_get_or_upload(provider, blob_id, attachment, upload))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    uri, mime_type, _ = await asyncio.shield(task)
+    return uri, mime_type
+
+async def remote_files(provider: str, attachments: list, upload) -> list:
+    """`remote_file` for every attachment, uploading the missing ones concurrently."""
+    return await asyncio.gather(*[remote_file(provider, attachment, upload) for attachment in attachments])
+
+def prune_remote_files() -> int:
+    """Deletes registry entries for files the provider has already expired."""
+    db = SessionLocal()
+    try:
+        removed = db.query(RemoteFile).filter(RemoteFile.expiresAt < datetime.datetime.utcnow()).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        return removed
+    finally:
+        db.close()
@@ -1,123 +1,435 @@
-import os
 import json
+import asyncio
 import base64
 import datetime
-from collections import defaultdict
+import uuid
+import threading
+from collections import defaultdict, OrderedDict
 
-import PyPDF2
+from fastapi import HTTPException
+from sqlalchemy import inspect, text
 
-from database.db import SessionLocal
+import metrics
+from logs import get_logger, fields
+from state import shared_state
+from database.db import SessionLocal, engine
 from database.models import Session as ChatSession, Message
+from database.usage import add_turn_usage
 
-async def extract_text_from_pdf(pdf_path):
-    text = ""
-    with open(pdf_path, "rb") as pdf_file:
-        reader = PyPDF2.PdfReader(pdf_file)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text.strip()    
+from .blobs import blob_path, blob_ids_of, adjust_refcounts, store_blob_bytes, store_legacy_file, registered_blob_ids
 
-def store_conversation_in_db(session_id: str, messages: list):
+logger = get_logger(__name__)
+
+def read_file_base64(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+# One lock per session so overlapping streams on the same session
+# cannot interleave their writes.
+_session_locks = defaultdict(threading.Lock)
+_session_locks_guard = threading.Lock()
+
+def get_session_lock(session_id: str) -> threading.Lock:
+    with _session_locks_guard:
+        return _session_locks[session_id]
+
+def turn_id_for(user_msg: dict, turn_index: int) -> str:
+    """
+    Returns the stable identifier of a conversation turn. Clients send a
+    `turnId` with each user message; older clients fall back to the
+    position of the turn in the conversation.
+    """
+    return user_msg.get("turnId") or f"turn-{turn_index}"
+
+def _serialize_attachments(user_msg: dict) -> str:
+    attachments = user_msg.get('attachments', [])
+    if not attachments:
+        return '[]'
+    attachments_list = []
+    # No file path: it is derived from the blob id each time the turn is sent.
+    for attachment in attachments:
+        attachments_list.append({
+            'name': attachment['name'],
+            'blobId': attachment.get('blobId'),
+            'type': attachment.get('type'),
+            'content': '',
+        })
+    return json.dumps(attachments_list)
+
+def _turn_fields(user_msg: dict, assistant_msg: dict) -> dict:
+    return {
+        "userText": user_msg["content"],
+        "aiResponse": assistant_msg["content"],
+        "attachments": _serialize_attachments(user_msg),
+        "model": assistant_msg["model"],
+        "persona": "professional",
+        "temperature": assistant_msg["temperature"],
+        "maxTokens": assistant_msg["max_tokens"],
+        "timestamp": datetime.datetime.fromisoformat(assistant_msg["timestamp"]),
+        "truncated": bool(assistant_msg.get("truncated")),
+        **_usage_fields(assistant_msg.get("usage")),
+    }
+
+def _usage_fields(usage: dict) -> dict:
+    if not usage:
+        return {}
+    return {
+        "promptTokens": usage["prompt_tokens"],
+        "completionTokens": usage["completion_tokens"],
+        "cachedTokens": usage["cached_tokens"],
+        "tokensEstimated": usage["estimated"],
+        "ttftSeconds": usage["ttft_seconds"],
+        "durationSeconds": usage["duration_seconds"],
+        "chunkCount": usage["chunks"],
+    }
+
+def _stored_usage(row: Message):
+    """The `usage` of an assistant message, as stored on its row (None before usage was recorded)."""
+    if row.promptTokens is None:
+        return None
+    return {
+        "prompt_tokens": row.promptTokens,
+        "completion_tokens": row.completionTokens,
+        "cached_tokens": row.cachedTokens or 0,
+        "estimated": bool(row.tokensEstimated),
+        "ttft_seconds": row.ttftSeconds,
+        "duration_seconds": row.durationSeconds,
+        "chunks": row.chunkCount or 0,
+    }
+
+def _add_usage(db, chat_session, assistant_msg: dict):
+    """Adds a newly generated turn to the usage rollups."""
+    if not assistant_msg.get("usage"):
+        return
+    add_turn_usage(
+        db, chat_session.sessionId, datetime.datetime.fromisoformat(assistant_msg["timestamp"]).date(),
+        assistant_msg["model"], assistant_msg["usage"], bool(assistant_msg.get("truncated")),
+    )
+
+def _stored_blob_ids(row: Message) -> list:
+    return blob_ids_of(json.loads(row.attachments or "[]"))
+
+def _rewrite_conversation(db, chat_session, messages: list):
+    for row in db.query(Message.attachments).filter(Message.sessionId == chat_session.id):
+        adjust_refcounts(db, _stored_blob_ids(row), -1)
+    db.query(Message).filter(Message.sessionId == chat_session.id).delete()
+    for turn_index, i in enumerate(range(0, len(messages) - 1, 2)):
+        user_msg, assistant_msg = messages[i], messages[i+1]
+        adjust_refcounts(db, blob_ids_of(user_msg.get("attachments")), 1)
+        db.add(Message(
+            sessionId=chat_session.id,
+            turnId=turn_id_for(user_msg, turn_index),
+            **_turn_fields(user_msg, assistant_msg),
+        ))
+
+def _persist_incremental(db, chat_session, messages: list):
+    """
+    Appends turns the database has not seen yet and updates turns whose
+    content changed (edits and regenerations). Unchanged turns are not
+    touched, so the cost of a write no longer grows with the session length.
+    Turns whose usage the row does not have yet are new generations and
+    are added to the usage rollups.
+    """
+    existing = (
+        db.query(Message)
+        .filter(Message.sessionId == chat_session.id)
+        .order_by(Message.id)
+        .all()
+    )
+    by_turn_id = {msg.turnId: msg for msg in existing if msg.turnId}
+
+    for turn_index, i in enumerate(range(0, len(messages) - 1, 2)):
+        user_msg, assistant_msg = messages[i], messages[i+1]
+        turn_id = turn_id_for(user_msg, turn_index)
+        row = by_turn_id.get(turn_id)
+
+        # Rows written before turn ids existed are matched by position.
+        if row is None and turn_index < len(existing) and not existing[turn_index].turnId:
+            row = existing[turn_index]
+            row.turnId = turn_id
+
+        if row is None:
+            adjust_refcounts(db, blob_ids_of(user_msg.get("attachments")), 1)
+            db.add(Message(sessionId=chat_session.id, turnId=turn_id, **_turn_fields(user_msg, assistant_msg)))
+            _add_usage(db, chat_session, assistant_msg)
+            continue
+
+        # Edited or regenerated turn: update the existing row in place.
+        new_usage = assistant_msg.get("usage") and assistant_msg["usage"] != _stored_usage(row)
+        if (row.userText == user_msg["content"] and row.aiResponse == assistant_msg["content"]
+                and bool(row.truncated) == bool(assistant_msg.get("truncated")) and not new_usage):
+            continue
+        if new_usage:
+            _add_usage(db, chat_session, assistant_msg)
+        adjust_refcounts(db, _stored_blob_ids(row), -1)
+        adjust_refcounts(db, blob_ids_of(user_msg.get("attachments")), 1)
+        for key, value in _turn_fields(user_msg, assistant_msg).items():
+            setattr(row, key, value)
+
+def remove_duplicate_turns(bind=engine) -> int:
+    """
+    Deletes all but the newest row of every (session, turn id). Older
+    versions of the write-behind writer could store a turn several times,
+    which the unique index on the pair no longer allows. Runs before
+    `add_missing_columns`, so it only reads columns older databases have.
+    """
+    if "turnId" not in {col["name"] for col in inspect(bind).get_columns("messages")}:
+        return 0
+    db = SessionLocal(bind=bind)
+    try:
+        duplicates = db.execute(text(
+            "SELECT id, attachments FROM messages WHERE turnId IS NOT NULL AND id NOT IN "
+            "(SELECT MAX(id) FROM messages WHERE turnId IS NOT NULL GROUP BY sessionId, turnId)"
+        )).all()
+        for row_id, attachments in duplicates:
+            adjust_refcounts(db, blob_ids_of(json.loads(attachments or "[]")), -1)
+            db.execute(text("DELETE FROM messages WHERE id = :id"), {"id": row_id})
+        db.commit()
+        if duplicates:
+            logger.warning("Removed duplicate stored turns", extra=fields(rows=len(duplicates)))
+        return len(duplicates)
+    finally:
+        db.close()
+
+def persist_conversation(db, session_id: str, messages: list, rewrite: bool = False) -> bool:
+    """
+    Writes the conversation into `db` without committing. Returns False
+    when the session does not exist. Callers must hold the session lock.
+    """
+    chat_session = db.query(ChatSession).filter(ChatSession.sessionId == session_id).first()
+    if chat_session is None:
+        logger.warning("Cannot store conversation, unknown session", extra=fields(session=session_id))
+        return False
+
+    if rewrite:
+        _rewrite_conversation(db, chat_session, messages)
+    else:
+        _persist_incremental(db, chat_session, messages)
+    # Keep the session list (ordered by updatedAt) in activity order.
+    chat_session.updatedAt = datetime.datetime.utcnow()
+    return True
+
+def store_conversation_in_db(session_id: str, messages: list, rewrite: bool = False):
     """
     Stores the conversation messages in the database.
-    If a session with session_id exists, append messages; 
-    otherwise, create a new session record.
+
+    By default only new or changed turns are written (see
+    `_persist_incremental`). Pass `rewrite=True` to replace every stored
+    message of the session with `messages`.
+    Writers for the same session are serialized.
     """
+    with get_session_lock(session_id), metrics.store_conversation_seconds.time():
+        db = SessionLocal()
+        try:
+            if persist_conversation(db, session_id, messages, rewrite=rewrite):
+                db.commit()
+                logger.debug("Conversation stored", extra=fields(session=session_id, messages=len(messages)))
+        except Exception as ex:
+            logger.exception("Error storing conversation", extra=fields(session=session_id))
+            db.rollback()
+        finally:
+            db.close()
+
+# Most recent conversation per session, in the format the routers send to
+# the providers. Lets a turn be served from memory while the previous turn
+# is still waiting in the write-behind queue.
+#
+# With a shared state (several workers), the next turn may reach another
+# worker. Each finished conversation is then also published to the shared
+# state under a new version, and a worker trusts its own copy only while
+# the versions match.
+CONVERSATION_CACHE_SIZE = 256
+# The shared copy only has to outlive the write-behind queue.
+CONVERSATION_SHARE_TTL = 600
+CONVERSATION_VERSION_TTL = 7 * 24 * 3600
+_conversation_cache = OrderedDict()
+_conversation_cache_lock = threading.Lock()
+
+def remember_conversation(session_id: str, messages: list, version: str = None):
+    with _conversation_cache_lock:
+        _conversation_cache[session_id] = (version, list(messages))
+        _conversation_cache.move_to_end(session_id)
+        while len(_conversation_cache) > CONVERSATION_CACHE_SIZE:
+            _conversation_cache.popitem(last=False)
+
+def _cached_conversation(session_id: str, version: str = None):
+    with _conversation_cache_lock:
+        cached = _conversation_cache.get(session_id)
+        if cached is None or (shared_state.shared and cached[0] != version):
+            return None
+        _conversation_cache.move_to_end(session_id)
+        return list(cached[1])
+
+def forget_session(session_id: str):
+    """Drops the per-session lock and cached history of a deleted session."""
+    with _session_locks_guard:
+        _session_locks.pop(session_id, None)
+    with _conversation_cache_lock:
+        _conversation_cache.pop(session_id, None)
+
+def _publish_conversation(session_id: str, version: str, messages: list):
+    shared_state.set("conversation", session_id, {"version": version, "messages": messages}, CONVERSATION_SHARE_TTL)
+    shared_state.set("conversation_version", session_id, version, CONVERSATION_VERSION_TTL)
+
+async def share_conversation(session_id: str, messages: list):
+    """
+    Makes the conversation just queued for storage visible to the other
+    workers. Does nothing when the state is not shared.
+    """
+    if not shared_state.shared:
+        return
+    version = uuid.uuid4().hex
+    # Inline file content stays out; the blob store has it.
+    shared = [
+        dict(msg, attachments=[{k: v for k, v in a.items() if k != "content"} for a in msg["attachments"]])
+        if msg.get("attachments") else msg
+        for msg in messages
+    ]
+    remember_conversation(session_id, messages, version)
+    await shared_state.run(_publish_conversation, session_id, version, shared)
+
+def _load_conversation_from_db(session_id: str) -> list:
     db = SessionLocal()
     try:
-        # Try to find an existing session with this session_id.
-        print("session_id", session_id)
-        chat_session = db.query(ChatSession).filter(ChatSession.sessionId == session_id).first()
-        print("chat_session", chat_session)
-
-        # Delete all messages for this session before adding new ones
-        if chat_session:
-            db.query(Message).filter(Message.sessionId == chat_session.id).delete()
-
-        for i in range(0, len(messages), 2):
-            user_msg = messages[i]
-            assistant_msg = messages[i+1]
-            print("assistant_msg", assistant_msg)
-
-            attachments = user_msg.get('attachments', [])
-            if attachments:
-                attachments_list = []
-                for attachment in attachments:
-                    attachments_list.append({'name': attachment['name'], 'file_path': attachment['file_path'], 'content': ''})
-                attachments = json.dumps(attachments_list)
-            else:
-                attachments = '[]'
-
-            new_msg = Message(
-                sessionId=chat_session.id,
-                userText=user_msg["content"],
-                aiResponse=assistant_msg["content"],
-                attachments=attachments,
-                model=assistant_msg["model"],
-                persona="professional",
-                temperature=assistant_msg["temperature"],
-                maxTokens=assistant_msg["max_tokens"],
-                timestamp=datetime.datetime.fromisoformat(assistant_msg["timestamp"])
-            )
-            db.add(new_msg)
-        db.commit()
-        print("Conversation stored successfully.")
-    except Exception as ex:
-        print("Error storing conversation:", ex)
-        db.rollback()
+        chat_session = db.query(ChatSession.id).filter(ChatSession.sessionId == session_id).first()
+        if chat_session is None:
+            return []
+        rows = db.query(Message).filter(Message.sessionId == chat_session.id).order_by(Message.id).all()
+        conversation = []
+        for row in rows:
+            conversation.append({
+                "role": "user",
+                "content": row.userText,
+                "attachments": json.loads(row.attachments or "[]"),
+                "turnId": row.turnId,
+            })
+            conversation.append({
+                "role": "assistant",
+                "content": row.aiResponse,
+                "model": row.model,
+                "temperature": row.temperature,
+                "max_tokens": row.maxTokens,
+                "timestamp": row.timestamp.isoformat() if row.timestamp else datetime.datetime.now().isoformat(),
+                "truncated": bool(row.truncated),
+                "usage": _stored_usage(row),
+            })
+        return conversation
     finally:
         db.close()
 
-async def handle_attachments(session_id, conversation, remove_content=True):
+async def load_conversation(session_id: str) -> list:
+    """
+    Returns the stored history of a session, from memory when possible and
+    otherwise from the database (off the event loop).
+    """
+    version = None
+    if shared_state.shared:
+        version = await shared_state.run(shared_state.get, "conversation_version", session_id)
+    cached = _cached_conversation(session_id, version)
+    if cached is not None:
+        return cached
+
+    if version is not None:
+        # Another worker's turn, possibly not written to the database yet.
+        entry = await shared_state.run(shared_state.get, "conversation", session_id)
+        if entry is not None and entry["version"] == version:
+            remember_conversation(session_id, entry["messages"], version)
+            return list(entry["messages"])
+
+    conversation = await asyncio.to_thread(_load_conversation_from_db, session_id)
+    remember_conversation(session_id, conversation, version)
+    return list(conversation)
+
+async def resolve_conversation(session_id: str, body: dict, conversation: list) -> list:
+    """
+    Returns the conversation to send to the provider.
+
+    Clients may send only the new user turn as `message`; the history is
+    then rebuilt on the server. Otherwise the full `conversation` sent by
+    the client is used as is.
     """
-    Process attachments for each message in the conversation.
-    
+    message = body.get("message")
+    if not message:
+        return conversation
+    message.setdefault("role", "user")
+    history = await load_conversation(session_id)
+    return history + [message]
+
+async def handle_attachments(session_id, conversation, remove_content=True, dropped=None):
+    """
+    Resolve the attachments of each message in the conversation to files
+    in the content-addressed blob store.
+
+    Attachments uploaded through `/attachments` carry a `blobId`. Older
+    clients send the file as base64 `content`, which is stored as a blob
+    the first time it is seen; identical files share one blob across
+    sessions. Turns stored before the blob store point at a file in the
+    session's `temp_attachments` folder, which is copied in. A `blobId`
+    must name a stored blob, or the request fails with a 400. Paths are
+    always derived from the blob id: a client-sent `file_path` is only
+    read as such a legacy location.
+
+    Attachments that resolve to no file are removed from their message,
+    and their names are added to `dropped`.
+
     Args:
         session_id (str): The unique identifier for the session
         conversation (list): List of message objects containing attachments
-        
+        remove_content (bool): Drop the base64 content once the file is stored
+        dropped (list): Collects the names of the attachments left out
+
     Returns:
-        None
-    """
-    # Process attachments for each message in the conversation
-    for outer_idx, msg in enumerate(conversation):
-        if "attachments" in msg and msg["attachments"]:
-            # Create a temporary folder for this session if it doesn't exist
-            session_folder = os.path.join("temp_attachments", session_id)
-            os.makedirs(session_folder, exist_ok=True)
-            
-            for inner_idx, attachment in enumerate(msg["attachments"]):
-                attachment_name = attachment.get("name", "unknown_file")
-                
-                # Check if this attachment already exists in the session
-                attachment_exists = False
-                file_path = None
-                
-                for existing_attachment in msg["attachments"]:
-                    if existing_attachment.get("name") == attachment_name and existing_attachment.get("file_path"):
-                        attachment_exists = True
-                        file_path = existing_attachment.get("file_path")
-                        break
-                
-                # Only decode and save if it's a new attachment
-                if not attachment_exists:
-                    attachment_content = attachment.get("content")
-                    if attachment_content:
-                        try:
-                            file_path = os.path.join(session_folder, attachment_name)
-                            # Decode base64 content and write to file
-                            with open(file_path, "wb") as f:
-                                f.write(base64.b64decode(attachment_content))
-                            
-                        except Exception as e:
-                            print(f"Error saving attachment: {str(e)}")
-                
-                # Add file_path to the original attachment dict
-                if file_path:
-                    if remove_content:
-                        del attachment["content"]
-                    attachment["file_path"] = file_path
-                    msg["attachments"][inner_idx] = attachment
-                    conversation[outer_idx] = msg
-
-    return conversation
\ No newline at end of file
+        list: The conversation, with a `file_path` on every attachment
+    """
+    attachments = [attachment for msg in conversation for attachment in msg.get("attachments") or []]
+    requested = {attachment["blobId"] for attachment in attachments if attachment.get("blobId")}
+    if requested:
+        unknown = requested - await asyncio.to_thread(registered_blob_ids, requested)
+        if unknown:
+            logger.warning("Rejected unknown blob ids", extra=fields(session=session_id, count=len(unknown)))
+            raise HTTPException(status_code=400, detail="Unknown attachment blobId")
+
+    for msg in conversation:
+        if not msg.get("attachments"):
+            continue
+        kept = []
+        for attachment in msg["attachments"]:
+            name = attachment.get("name", "unknown_file")
+            legacy_path = attachment.pop("file_path", None)
+            blob = None
+            try:
+                if attachment.get("blobId"):
+                    blob = {"blobId": attachment["blobId"]}
+                elif attachment.get("content"):
+                    with metrics.attachment_decode_seconds.time():
+                        data = base64.b64decode(attachment["content"])
+                        blob = await asyncio.to_thread(store_blob_bytes, data, name, attachment.get("type"))
+                else:
+                    blob = await asyncio.to_thread(store_legacy_file, session_id, legacy_path, name, attachment.get("type"))
+            except Exception as e:
+                logger.warning("Error saving attachment: %s", e, extra=fields(session=session_id, attachment=name))
+
+            if blob is None:
+                logger.warning("Attachment has no stored file", extra=fields(session=session_id, attachment=name))
+                if dropped is not None:
+                    dropped.append(name)
+                continue
+            attachment["blobId"] = blob["blobId"]
+            if blob.get("type"):
+                attachment["type"] = blob["type"]
+            attachment["file_path"] = blob_path(blob["blobId"])
+            if remove_content:
+                attachment.pop("content", None)
+            kept.append(attachment)
+        msg["attachments"] = kept
+
+    return conversation
+
+def is_pdf(attachment: dict) -> bool:
+    # Blob paths carry no extension, so look at the declared type and name.
+    if attachment.get("type") == "application/pdf":
+        return True
+    return any(
+        (attachment.get(key) or "").lower().endswith(".pdf")
+        for key in ("name", "file_path")
+    )
@@ -0,0 +1,89 @@
+"""
+Debug watchdog that reports coroutines holding the event loop.
+
+A heartbeat task on the loop records when it last ran; a separate thread
+checks the heartbeat and, when the loop has been unresponsive for longer
+than the threshold, captures the loop thread's current stack. That stack
+points at the blocking call (for example a synchronous SDK stream
+iterated inside an async generator).
+
+Enable it for the server with `CONVO_LOOP_WATCHDOG_MS=<threshold>`, or use
+it directly in tests:
+
+    watchdog = LoopWatchdog(threshold=0.05)
+    watchdog.start()
+    ...  # exercise the code under test
+    watchdog.stop()
+    assert not watchdog.reports
+"""
+import sys
+import time
+import asyncio
+import threading
+import traceback
+
+from logs import get_logger, fields
+
+logger = get_logger(__name__)
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.1, interval: float = None, on_block=None):
+        self.threshold = threshold
+        self.interval = interval or min(threshold / 4, 0.05)
+        self.on_block = on_block or self._log_report
+        self.reports = []
+        self.max_lag = 0.0
+
+        self._loop_thread_id = None
+        self._last_beat = 0.0
+        self._heartbeat_task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts watching the running loop. Call from the loop's thread."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat_task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            now = time.monotonic()
+            # The sleep itself accounts for `interval` of the gap.
+            self.max_lag = max(self.max_lag, now - self._last_beat - self.interval)
+            self._last_beat = now
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            last_beat = self._last_beat
+            blocked_for = time.monotonic() - last_beat - self.interval
+            if blocked_for < self.threshold or last_beat == reported_beat:
+                continue
+            # Report each stall once, with the stack at the time we noticed it.
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            report = {"blocked_for": blocked_for, "stack": stack}
+            self.reports.append(report)
+            self.on_block(report)
+
+    @staticmethod
+    def _log_report(report):
+        logger.warning("Event loop blocked, loop thread stack:\n%s", report["stack"], extra=fields(
+            blocked_ms=round(report["blocked_for"] * 1000)
+        ))
@@ -0,0 +1,153 @@
+import time
+import queue
+import threading
+from contextlib import ExitStack
+
+import metrics
+from logs import get_logger, fields
+from database.db import SessionLocal
+
+from .utils import get_session_lock, persist_conversation, store_conversation_in_db, remember_conversation
+
+logger = get_logger(__name__)
+
+class ConversationWriter:
+    """
+    Write-behind queue for conversation storage.
+
+    Stream handlers call `submit()` from the event loop, which only puts the
+    conversation on a queue. A dedicated writer thread drains the queue and
+    stores every pending conversation, across sessions, in one transaction.
+    """
+
+    def __init__(self, max_batch: int = 64):
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = object()
+
+        self.batches_committed = 0
+        self.items_written = 0
+        self.batches_failed = 0
+        self.last_commit_seconds = 0.0
+        self.total_commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, session_id: str, messages: list, rewrite: bool = False):
+        # Snapshot the list so later mutation by the caller does not leak
+        # into the queued write.
+        self.start()
+        self._queue.put((session_id, list(messages), rewrite))
+
+    def flush(self, timeout: float = 10.0):
+        """
+        Stops the writer thread after every queued conversation has been
+        stored. Called on application shutdown.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(self._stop)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning("Conversation writer did not finish in time", extra=fields(
+                timeout=timeout, pending=self._queue.qsize()
+            ))
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "batches_committed": self.batches_committed,
+            "items_written": self.items_written,
+            "batches_failed": self.batches_failed,
+            "last_commit_seconds": self.last_commit_seconds,
+            "avg_commit_seconds": self.total_commit_seconds / self.batches_committed if self.batches_committed else 0.0,
+            "max_commit_seconds": self.max_commit_seconds,
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            stopping = item is self._stop
+            batch = [] if stopping else [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stopping = True
+                    continue
+                batch.append(item)
+
+            if batch:
+                self._write_batch(batch)
+            if stopping and self._queue.empty():
+                return
+
+    def _write_batch(self, batch: list):
+        started = time.perf_counter()
+        # Each snapshot holds the whole conversation, so only the latest one
+        # per session needs storing. Rows added for an earlier snapshot are
+        # not flushed yet (autoflush is off) and would be inserted again.
+        latest = {}
+        for session_id, messages, rewrite in batch:
+            rewrite = rewrite or (session_id in latest and latest[session_id][1])
+            latest[session_id] = (messages, rewrite)
+        batch = [(session_id, messages, rewrite) for session_id, (messages, rewrite) in latest.items()]
+        # Lock sessions in a fixed order so we never deadlock with a
+        # concurrent synchronous store_conversation_in_db call.
+        session_ids = sorted({session_id for session_id, _, _ in batch})
+        db = SessionLocal()
+        try:
+            with ExitStack() as stack:
+                for session_id in session_ids:
+                    stack.enter_context(get_session_lock(session_id))
+                for session_id, messages, rewrite in batch:
+                    persist_conversation(db, session_id, messages, rewrite=rewrite)
+                db.commit()
+        except Exception as ex:
+            logger.warning("Error storing conversation batch, retrying one by one: %s", ex, extra=fields(size=len(batch)))
+            db.rollback()
+            db.close()
+            # Store what we can so one bad conversation does not drop the rest.
+            for session_id, messages, rewrite in batch:
+                store_conversation_in_db(session_id, messages, rewrite=rewrite)
+            self.batches_failed += 1
+            return
+        finally:
+            db.close()
+
+        elapsed = time.perf_counter() - started
+        metrics.writer_commit_seconds.observe(elapsed)
+        metrics.writer_batch_size.observe(len(batch))
+        self.batches_committed += 1
+        self.items_written += len(batch)
+        self.last_commit_seconds = elapsed
+        self.total_commit_seconds += elapsed
+        self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+conversation_writer = ConversationWriter()
+
+metrics.Gauge(
+    "convo_writer_queue_depth", "Conversations waiting in the write-behind queue.",
+    function=lambda: conversation_writer.metrics()["queue_depth"],
+)
+
+def enqueue_conversation(session_id: str, messages: list, rewrite: bool = False):
+    """
+    Non-blocking replacement for store_conversation_in_db, safe to call from
+    async code.
+    """
+    remember_conversation(session_id, messages)
+    conversation_writer.submit(session_id, messages, rewrite=rewrite)
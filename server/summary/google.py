@@ -1,22 +1,39 @@
 import os
-import json
-import tomli
-from string import Template
+import asyncio
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import Request, HTTPException
 from fastapi import APIRouter
 
 from google.genai import types
 from google import genai
 
-from database.db import SessionLocal
-from database.models import Session
+import metrics
+from logs import get_logger, log_payload, fields, redact
+
+from .prompts import render_summary_prompt, render_system_prompt, clean_summary
+from .store import load_summary_settings, save_summary
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 client = genai.client.AsyncClient(genai.client.ApiClient(api_key=GOOGLE_API_KEY))
 
+async def summarize(model: str, previous_summary: str, turns: list, persona: str = "professional") -> str:
+    """Returns the updated summary for `turns`, a list of (user text, assistant text) pairs."""
+    with metrics.summary_seconds.time(provider="gemini", model=model):
+        summary = await client.models.generate_content(
+            model=model,
+            contents=[render_summary_prompt(previous_summary, turns)],
+            config=types.GenerateContentConfig(
+                system_instruction=render_system_prompt(persona),
+                temperature=1.0,
+                max_output_tokens=8096,
+                top_p=0.95,
+            ),
+        )
+    logger.debug("Summary generated", extra=fields(model=model, summary=redact(summary.text)))
+    return summary.text
 
 @router.post("/gemini_summary")
 async def gemini_summary(request: Request):
@@ -29,11 +46,7 @@ async def gemini_summary(request: Request):
     if not conversation:
         raise HTTPException(status_code=400, detail="Missing 'conversation' in payload")
 
-    print("--------------------------------")
-    print(body)
-    print()
-    temperature = 1.0#body.get("temperature", 0.7)
-    max_tokens = 8096# body.get("max_tokens", 256)
+    log_payload(logger, "gemini_summary", body)
     model = body.get("model", "gemini-1.5-flash")
 
     # Get session ID from the request
@@ -41,50 +54,14 @@ async def gemini_summary(request: Request):
     if not session_id:
         raise HTTPException(status_code=400, detail="Missing 'session_id' in payload")
 
-    # Get previous summary from database
-    db = SessionLocal()
-    try:
-        session = db.query(Session).filter(Session.sessionId == session_id).first()
-        prev_summary = session.summary if session else ""
-    finally:
-        db.close()
-
-    with open("./configs/prompts.toml", "rb") as f:
-        prompts = tomli.load(f)
-
-    prompt = Template(prompts["summarization"]["prompt"])
-    system_prompt = Template(prompts["summarization"]["system_prompt"])
-
+    settings = await asyncio.to_thread(load_summary_settings, session_id)
     latest_conversation = conversation[-1]
-
-    summary = await client.models.generate_content(
-        model=model,
-        contents=[
-            prompt.safe_substitute(
-                previous_summary=prev_summary,
-                latest_conversation="User:{}\n\nAssistant:{}".format(
-                    latest_conversation["userText"], latest_conversation["aiResponse"]
-                ),
-            )
-        ],
-        config=types.GenerateContentConfig(
-            system_instruction=system_prompt.substitute(persona="professional"),
-            temperature=temperature,
-            max_output_tokens=max_tokens,
-            top_p=0.95,
-        ),
+    summary_text = await summarize(
+        model,
+        settings["summary"] if settings else "",
+        [(latest_conversation["userText"], latest_conversation["aiResponse"])],
     )
+    if settings:
+        await asyncio.to_thread(save_summary, session_id, clean_summary(summary_text))
 
-    print(summary)
-
-    # Update the session's summary in the database
-    db = SessionLocal()
-    try:
-        session = db.query(Session).filter(Session.sessionId == session_id).first()
-        if session:
-            session.summary = summary.text.replace("```markdown", "").replace("```md", "").strip()
-            db.commit()
-    finally:
-        db.close()
-
-    return {"summary": summary.text}
+    return {"summary": summary_text}
@@ -0,0 +1,211 @@
+"""
+Background summarization.
+
+When a stream finishes, the pipeline calls `schedule_summary`. For
+sessions with `enableSummarization`, a job folds the turns added since
+the last run into `Session.summary`, using the session's
+`summarizingModel`.
+
+- Jobs wait SUMMARY_DEBOUNCE_SECONDS before starting. A burst of turns on
+  one session becomes a single run. Turns that finish while a run is in
+  progress trigger exactly one follow-up run.
+- At most SUMMARY_CONCURRENCY runs per provider call the provider at
+  once.
+- Clients wait for the result with `GET /sessions/{id}/summary?wait=...`
+  (see `wait_for_summary`) instead of calling a summary route themselves.
+- With several workers, job status and a per-session lease live in the
+  shared state (see `state.py`): one worker at a time summarizes a
+  session, and a client may wait on any worker.
+"""
+import os
+import uuid
+import asyncio
+
+import metrics
+from state import shared_state
+from logs import get_logger, fields
+from stream.utils import load_conversation
+
+from .prompts import clean_summary
+from .store import load_summary_settings, save_summary
+from . import openai as openai_summary, google as google_summary
+
+logger = get_logger(__name__)
+
+SUMMARY_DEBOUNCE_SECONDS = float(os.environ.get("CONVO_SUMMARY_DEBOUNCE", 2.0))
+SUMMARY_CONCURRENCY = int(os.environ.get("CONVO_SUMMARY_CONCURRENCY", 2))
+# Longest a run may hold a session's lease, and how often others check on it.
+SUMMARY_LEASE_SECONDS = 300
+SUMMARY_POLL_SECONDS = 0.5
+
+# Summarizing model prefix -> (provider, summarize function).
+SUMMARIZERS = {
+    "gpt-4o": ("openai", openai_summary.summarize),
+    "gemini": ("gemini", google_summary.summarize),
+}
+
+summary_jobs = metrics.Counter(
+    "convo_summary_jobs", "Background summary jobs by result (done, failed, skipped, coalesced).", ("result",)
+)
+
+def summarizer_for(model: str):
+    for prefix, summarizer in SUMMARIZERS.items():
+        if (model or "").startswith(prefix):
+            return summarizer
+    return None
+
+def select_turns(conversation: list, turn_ids: set) -> list:
+    """
+    Returns the (user text, assistant text) pairs of the turns in
+    `turn_ids`, in conversation order. Falls back to the newest turn when
+    none of them can be found (e.g. clients that send no turn ids).
+    """
+    turns = []
+    for msg in conversation:
+        if msg.get("role") == "user":
+            turns.append([msg.get("turnId"), msg.get("content") or "", ""])
+        elif turns:
+            turns[-1][2] = msg.get("content") or ""
+
+    selected = [turn for turn in turns if turn[0] is not None and turn[0] in turn_ids]
+    if not selected:
+        selected = turns[-1:]
+    return [(user_text, ai_response) for _, user_text, ai_response in selected]
+
+class _Job:
+    def __init__(self):
+        self.state = "pending"
+        self.rerun = False
+        # Turns finished since the last run started.
+        self.turn_ids = set()
+        self.done = asyncio.Event()
+        self.owner = uuid.uuid4().hex
+
+class SummaryQueue:
+    def __init__(self, debounce: float = SUMMARY_DEBOUNCE_SECONDS, concurrency: int = SUMMARY_CONCURRENCY):
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self._jobs = {}
+        self._tasks = set()
+        self._semaphores = {}
+
+    def schedule(self, session_id: str, turn_id: str = None):
+        """Queues a summary run covering `turn_id`. Must be called on the event loop."""
+        job = self._jobs.get(session_id)
+        if job is not None:
+            job.turn_ids.add(turn_id)
+            if job.state == "running":
+                job.rerun = True
+            summary_jobs.inc(result="coalesced")
+            return
+        job = self._jobs[session_id] = _Job()
+        job.turn_ids.add(turn_id)
+        task = asyncio.ensure_future(self._run(session_id, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def status(self, session_id: str) -> str:
+        job = self._jobs.get(session_id)
+        if job is not None:
+            return job.state
+        return await shared_state.run(shared_state.get, "summary_job", session_id, "idle")
+
+    async def wait(self, session_id: str, timeout: float):
+        """Waits up to `timeout` seconds for the session's queued or running job, on any worker."""
+        job = self._jobs.get(session_id)
+        try:
+            if job is not None:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            else:
+                await asyncio.wait_for(self._wait_shared(session_id), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _wait_shared(self, session_id: str):
+        while await shared_state.run(shared_state.get, "summary_job", session_id):
+            await asyncio.sleep(SUMMARY_POLL_SECONDS)
+
+    async def _publish(self, session_id: str, state: str):
+        await shared_state.run(shared_state.set, "summary_job", session_id, state, SUMMARY_LEASE_SECONDS)
+
+    async def _lease(self, session_id: str, job: _Job):
+        """Waits until no other worker is summarizing the session."""
+        while not await shared_state.run(shared_state.acquire, "summary_lease", session_id, job.owner, SUMMARY_LEASE_SECONDS):
+            await asyncio.sleep(self.debounce or SUMMARY_POLL_SECONDS)
+
+    def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        if provider not in self._semaphores:
+            self._semaphores[provider] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[provider]
+
+    async def _run(self, session_id: str, job: _Job):
+        try:
+            await self._publish(session_id, "pending")
+            await asyncio.sleep(self.debounce)
+            while True:
+                # Also renews the lease before each follow-up run.
+                await self._lease(session_id, job)
+                job.state = "running"
+                job.rerun = False
+                await self._publish(session_id, "running")
+                turn_ids, job.turn_ids = job.turn_ids, set()
+                await self._summarize(session_id, turn_ids)
+                if not job.rerun:
+                    break
+                await asyncio.sleep(self.debounce)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            summary_jobs.inc(result="failed")
+            logger.warning("Summary job failed: %s", e, extra=fields(session=session_id))
+        finally:
+            job.state = "done"
+            self._jobs.pop(session_id, None)
+            job.done.set()
+            try:
+                await shared_state.run(shared_state.release, "summary_lease", session_id, job.owner)
+                await shared_state.run(shared_state.delete, "summary_job", session_id)
+            except Exception as e:
+                logger.warning("Could not clear summary job state: %s", e, extra=fields(session=session_id))
+
+    async def _summarize(self, session_id: str, turn_ids: set):
+        settings = await asyncio.to_thread(load_summary_settings, session_id)
+        if not settings or not settings["enabled"]:
+            summary_jobs.inc(result="skipped")
+            return
+        summarizer = summarizer_for(settings["model"])
+        if summarizer is None:
+            summary_jobs.inc(result="skipped")
+            logger.info("No summarizer for model", extra=fields(session=session_id, model=settings["model"]))
+            return
+
+        conversation = await load_conversation(session_id)
+        turns = select_turns(conversation, turn_ids)
+        if not turns:
+            summary_jobs.inc(result="skipped")
+            return
+
+        provider, summarize = summarizer
+        async with self._semaphore(provider):
+            summary = await summarize(settings["model"], settings["summary"], turns, settings["persona"])
+        await asyncio.to_thread(save_summary, session_id, clean_summary(summary))
+        summary_jobs.inc(result="done")
+        logger.info("Summary updated", extra=fields(session=session_id, provider=provider, turns=len(turns)))
+
+summary_queue = SummaryQueue()
+
+def schedule_summary(session_id: str, turn_id: str = None):
+    summary_queue.schedule(session_id, turn_id)
+
+async def wait_for_summary(session_id: str, timeout: float) -> dict:
+    """Returns the session's summary once no job is queued or running for it, or after `timeout`."""
+    await summary_queue.wait(session_id, timeout)
+    settings = await asyncio.to_thread(load_summary_settings, session_id)
+    return {
+        "summary": settings["summary"] if settings else "",
+        "status": await summary_queue.status(session_id),
+    }
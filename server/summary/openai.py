@@ -1,21 +1,36 @@
 import os
-import json
-import tomli
-from string import Template
+import asyncio
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import Request, HTTPException
 from fastapi import APIRouter
 
 from openai import AsyncOpenAI
 
-from database.db import SessionLocal
-from database.models import Session
+import metrics
+from logs import get_logger, log_payload
+
+from .prompts import render_summary_prompt, render_system_prompt, clean_summary
+from .store import load_summary_settings, save_summary
 
 router = APIRouter()
+logger = get_logger(__name__)
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+async def summarize(model: str, previous_summary: str, turns: list, persona: str = "professional") -> str:
+    """Returns the updated summary for `turns`, a list of (user text, assistant text) pairs."""
+    with metrics.summary_seconds.time(provider="openai", model=model):
+        summary = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": render_system_prompt(persona)},
+                {"role": "user", "content": render_summary_prompt(previous_summary, turns)},
+            ],
+            max_tokens=8096,
+            temperature=1.0,
+        )
+    return summary.choices[0].message.content
 
 @router.post("/openai_summary")
 async def openai_summary(request: Request):
@@ -28,11 +43,7 @@ async def openai_summary(request: Request):
     if not conversation:
         raise HTTPException(status_code=400, detail="Missing 'conversation' in payload")
 
-    print("--------------------------------")
-    print(body)
-    print()
-    temperature = 1.0#body.get("temperature", 0.7)
-    max_tokens = 8096#body.get("max_tokens", 256)
+    log_payload(logger, "openai_summary", body)
     model = body.get("model", "gpt-4o-mini")
 
     # Get session ID from the request
@@ -40,54 +51,14 @@ async def openai_summary(request: Request):
     if not session_id:
         raise HTTPException(status_code=400, detail="Missing 'session_id' in payload")
 
-    # Get previous summary from database
-    db = SessionLocal()
-    try:
-        session = db.query(Session).filter(Session.sessionId == session_id).first()
-        prev_summary = session.summary if session else ""
-    finally:
-        db.close()
-
-    with open("./configs/prompts.toml", "rb") as f:
-        prompts = tomli.load(f)
-
-    prompt = Template(prompts["summarization"]["prompt"])
-    system_prompt = Template(prompts["summarization"]["system_prompt"])
-
+    settings = await asyncio.to_thread(load_summary_settings, session_id)
     latest_conversation = conversation[-1]
-
-    summary = await client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt.substitute(persona="professional"),
-            },
-            {
-                "role": "user",
-                "content": prompt.safe_substitute(
-                    previous_summary=prev_summary,
-                    latest_conversation="User:{}\n\nAssistant:{}".format(
-                        latest_conversation["userText"],
-                        latest_conversation["aiResponse"],
-                    ),
-                ),
-            },
-        ],
-        max_tokens=max_tokens,
-        temperature=temperature,
+    summary_text = await summarize(
+        model,
+        settings["summary"] if settings else "",
+        [(latest_conversation["userText"], latest_conversation["aiResponse"])],
     )
-
-    summary_text = summary.choices[0].message.content
-
-    # Update the session's summary in the database
-    db = SessionLocal()
-    try:
-        session = db.query(Session).filter(Session.sessionId == session_id).first()
-        if session:
-            session.summary = summary_text.replace("```markdown", "").replace("```md", "").strip()
-            db.commit()
-    finally:
-        db.close()
+    if settings:
+        await asyncio.to_thread(save_summary, session_id, clean_summary(summary_text))
 
     return {"summary": summary_text}
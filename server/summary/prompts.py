@@ -0,0 +1,27 @@
+"""
+Summarization prompts, loaded from `configs/prompts.toml` once at import.
+"""
+import os
+import tomli
+from string import Template
+
+PROMPTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "prompts.toml")
+
+with open(PROMPTS_PATH, "rb") as f:
+    prompts = tomli.load(f)
+
+summary_prompt = Template(prompts["summarization"]["prompt"])
+summary_system_prompt = Template(prompts["summarization"]["system_prompt"])
+
+def format_turns(turns: list) -> str:
+    """Formats (user text, assistant text) pairs the way the prompt expects."""
+    return "\n\n".join(f"User:{user_text}\n\nAssistant:{ai_response}" for user_text, ai_response in turns)
+
+def render_summary_prompt(previous_summary: str, turns: list) -> str:
+    return summary_prompt.safe_substitute(previous_summary=previous_summary, latest_conversation=format_turns(turns))
+
+def render_system_prompt(persona: str = "professional") -> str:
+    return summary_system_prompt.substitute(persona=persona or "professional")
+
+def clean_summary(text: str) -> str:
+    return (text or "").replace("```markdown", "").replace("```md", "").strip()
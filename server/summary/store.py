@@ -0,0 +1,34 @@
+"""
+Reads and writes of the summary fields of a session. Each call is one
+short statement; call them off the event loop.
+"""
+from database.db import SessionLocal
+from database.models import Session
+
+def load_summary_settings(session_id: str):
+    """Returns the session's summary settings as a dict, or None for an unknown session."""
+    db = SessionLocal()
+    try:
+        row = db.query(
+            Session.summary, Session.enableSummarization, Session.summarizingModel, Session.persona
+        ).filter(Session.sessionId == session_id).first()
+        if row is None:
+            return None
+        return {
+            "summary": row.summary or "",
+            "enabled": bool(row.enableSummarization),
+            "model": row.summarizingModel,
+            "persona": row.persona,
+        }
+    finally:
+        db.close()
+
+def save_summary(session_id: str, summary: str):
+    db = SessionLocal()
+    try:
+        db.query(Session).filter(Session.sessionId == session_id).update(
+            {Session.summary: summary}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
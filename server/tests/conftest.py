@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+# Point the database, and with it the stores, at a scratch directory
+# before any server module opens them.
+_workdir = tempfile.mkdtemp(prefix="convo-tests-")
+os.environ.setdefault("CONVO_DATABASE_URL", f"sqlite:///{os.path.join(_workdir, 'database.db')}")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture(scope="session")
+def mock_root():
+    """Root URL of the mock providers (see `benchmarks.mock_providers`), served on their own thread."""
+    from benchmarks import load_test, mock_providers
+
+    return load_test.start_mock(mock_providers.MockConfig(ttft_ms=10, tokens_per_second=200, tokens=20))
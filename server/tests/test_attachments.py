@@ -0,0 +1,45 @@
+import os
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+
+from database.db import Base, engine
+from stream.blobs import blob_path, store_blob_bytes
+from stream.utils import handle_attachments
+
+@pytest.fixture(autouse=True)
+def schema():
+    Base.metadata.create_all(bind=engine)
+
+@pytest.mark.parametrize("blob_id", [
+    "../../etc/passwd",
+    "/etc/passwd",
+    "0" * 64,  # well formed but never uploaded
+])
+def test_unknown_blob_ids_are_rejected(blob_id):
+    conversation = [{"role": "user", "content": "hi", "attachments": [{"name": "x", "blobId": blob_id}]}]
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(handle_attachments("session", conversation))
+    assert excinfo.value.status_code == 400
+
+def test_file_path_comes_from_the_blob_id():
+    blob = store_blob_bytes(b"hello", "hello.txt", "text/plain")
+    conversation = [{"role": "user", "content": "hi", "attachments": [
+        {"name": "hello.txt", "blobId": blob["blobId"], "file_path": "/etc/passwd"},
+        {"name": "other.txt", "file_path": "/etc/passwd"},
+    ]}]
+    dropped = []
+    attachments = asyncio.run(handle_attachments("session", conversation, dropped=dropped))[0]["attachments"]
+    assert blob["blobId"] == hashlib.sha256(b"hello").hexdigest()
+    assert [a["file_path"] for a in attachments] == [blob_path(blob["blobId"])]
+    assert dropped == ["other.txt"]
+
+def test_blobs_live_next_to_the_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    blob = store_blob_bytes(b"elsewhere", "elsewhere.txt", "text/plain")
+    path = blob_path(blob["blobId"])
+    assert os.path.isabs(path) and os.path.exists(path)
+    assert path.startswith(os.path.dirname(engine.url.database))
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,33 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from benchmarks.pdf_extraction import make_synthetic_pdf
+from stream import extraction
+
+def test_pages_come_back_in_order(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    make_synthetic_pdf(path, 40)
+
+    async def pages():
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            return [page async for page in extraction.iter_pdf_pages(path, executor)]
+
+    pages = asyncio.run(pages())
+    assert [index for index, _, _ in pages] == list(range(40))
+    assert {count for _, count, _ in pages} == {40}
+    assert all(text.startswith(f"Page {index + 1} line 1:") for index, _, text in pages)
+
+def test_extraction_reports_progress(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    make_synthetic_pdf(path, 20)
+    extracted = metrics.attachment_extract_pages._values.get((), 0)
+
+    try:
+        text = asyncio.run(extraction.get_pdf_text(path))
+    finally:
+        extraction.shutdown_extraction()
+
+    assert text.startswith("Page 1 line 1:")
+    assert metrics.attachment_extract_pages._values[()] - extracted == 20
+    assert metrics.attachment_extract_pages_pending._values[()] == 0
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+# The provider clients refuse to build without a key.
+for name in ("GOOGLE_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from google import genai
+from google.genai import types
+
+from stream import google
+
+def stalled_server():
+    """Answers every request with stream headers and then never sends a byte."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    connections = []
+
+    def serve():
+        while True:
+            connection, _ = server.accept()
+            connection.recv(65536)
+            connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+            connections.append(connection)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return f"http://127.0.0.1:{server.getsockname()[1]}/"
+
+def readers():
+    return [thread for thread in threading.enumerate() if thread.name == "gemini-stream"]
+
+def test_cancel_stops_a_stalled_reader(monkeypatch):
+    api_client = google._ApiClient(api_key="test", http_options={"base_url": stalled_server()})
+    monkeypatch.setattr(google, "sync_models", genai.models.Models(api_client))
+    req = SimpleNamespace(model="gemini-pro", temperature=0.5, max_tokens=10, usage={})
+    messages = [types.Content(role="user", parts=[types.Part.from_text(text="hi")])]
+
+    async def cancel_midway():
+        deltas = google.adapter.stream(req, messages)
+        pending = asyncio.create_task(deltas.__anext__())
+        await asyncio.sleep(0.5)
+        pending.cancel()
+        try:
+            await pending
+        except asyncio.CancelledError:
+            pass
+        await deltas.aclose()
+
+    asyncio.run(cancel_midway())
+    deadline = time.monotonic() + 2
+    while readers() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not readers()
@@ -0,0 +1,48 @@
+import os
+import json
+
+# The provider clients refuse to build without a key.
+for name in ("GOOGLE_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+
+import main
+from database.db import DATA_DIR, SessionLocal
+from database.models import Session as ChatSession, Message
+from stream import openai
+
+def test_turn_after_legacy_attachments_streams(mock_root, monkeypatch):
+    monkeypatch.setattr(openai.adapter, "client", AsyncOpenAI(api_key="test", base_url=f"{mock_root}/v1"))
+    with TestClient(main.app) as client:
+        session_id = client.post("/add_session").json()["sessionId"]
+
+        # A turn stored before the blob store: one file still on disk, one gone.
+        folder = os.path.join(DATA_DIR, "temp_attachments", session_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, "notes.txt"), "w") as f:
+            f.write("legacy notes")
+        db = SessionLocal()
+        try:
+            chat_session = db.query(ChatSession).filter(ChatSession.sessionId == session_id).one()
+            db.add(Message(
+                sessionId=chat_session.id, turnId="t0", userText="read these", aiResponse="done",
+                attachments=json.dumps([
+                    {"name": "notes.txt", "file_path": f"temp_attachments/{session_id}/notes.txt", "content": ""},
+                    {"name": "doc.pdf", "file_path": f"temp_attachments/{session_id}/doc.pdf", "content": ""},
+                ]),
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+        response = client.post(
+            "/chat_stream",
+            json={"message": {"content": "and now?", "turnId": "t1"}, "model": "gpt-4o-mini"},
+            headers={"X-Session-ID": session_id},
+        )
+        assert response.status_code == 200
+        assert '"error"' not in response.text
+        assert "data: [DONE]" in response.text
+        assert json.loads(response.headers["X-Convo-Context"])["attachments_dropped"] == ["doc.pdf"]
@@ -0,0 +1,64 @@
+import os
+import time
+import asyncio
+
+# The provider clients refuse to build without a key.
+for name in ("GOOGLE_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+from anthropic import AsyncAnthropic
+
+from benchmarks.pdf_extraction import make_synthetic_pdf
+from stream import anthropic
+from stream.blobs import blob_path, store_blob_bytes
+from stream.pipeline import StreamRequest
+from stream.watchdog import LoopWatchdog
+
+THRESHOLD = 0.05
+
+def watched(coroutine_function):
+    """Runs the coroutine with a watchdog on the loop; returns (result, stall reports)."""
+    async def run():
+        watchdog = LoopWatchdog(threshold=THRESHOLD, on_block=lambda report: None)
+        watchdog.start()
+        try:
+            return await coroutine_function(), watchdog.reports
+        finally:
+            watchdog.stop()
+    return asyncio.run(run())
+
+def test_watchdog_reports_a_blocking_call():
+    async def blocking():
+        await asyncio.sleep(THRESHOLD)
+        time.sleep(THRESHOLD * 4)
+        await asyncio.sleep(THRESHOLD * 2)
+
+    _, reports = watched(blocking)
+    assert reports
+
+def test_anthropic_stream_does_not_block_the_loop(mock_root, monkeypatch, tmp_path):
+    monkeypatch.setattr(anthropic, "client", AsyncAnthropic(api_key="test", base_url=mock_root))
+    pdf = str(tmp_path / "doc.pdf")
+    make_synthetic_pdf(pdf, 50)
+    with open(pdf, "rb") as f:
+        blob = store_blob_bytes(f.read(), "doc.pdf", "application/pdf")
+    req = StreamRequest(
+        session_id="loop-blocking",
+        conversation=[{"role": "user", "content": "summarize", "attachments": [
+            {"name": "doc.pdf", "type": "application/pdf", "blobId": blob["blobId"], "file_path": blob_path(blob["blobId"])},
+        ]}],
+        model="claude-3.5-sonnet-latest",
+        temperature=0,
+        max_tokens=64,
+        timestamp="2026-01-01T00:00:00",
+        body={},
+    )
+
+    async def stream_turn():
+        messages = await anthropic.adapter.build_messages(req)
+        return [text async for text in anthropic.adapter.stream(req, messages)]
+
+    deltas, reports = watched(stream_turn)
+    assert len(deltas) == 20
+    assert req.usage["completion_tokens"] == 20
+    assert not reports, reports[0]["stack"]
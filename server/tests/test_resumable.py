@@ -0,0 +1,39 @@
+import asyncio
+
+from stream import resumable
+
+def run_generation(monkeypatch, deltas, replay_frames, text_chars):
+    """Publishes `deltas` on a finished generation with the given buffer sizes."""
+    monkeypatch.setattr(resumable, "STREAM_REPLAY_FRAMES", replay_frames)
+    monkeypatch.setattr(resumable, "STREAM_REPLAY_TEXT_CHARS", text_chars)
+
+    async def run():
+        generation = resumable.Generation("session", {}, catch_up=lambda text: f"catch-up:{text}\n")
+        for delta in deltas:
+            generation.publish(f"delta:{delta}\n", delta)
+        generation.finished = True
+        return generation
+    return asyncio.run(run())
+
+def frames_after(generation, last_event_id):
+    async def collect():
+        return [frame async for frame in generation.subscribe(last_event_id)]
+    return asyncio.run(collect())
+
+def test_resume_catches_up_with_missed_text(monkeypatch):
+    deltas = [f"{i:03d}" for i in range(100)]
+    generation = run_generation(monkeypatch, deltas, replay_frames=10, text_chars=1000)
+
+    frames = frames_after(generation, 50)
+
+    assert frames[0] == "id: 90\ncatch-up:" + "".join(deltas[50:90]) + "\n"
+    assert frames[1:] == [f"id: {i + 1}\ndelta:{deltas[i]}\n" for i in range(90, 100)]
+
+def test_kept_text_is_bounded(monkeypatch):
+    deltas = [f"{i:03d}" for i in range(1000)]
+    generation = run_generation(monkeypatch, deltas, replay_frames=10, text_chars=300)
+
+    assert generation._text_chars <= 300
+    assert not generation.can_resume(500)
+    assert generation.can_resume(950)
+    assert frames_after(generation, 950)[0] == "id: 990\ncatch-up:" + "".join(deltas[950:990]) + "\n"
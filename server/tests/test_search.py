@@ -0,0 +1,30 @@
+import pytest
+
+from database.db import Base, SessionLocal, engine
+from database.models import Session as ChatSession, Message
+from database.search import create_search_index, search_messages
+
+@pytest.fixture(autouse=True)
+def schema():
+    Base.metadata.create_all(bind=engine)
+    create_search_index()
+
+def test_snippets_escape_stored_text():
+    db = SessionLocal()
+    try:
+        chat_session = ChatSession(sessionId="search-xss", name="xss", title="xss")
+        db.add(chat_session)
+        db.flush()
+        db.add(Message(
+            sessionId=chat_session.id, turnId="t1",
+            userText='payload <img src=x onerror="alert(1)"> here', aiResponse="plain payload",
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+    [result] = [r for r in search_messages("payload") if r["sessionId"] == "search-xss"]
+    assert "<img" not in result["userSnippet"]
+    assert "&lt;img" in result["userSnippet"]
+    assert result["userSnippet"].startswith("<mark>payload</mark>")
+    assert result["aiSnippet"] == "plain <mark>payload</mark>"
@@ -0,0 +1,23 @@
+import os
+
+# The provider clients refuse to build without a key.
+for name in ("GOOGLE_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.mark.parametrize("body", [
+    {"model": "gpt-4o-mini", "message": "hi"},
+    {"model": "gpt-4o-mini", "message": {"text": "hi"}},
+    {"model": "gpt-4o-mini", "message": {"content": 42}},
+    {"model": "gpt-4o-mini", "message": {"content": "hi", "attachments": "doc.pdf"}},
+    {"model": "gpt-4o-mini", "message": {"content": "hi", "attachments": [{"blobId": "x"}]}},
+    ["not", "an", "object"],
+])
+def test_malformed_messages_are_rejected(body):
+    with TestClient(main.app, raise_server_exceptions=False) as client:
+        response = client.post("/chat_stream", json=body, headers={"X-Session-ID": "malformed"})
+    assert response.status_code == 400
@@ -0,0 +1,67 @@
+import uuid
+import datetime
+
+import pytest
+
+from database.db import Base, SessionLocal, engine
+from database.models import Session as ChatSession, Message, UsageSession
+from stream import utils
+from stream.writer import ConversationWriter
+
+@pytest.fixture(autouse=True)
+def schema():
+    Base.metadata.create_all(bind=engine)
+    yield
+
+@pytest.fixture
+def session_id():
+    session_id = uuid.uuid4().hex
+    db = SessionLocal()
+    db.add(ChatSession(sessionId=session_id, name="test", title="test"))
+    db.commit()
+    db.close()
+    return session_id
+
+def conversation(turns: int) -> list:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"q{i}", "turnId": f"t{i}", "attachments": []})
+        messages.append({
+            "role": "assistant", "content": f"a{i}", "model": "gpt-4o-mini", "temperature": 0.7,
+            "max_tokens": 1024, "timestamp": datetime.datetime.now().isoformat(),
+            "usage": {
+                "prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0, "estimated": False,
+                "ttft_seconds": 0.1, "duration_seconds": 0.5, "chunks": 3,
+            },
+        })
+    return messages
+
+def test_batch_with_growing_snapshots_stores_each_turn_once(session_id):
+    snapshots = [conversation(turns) for turns in range(1, 6)]
+    writer = ConversationWriter()
+    writer._write_batch([(session_id, snapshot, False) for snapshot in snapshots])
+    # A later batch with the same conversation changes nothing.
+    writer._write_batch([(session_id, snapshots[-1], False)])
+
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Message.turnId, Message.userText)
+            .join(ChatSession, Message.sessionId == ChatSession.id)
+            .filter(ChatSession.sessionId == session_id)
+            .order_by(Message.id)
+            .all()
+        )
+        turns = sum(row.turns for row in db.query(UsageSession).filter(UsageSession.sessionId == session_id))
+    finally:
+        db.close()
+    assert [tuple(row) for row in rows] == [(f"t{i}", f"q{i}") for i in range(5)]
+    assert turns == 5
+
+def test_deleted_sessions_release_their_lock(session_id):
+    ConversationWriter()._write_batch([(session_id, conversation(1), False)])
+    assert session_id in utils._session_locks
+
+    utils.forget_session(session_id)
+
+    assert session_id not in utils._session_locks